@@ -36,8 +36,77 @@ KMS_KEY_RING_ID = None
 KMS_KEY_ID = None
 KEYSET_FILE = None
 
+# Seconds between checks for a new KEYSET_FILE (e.g. after `tink_keyset` or a
+# rotation), which is then loaded without restarting. None to never check.
+KEYSET_RELOAD_INTERVAL = 5.0
+
+# Streaming AEAD keyset for large files (`tink_keyset --streaming`). Encrypted with
+# KMS like KEYSET_FILE when KMS is configured.
+STREAMING_KEYSET_FILE = None
+
+# KmsEnvelopeAead mode (KMS settings but no KEYSET_FILE): cache data keys so that
+# most encrypts and decrypts don't need a KMS round trip
+KMS_DEK_CACHE = True
+KMS_DEK_CACHE_SIZE = 1000  # unwrapped data keys kept for decryption
+KMS_DEK_CACHE_TTL = 300.0  # seconds
+KMS_DEK_MAX_USES = 1000  # encryptions per data key
+
+# Set (in seconds of simulated latency) to use an in-process stand-in for KMS when
+# no GCP settings are configured. Keys don't survive a restart; for testing only.
+LOCAL_KMS_LATENCY = None
+
+# Compress plaintexts of at least TINK_FIELD_COMPRESSION_THRESHOLD bytes before
+# encrypting them: "zlib", "zstd" (needs the zstandard package) or None. Existing
+# ciphertexts decrypt either way.
+TINK_FIELD_COMPRESSION = None
+TINK_FIELD_COMPRESSION_THRESHOLD = 1024
+TINK_FIELD_COMPRESSION_LEVEL = None  # the algorithm's default
+
 LEGACY_KEY = None
 
+# HMAC key for blind index columns (urlsafe base64, at least 32 bytes), kept apart
+# from the tink keyset. Generate one with `tink_field.blind_index.generate_key()`.
+# Blind indexes are left empty while this is None.
+BLIND_INDEX_KEY = None
+
+# Dotted path to a `tink_field.instrumentation.Instrumentation` subclass, or None
+# for no instrumentation. `PrometheusInstrumentation` is served at /secrets/metrics.
+TINK_FIELD_INSTRUMENTATION = "tink_field.instrumentation.PrometheusInstrumentation"
+
+# Checked by `manage.py check_import_time`
+TINK_FIELD_IMPORT_BUDGET_MS = 1000
+
+# Used by `EncryptedField`s with `write_behind=True`
+REENCRYPTION_QUEUE_SIZE = 10000
+REENCRYPTION_BATCH_SIZE = 500
+REENCRYPTION_FLUSH_INTERVAL = 1.0  # seconds
+
+# Concurrent reads of the same stale row wait this long for the one re-encrypting it
+# instead of re-encrypting it themselves
+REENCRYPTION_SINGLE_FLIGHT_TIMEOUT = 1.0  # seconds
+
+# Re-encryptions made by reads of stale fields, per process. Reads over budget
+# return the plaintext and leave the row for a later read. None for no limit.
+REENCRYPTION_RATE_LIMIT = 50.0  # per second
+REENCRYPTION_RATE_BURST = 100
+
+# Pool used by `Secret.objects.decrypted(...)`: "thread" or "process"
+DECRYPT_EXECUTOR = "thread"
+DECRYPT_WORKERS = 4
+
+# Ciphertexts that no encryptor could decrypt are remembered (as hashes) so that
+# repeated reads fail fast
+DECRYPT_NEGATIVE_CACHE_SIZE = 1000
+DECRYPT_NEGATIVE_CACHE_TTL = 300.0  # seconds
+
+# Alias in DATABASES that `tink_field.routers.ReplicaRouter` reads secrets from, or
+# None to read them from "default". Rows re-encrypted from replica reads are
+# remembered for REPLICA_REENCRYPTION_MEMO_TTL seconds (longer than the worst
+# replica lag) so they aren't re-encrypted again before the replica catches up.
+READ_REPLICA_DATABASE = "replica"
+REPLICA_REENCRYPTION_MEMO_SIZE = 10000
+REPLICA_REENCRYPTION_MEMO_TTL = 60.0  # seconds
+
 # Application definition
 
 INSTALLED_APPS = [
@@ -58,6 +127,8 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    # One UPDATE per row for the re-encryptions a request triggers
+    "tink_field.middleware.CoalesceReencryptionMiddleware",
 ]
 
 ROOT_URLCONF = "demo.urls"
@@ -88,9 +159,18 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
-    }
+    },
+    # Stands in for a read replica: the same file through a second connection, so a
+    # replica with no lag. With Postgres, point this at a standby of "default".
+    "replica": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": BASE_DIR / "db.sqlite3",
+        "TEST": {"MIRROR": "default"},
+    },
 }
 
+DATABASE_ROUTERS = ["tink_field.routers.ReplicaRouter"]
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -128,6 +208,9 @@ USE_TZ = True
 
 STATIC_URL = "static/"
 
+# Uploaded files are stored here, encrypted
+MEDIA_ROOT = BASE_DIR / "media"
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
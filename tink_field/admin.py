@@ -1,36 +1,170 @@
-import copy
-
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import EmptyPage, Paginator
+from django.db import connections
+from django.db.models import CharField, Case, Max, QuerySet, Value, When
+from django.db.models.fields import AutoFieldMixin
+from django.db.models.fields.json import KeyTextTransform
+from django.db.models.functions import Concat, Greatest, Length, Substr
+from django.db.models.lookups import GreaterThan
+from django.utils.functional import cached_property
 
 from .models import Secret
+from .reencryption import reencrypt_queryset
+
+
+class NeedsReencryptionFilter(admin.SimpleListFilter):
+    title = "needs re-encryption"
+    parameter_name = "stale"
+
+    def lookups(self, request, model_admin):
+        return [("yes", "Yes"), ("no", "No")]
+
+    def queryset(self, request, queryset):
+        match self.value():
+            case "yes":
+                return queryset.stale()
+            case "no":
+                return queryset.exclude(pk__in=queryset.stale().values("pk"))
+        return queryset
+
+
+def _tail(column, length):
+    # Last `length` characters (or bytes) of `column`; `Right()` doesn't work on
+    # binary columns everywhere
+    return Substr(column, Greatest(Length(column) - (length - 1), Value(1)))
+
+
+def _abbreviated(column, length=5):
+    return Concat(
+        Substr(column, 1, length),
+        Value("..."),
+        _tail(column, length),
+        output_field=CharField(),
+    )
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Avoids a full `COUNT(*)` on large tables. Unfiltered querysets use the
+    database's row estimate (or the largest primary key where there isn't one) once
+    it exceeds `exact_count_limit`; filtered querysets count at most
+    `exact_count_limit` rows, and exactly only when a page past that is requested.
+    """
+
+    exact_count_limit = 10000
+    # Whether `count` stopped at `exact_count_limit`, and whether it mustn't
+    _capped = False
+    _exact = False
+
+    def _estimate(self, queryset):
+        connection = connections[queryset.db]
+        table = queryset.model._meta.db_table
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+                    [connection.ops.quote_name(table)],
+                )
+                row = cursor.fetchone()
+            return row[0] if row else None
+        elif connection.vendor == "mysql":
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT table_rows FROM information_schema.tables "
+                    "WHERE table_schema = DATABASE() AND table_name = %s",
+                    [table],
+                )
+                row = cursor.fetchone()
+            return row[0] if row else None
+        elif isinstance(queryset.model._meta.pk, AutoFieldMixin):
+            # An index lookup; overcounts by however many rows were deleted
+            return queryset.order_by().aggregate(max_pk=Max("pk"))["max_pk"]
+        return None
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not isinstance(queryset, QuerySet):
+            return super().count
+        if not queryset.query.where:
+            estimate = self._estimate(queryset)
+            if estimate is not None and estimate > self.exact_count_limit:
+                return estimate
+        if self._exact:
+            return queryset.count()
+        count = queryset.values("pk").order_by()[: self.exact_count_limit].count()
+        self._capped = count == self.exact_count_limit
+        return count
+
+    def validate_number(self, number):
+        try:
+            return super().validate_number(number)
+        except EmptyPage:
+            if not self._capped:
+                raise
+        # Past the capped count; there may well be such a page
+        self._exact = True
+        self.__dict__.pop("count", None)
+        self.__dict__.pop("num_pages", None)
+        return super().validate_number(number)
+
+
+class SecretChangeList(ChangeList):
+    def get_queryset(self, request, exclude_parameters=None):
+        # Only fetch what the changelist shows; binary and b64 ciphertext previews are
+        # computed by the database instead of transferring whole ciphertexts
+        queryset = super().get_queryset(request, exclude_parameters)
+        json_secret = KeyTextTransform("secret", "json_with_encrypted_secret")
+        return queryset.only(
+            "name",
+            "_plaintext_secret",
+            "_plaintext_json",
+            "binary_reencryption_time",
+            "b64_reencryption_time",
+            "json_with_encrypted_secret",
+            "json_reencryption_time",
+        ).annotate(
+            binary_head=Substr("binary_encrypted_secret", 1, 5),
+            binary_tail=_tail("binary_encrypted_secret", 5),
+            b64_preview=_abbreviated("b64_encrypted_secret"),
+            json_secret_preview=Case(
+                When(
+                    GreaterThan(Length(json_secret), 30), then=_abbreviated(json_secret)
+                ),
+                default=json_secret,
+                output_field=CharField(),
+            ),
+        )
 
 
 class SecretAdmin(admin.ModelAdmin):
 
+    def get_changelist(self, request, **kwargs):
+        return SecretChangeList
+
     def binary_secret(self, obj):
-        if not obj.binary_encrypted_secret:
+        if not obj.binary_head:
             return ""
-        return (
-            f"{obj.binary_encrypted_secret[0:5]}...{obj.binary_encrypted_secret[-5:]}"
-        )
+        return f"{bytes(obj.binary_head)}...{bytes(obj.binary_tail)}"
 
     def b64_secret(self, obj):
-        return f"{obj.b64_encrypted_secret[0:5]}...{obj.b64_encrypted_secret[-5:]}"
+        return obj.b64_preview
 
     def json_with_secret(self, obj):
-        secret = obj.json_with_encrypted_secret["secret"]
-        if len(secret) > 30:
-            secret = f"{secret[0:5]}...{secret[-5:]}"
-        abbreviated = copy.deepcopy(obj.json_with_encrypted_secret)
-        abbreviated["secret"] = secret
-        return abbreviated
+        document = obj.json_with_encrypted_secret
+        if not isinstance(document, dict) or "secret" not in document:
+            return document
+        # A shallow copy; only the abbreviated ciphertext differs
+        return {**document, "secret": obj.json_secret_preview}
 
     def maybe_trigger_reencryption(self, request, queryset):
-        for secret in queryset.iterator():
-            print(f"Maybe re-encrypt binary: {secret.plaintext_from_binary}")
-            print(f"Maybe re-encrypt b64: {secret.plaintext_from_b64}")
-            print(f"Maybe re-encrypt json: {secret.plaintext_from_json}")
-        pass
+        stats = reencrypt_queryset(queryset)
+        self.message_user(
+            request,
+            f"Re-encrypted {stats.reencrypted} of {stats.scanned} stale secrets "
+            f"({stats.failed} failed to decrypt)",
+        )
 
     list_display = [
         "name",
@@ -44,6 +178,12 @@ class SecretAdmin(admin.ModelAdmin):
         "json_reencryption_time",
     ]
 
+    list_filter = [NeedsReencryptionFilter]
+
+    paginator = EstimatedCountPaginator
+    # Skips the second, unfiltered count on filtered pages
+    show_full_result_count = False
+
     actions = ["maybe_trigger_reencryption"]
 
 
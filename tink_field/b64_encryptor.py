@@ -1,7 +1,12 @@
 import base64
+import binascii
 
+from .keysets import HEADER_LEN, get_ciphertext_matcher
 from .tink_encryptor import TinkEncryptor
 
+# Base64 characters needed to decode `HEADER_LEN` bytes
+_HEADER_CHARS = -(-HEADER_LEN // 3) * 4
+
 
 class B64Encryptor(TinkEncryptor):
     """
@@ -33,6 +38,43 @@ class B64Encryptor(TinkEncryptor):
         ciphertext = base64.b64decode(encoded_ciphertext)
         return super().decrypt(ciphertext, associated_data).decode("utf-8")
 
+    def may_decrypt(self, encoded_ciphertext) -> bool:
+        # Only decode enough of the ciphertext for the header check
+        if not isinstance(encoded_ciphertext, (str, bytes)):
+            return False
+        if len(encoded_ciphertext) % 4:
+            return False
+        padding = encoded_ciphertext[-2:].count(
+            "=" if type(encoded_ciphertext) == str else b"="
+        )
+        try:
+            header = base64.b64decode(encoded_ciphertext[:_HEADER_CHARS])
+        except (binascii.Error, ValueError):
+            return False
+        length = len(encoded_ciphertext) // 4 * 3 - padding
+        return get_ciphertext_matcher()(header[:HEADER_LEN], length)
+
+    def key_id(self, encoded_ciphertext: str) -> str | None:
+        return super().key_id(base64.b64decode(encoded_ciphertext))
+
+    async def aencrypt(
+        self, plaintext: bytes | str, associated_data: bytes | str = b""
+    ) -> str:
+        ciphertext = await super().aencrypt(plaintext, associated_data)
+        return base64.b64encode(ciphertext).decode("utf-8")
+
+    async def adecrypt(
+        self, encoded_ciphertext: bytes | str, associated_data: bytes | str = b""
+    ) -> str:
+        if type(encoded_ciphertext) == str:
+            encoded_ciphertext = encoded_ciphertext.encode("utf-8")
+        if type(associated_data) == str:
+            associated_data = associated_data.encode("utf-8")
+
+        ciphertext = base64.b64decode(encoded_ciphertext)
+        plaintext = await super().adecrypt(ciphertext, associated_data)
+        return plaintext.decode("utf-8")
+
 
 _encryptor: B64Encryptor = None
 
@@ -0,0 +1,110 @@
+import math
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+import django
+from django.apps import apps
+from django.conf import settings
+
+from .encrypted_field import encrypted_fields
+
+
+def _decrypt_batch(model_label, items):
+    """
+    Runs on a pool worker. `items` is a list of (field name, ciphertext, associated
+    data) tuples; returns a list of (ok, plaintext or error message) tuples.
+    """
+    fields = encrypted_fields(apps.get_model(model_label))
+    results = []
+    for field_name, ciphertext, associated_data in items:
+        try:
+            plaintext = fields[field_name].decrypt_value(ciphertext, associated_data)
+            results.append((True, plaintext))
+        except Exception as e:
+            results.append((False, str(e)))
+    return results
+
+
+_executor: Executor = None
+_executor_lock = threading.Lock()
+
+
+def decrypt_workers() -> int:
+    return getattr(settings, "DECRYPT_WORKERS", 4)
+
+
+def get_executor() -> Executor:
+    """
+    Returns the shared pool used for batched decryption. `settings.DECRYPT_EXECUTOR`
+    selects a "thread" (default) or "process" pool of `settings.DECRYPT_WORKERS`.
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                kind = getattr(settings, "DECRYPT_EXECUTOR", "thread")
+                if kind == "thread":
+                    _executor = ThreadPoolExecutor(
+                        max_workers=decrypt_workers(),
+                        thread_name_prefix="tink-field-decrypt",
+                    )
+                elif kind == "process":
+                    _executor = ProcessPoolExecutor(
+                        max_workers=decrypt_workers(), initializer=django.setup
+                    )
+                else:
+                    raise Exception(f"Unknown DECRYPT_EXECUTOR {kind}")
+
+    return _executor
+
+
+def decrypt_instances(instances, field_names, executor: Executor | None = None):
+    """
+    Decrypts `field_names` for every instance in `instances` (all of the same model)
+    in one batch on `executor` and primes each field's plaintext cache, so that
+    reading those fields afterwards does not decrypt again.
+
+    Values that are already cached are skipped. Values that fail to decrypt are left
+    alone; reading them goes through the usual `EncryptedField` failure handling.
+    """
+    if not instances:
+        return
+    if executor is None:
+        executor = get_executor()
+
+    model = type(instances[0])
+    all_fields = encrypted_fields(model)
+    fields = {name: all_fields[name] for name in field_names}
+    fields = {name: f for name, f in fields.items() if f.cache_plaintext}
+
+    targets = []
+    items = []
+    for obj in instances:
+        for name, f in fields.items():
+            ciphertext = getattr(obj, f.ciphertext_attr, None)
+            if ciphertext is None:
+                continue
+            if isinstance(ciphertext, memoryview):
+                ciphertext = bytes(ciphertext)
+            associated_data = f._get_associated_data(obj)
+            cached = f._cache(obj).get(name)
+            if cached is not None and cached[:2] == (ciphertext, associated_data):
+                continue
+            targets.append((obj, f, ciphertext, associated_data))
+            items.append((name, ciphertext, associated_data))
+
+    if not items:
+        return
+
+    slice_size = math.ceil(len(items) / decrypt_workers())
+    futures = [
+        executor.submit(
+            _decrypt_batch, model._meta.label, items[start : start + slice_size]
+        )
+        for start in range(0, len(items), slice_size)
+    ]
+    results = [result for future in futures for result in future.result()]
+
+    for (obj, f, ciphertext, associated_data), (ok, plaintext) in zip(targets, results):
+        if ok:
+            f.prime_cache(obj, ciphertext, associated_data, plaintext)
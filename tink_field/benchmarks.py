@@ -0,0 +1,313 @@
+import base64
+import importlib.metadata
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+
+import tink
+from cryptography.fernet import Fernet
+from django.test.utils import override_settings
+from tink import aead
+from tink import secret_key_access
+
+from . import compression
+
+SIZES = (16, 256, 4096, 65536, 1048576)
+ASSOCIATED_DATA = b"benchmark"
+
+
+@dataclass
+class Result:
+    name: str
+    operation: str
+    size: int
+    iterations: int
+    ns_per_op: float
+    # Output size / input size, for cases where that's interesting
+    ratio: float | None = None
+
+    @property
+    def key(self):
+        return f"{self.name}/{self.operation}/{self.size}"
+
+    @property
+    def mb_per_second(self):
+        return self.size / self.ns_per_op * 1e9 / 1e6
+
+
+def _time_ns(func, iterations):
+    start = time.perf_counter_ns()
+    for _ in range(iterations):
+        func()
+    return time.perf_counter_ns() - start
+
+
+def measure(func, min_time=0.2, repeat=3) -> tuple[int, float]:
+    """
+    Calls `func` in batches of about `min_time` seconds, `repeat` times, and returns
+    (iterations per batch, best nanoseconds per call).
+    """
+    # Double the batch size until one batch takes at least a tenth of `min_time`
+    iterations = 1
+    while (elapsed := _time_ns(func, iterations)) < min_time * 1e8:
+        iterations *= 2
+    iterations = max(1, int(iterations * min_time * 1e9 / elapsed))
+
+    best = min(_time_ns(func, iterations) for _ in range(repeat))
+    return iterations, best / iterations
+
+
+@contextmanager
+def offline_settings(**extra):
+    """
+    Points every encryptor at a freshly generated plaintext keyset and Fernet key,
+    with KMS and instrumentation turned off.
+    """
+    aead.register()
+    keyset_handle = tink.new_keyset_handle(aead.aead_key_templates.AES128_GCM)
+    with tempfile.TemporaryDirectory() as tmp:
+        keyset_file = os.path.join(tmp, "keyset.json")
+        with open(keyset_file, "wt") as f:
+            f.write(
+                tink.json_proto_keyset_format.serialize(
+                    keyset_handle, secret_key_access.TOKEN
+                )
+            )
+        overrides = {
+            "GCP_PROJECT_ID": None,
+            "KMS_LOCATION_ID": None,
+            "KMS_KEY_RING_ID": None,
+            "KMS_KEY_ID": None,
+            "KEYSET_FILE": keyset_file,
+            "LOCAL_KMS_LATENCY": None,
+            "LEGACY_KEY": Fernet.generate_key(),
+            "TINK_FIELD_INSTRUMENTATION": None,
+        }
+        overrides.update(extra)
+        with override_settings(**overrides):
+            yield
+
+
+def _payload(size):
+    # Printable so it works for the str-based encryptors too
+    return ("x" * size).encode("utf-8")
+
+
+def encryptor_cases(sizes):
+    from .b64_encryptor import B64Encryptor
+    from .legacy_encryptor import LegacyEncryptor
+    from .json_encryptor import JsonEncryptor
+    from .models import PlaintextEncryptor
+    from .tink_encryptor import TinkEncryptor
+
+    encryptors = {
+        "TinkEncryptor": (TinkEncryptor(), lambda p: p),
+        "B64Encryptor": (B64Encryptor(), lambda p: p.decode("utf-8")),
+        "JsonEncryptor": (JsonEncryptor(), lambda p: {"secret": p.decode("utf-8")}),
+        "LegacyEncryptor": (LegacyEncryptor(), lambda p: p),
+        "PlaintextEncryptor": (PlaintextEncryptor(), lambda p: p),
+    }
+    for name, (encryptor, convert) in encryptors.items():
+        for size in sizes:
+            plaintext = convert(_payload(size))
+            ciphertext = encryptor.encrypt(plaintext, ASSOCIATED_DATA)
+            yield name, "encrypt", size, (
+                lambda e=encryptor, p=plaintext: e.encrypt(p, ASSOCIATED_DATA)
+            )
+            yield name, "decrypt", size, (
+                lambda e=encryptor, c=ciphertext: e.decrypt(c, ASSOCIATED_DATA)
+            )
+
+
+def field_cases(sizes):
+    """
+    `EncryptedField` overhead on top of the primitives measured above, plus raw
+    column decrypts routed to the primary and to the fallback encryptor.
+    """
+    from .legacy_encryptor import LegacyEncryptor
+    from .models import Secret
+
+    field = Secret.__dict__["plaintext_from_b64"]
+    legacy = LegacyEncryptor()
+
+    for size in sizes:
+        plaintext = _payload(size).decode("utf-8")
+
+        def assign(plaintext=plaintext):
+            secret = Secret(name="benchmark")
+            secret.plaintext_from_b64 = plaintext
+
+        yield "EncryptedField", "set", size, assign
+
+        secret = Secret(name="benchmark")
+        secret.plaintext_from_b64 = plaintext
+        yield "EncryptedField", "get_cached", size, lambda s=secret: (
+            s.plaintext_from_b64
+        )
+
+        def uncached_get(secret=secret):
+            secret.__dict__.pop("_encrypted_field_cache", None)
+            return secret.plaintext_from_b64
+
+        yield "EncryptedField", "get_uncached", size, uncached_get
+
+        # The raw-column read path for each encryptor. A Fernet token fails the
+        # primary's `may_decrypt`, so only the fallback decrypts it; the gap between
+        # the two is the routing, not a failed primary attempt
+        yield "EncryptedField", "decrypt_via_primary", size, (
+            lambda c=field.encryptor.encrypt(plaintext, ASSOCIATED_DATA): (
+                field.decrypt_value(c, ASSOCIATED_DATA)
+            )
+        )
+        yield "EncryptedField", "decrypt_via_fallback", size, (
+            lambda c=legacy.encrypt(plaintext): field.decrypt_value(c, ASSOCIATED_DATA)
+        )
+
+
+def _json_payload(size):
+    # Shaped like a typical JSON secret: repeated keys, short values
+    records = []
+    i = 0
+    while len(json.dumps(records)) < size:
+        records.append(
+            {"id": i, "name": f"service-{i % 17}", "token": f"{i * 7919:012x}"}
+        )
+        i += 1
+    return json.dumps(records).encode("utf-8")[:size]
+
+
+def _text_payload(size):
+    words = "the quick brown fox jumps over a lazy dog while secrets rotate".split()
+    rng = random.Random(size)
+    text = " ".join(rng.choice(words) for _ in range(size // 3 + 1))
+    return text.encode("utf-8")[:size]
+
+
+def _random_payload(size):
+    # Already-encrypted or random tokens; compression can't help
+    return base64.b64encode(random.Random(size).randbytes(size))[:size]
+
+
+PAYLOADS = {"json": _json_payload, "text": _text_payload, "random": _random_payload}
+
+
+def compression_algorithms():
+    available = ["zlib"]
+    try:
+        import zstandard  # noqa: F401
+
+        available.append("zstd")
+    except ImportError:
+        pass
+    return available
+
+
+def compression_cases(sizes):
+    """
+    Size vs. CPU for each compression algorithm on representative payloads, and
+    what it does to end-to-end `B64Encryptor` encrypt/decrypt time and ciphertext
+    size. The ratio is compressed size / original size (lower is better).
+
+    Cases are yielded with compression enabled in the settings, so they must be
+    measured as they are yielded rather than collected first.
+    """
+    from .b64_encryptor import B64Encryptor
+
+    encryptor = B64Encryptor()
+    for algorithm in compression_algorithms():
+        with override_settings(
+            TINK_FIELD_COMPRESSION=algorithm, TINK_FIELD_COMPRESSION_THRESHOLD=0
+        ):
+            for kind, make_payload in PAYLOADS.items():
+                for size in sizes:
+                    payload = make_payload(size)
+                    compressed = compression.compress(payload)
+                    ratio = len(compressed) / len(payload)
+                    yield algorithm, f"compress_{kind}", size, ratio, (
+                        lambda p=payload: compression.compress(p)
+                    )
+                    yield algorithm, f"decompress_{kind}", size, ratio, (
+                        lambda c=compressed: compression.decompress(c)
+                    )
+
+                    plaintext = payload.decode("utf-8")
+                    ciphertext = encryptor.encrypt(plaintext, ASSOCIATED_DATA)
+                    with override_settings(TINK_FIELD_COMPRESSION=None):
+                        uncompressed = encryptor.encrypt(plaintext, ASSOCIATED_DATA)
+                    ratio = len(ciphertext) / len(uncompressed)
+                    name = f"B64Encryptor+{algorithm}"
+                    yield name, f"encrypt_{kind}", size, ratio, (
+                        lambda p=plaintext: encryptor.encrypt(p, ASSOCIATED_DATA)
+                    )
+                    yield name, f"decrypt_{kind}", size, ratio, (
+                        lambda c=ciphertext: encryptor.decrypt(c, ASSOCIATED_DATA)
+                    )
+
+
+def run(sizes=SIZES, min_time=0.2, repeat=3, only=None, progress=None):
+    results = []
+    with offline_settings():
+        cases = itertools.chain(
+            ((*case[:3], None, case[3]) for case in encryptor_cases(sizes)),
+            ((*case[:3], None, case[3]) for case in field_cases(sizes)),
+            compression_cases(sizes),
+        )
+        for name, operation, size, ratio, func in cases:
+            if only is not None and name not in only:
+                continue
+            iterations, ns_per_op = measure(func, min_time, repeat)
+            result = Result(name, operation, size, iterations, ns_per_op, ratio)
+            results.append(result)
+            if progress is not None:
+                progress(result)
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "commit": commit or None,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "tink": importlib.metadata.version("tink"),
+        "timestamp": time.time(),
+    }
+
+
+def report(results) -> dict:
+    return {
+        "environment": environment(),
+        "results": [asdict(result) for result in results],
+    }
+
+
+def compare(baseline: dict, results, threshold: float):
+    """
+    Returns (key, baseline ns/op, current ns/op, ratio) for every result that is
+    slower than the baseline by more than `threshold` (e.g. 1.1 for 10%).
+    """
+    previous = {
+        f"{r['name']}/{r['operation']}/{r['size']}": r["ns_per_op"]
+        for r in baseline["results"]
+    }
+    regressions = []
+    for result in results:
+        before = previous.get(result.key)
+        if before is None:
+            continue
+        ratio = result.ns_per_op / before
+        if ratio > threshold:
+            regressions.append((result.key, before, result.ns_per_op, ratio))
+    return regressions
@@ -0,0 +1,78 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+
+# Blind indexes are HMAC-SHA256 hex digests
+BLIND_INDEX_LENGTH = 64
+
+
+def generate_key() -> str:
+    """
+    Returns a new random value for `settings.BLIND_INDEX_KEY`.
+    """
+    return base64.urlsafe_b64encode(os.urandom(32)).decode("utf-8")
+
+
+_key: bytes = None
+
+
+def has_key() -> bool:
+    return getattr(settings, "BLIND_INDEX_KEY", None) is not None
+
+
+def get_key() -> bytes:
+    """
+    Returns the decoded `settings.BLIND_INDEX_KEY`. It is deliberately separate from
+    the tink keyset: rotating the keyset doesn't invalidate the index, and the HMAC
+    key never has to be able to decrypt anything.
+    """
+    global _key
+    if _key is None:
+        encoded = getattr(settings, "BLIND_INDEX_KEY", None)
+        if encoded is None:
+            raise ImproperlyConfigured("BLIND_INDEX_KEY is not set")
+        key = base64.urlsafe_b64decode(encoded)
+        if len(key) < 32:
+            raise ImproperlyConfigured("BLIND_INDEX_KEY must be at least 32 bytes")
+        _key = key
+
+    return _key
+
+
+def _canonical(value) -> bytes:
+    match value:
+        case bytes():
+            return value
+        case bytearray() | memoryview():
+            return bytes(value)
+        case str():
+            return value.encode("utf-8")
+        case _:
+            return json.dumps(value, sort_keys=True, separators=(",", ":")).encode(
+                "utf-8"
+            )
+
+
+def compute(label: str, value) -> str:
+    """
+    Keyed HMAC of `value`, domain-separated by the field's `label` so equal values in
+    different fields don't produce equal indexes.
+    """
+    label = label.encode("utf-8")
+    message = len(label).to_bytes(4, "big") + label + _canonical(value)
+    return hmac.new(get_key(), message, hashlib.sha256).hexdigest()
+
+
+def _reset(*, setting, **kwargs):
+    global _key
+    if setting == "BLIND_INDEX_KEY":
+        _key = None
+
+
+setting_changed.connect(_reset)
@@ -0,0 +1,294 @@
+import contextvars
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import router
+from django.db.models import Q
+
+from .instrumentation import get_instrumentation
+from .negative_cache import ciphertext_bytes
+
+logger = logging.getLogger(__name__)
+
+
+def _fingerprint(ciphertext) -> bytes:
+    return hashlib.blake2b(ciphertext_bytes(ciphertext), digest_size=16).digest()
+
+
+class RecentReencryptions:
+    """
+    Bounded LRU of rows this process re-encrypted after reading them from a
+    replica, with the last re-encryption times and ciphertexts they were read with.
+    Until the replica catches up it keeps returning both, and reads that see them
+    skip re-encrypting the row again. A row rewritten meanwhile has a different
+    ciphertext, even if its time is the same (e.g. NULL), so it isn't skipped.
+    Entries expire after `ttl` seconds, which should exceed the worst replica lag.
+
+    Only hashes of the ciphertexts are stored.
+    """
+
+    def __init__(self, size: int = 10000, ttl: float = 60.0):
+        self.size = size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # (model label, pk, column) -> (value, ciphertext fingerprint, expiry)
+        self._entries = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, obj, expected: dict, ciphertext):
+        """
+        Remembers that `obj`'s row was re-encrypted from a read where the
+        `expected` columns held their values and the field held `ciphertext`.
+        """
+        if self.size <= 0:
+            return
+        fingerprint = _fingerprint(ciphertext)
+        expiry = time.monotonic() + self.ttl
+        with self._lock:
+            for column, value in expected.items():
+                key = (obj._meta.label, obj.pk, column)
+                self._entries[key] = (value, fingerprint, expiry)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def seen(self, obj, column: str, value, ciphertext) -> bool:
+        """
+        Whether `obj`'s row was re-encrypted from a read where `column` held
+        `value` and the field held `ciphertext`, i.e. `obj` was read from a
+        replica that hasn't caught up yet.
+        """
+        key = (obj._meta.label, obj.pk, column)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False
+            if entry[2] <= time.monotonic():
+                del self._entries[key]
+                return False
+        return entry[0] == value and entry[1] == _fingerprint(ciphertext)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_recent: RecentReencryptions = None
+
+
+def get_recent_reencryptions() -> RecentReencryptions:
+    global _recent
+    if _recent is None:
+        _recent = RecentReencryptions(
+            size=getattr(settings, "REPLICA_REENCRYPTION_MEMO_SIZE", 10000),
+            ttl=getattr(settings, "REPLICA_REENCRYPTION_MEMO_TTL", 60.0),
+        )
+
+    return _recent
+
+
+def _reset(*, setting, **kwargs):
+    global _recent
+    if setting in ("REPLICA_REENCRYPTION_MEMO_SIZE", "REPLICA_REENCRYPTION_MEMO_TTL"):
+        _recent = None
+
+
+setting_changed.connect(_reset)
+
+
+def unchanged_q(pk, expected: dict) -> Q:
+    """
+    Matches row `pk` only while each of the `expected` columns still holds the
+    value it was read with.
+    """
+    conditions = {}
+    for column, value in expected.items():
+        if value is None:
+            conditions[f"{column}__isnull"] = True
+        else:
+            conditions[column] = value
+    return Q(pk=pk, **conditions)
+
+
+def _unchanged(obj, using, expected: dict):
+    return type(obj)._base_manager.using(using).filter(unchanged_q(obj.pk, expected))
+
+
+def read_from_replica(obj) -> bool:
+    """
+    Whether `obj` was loaded from a database other than the one it's written to.
+    """
+    return obj._state.db not in (None, router.db_for_write(type(obj), instance=obj))
+
+
+def _conditional_update(obj, columns: list[str], expected: dict):
+    using = router.db_for_write(type(obj), instance=obj)
+    values = {column: getattr(obj, column) for column in columns}
+    return _unchanged(obj, using, expected), values
+
+
+def _written(labels, updated: int) -> bool:
+    if updated:
+        return True
+    instrumentation = get_instrumentation()
+    for label in labels:
+        instrumentation.increment("reencryption_skipped", label)
+    return False
+
+
+def save_reencrypted(obj, columns: list[str], expected: dict, labels=()) -> bool:
+    """
+    Writes the re-encrypted `columns` of `obj` with a single UPDATE on the database
+    writes go to, conditional on the `expected` columns (last re-encryption times
+    and, where comparable, ciphertexts) still holding the values that were read.
+
+    If another process re-encrypted or changed the row first, nothing is written,
+    so concurrent readers of a stale row don't overwrite each other and a lagging
+    replica (see `routers.ReplicaRouter`) can't roll a row back. The field `labels`
+    are then counted as `reencryption_skipped` and False is returned.
+    """
+    queryset, values = _conditional_update(obj, columns, expected)
+    updated = queryset.update(**values)
+    return _written(labels, updated)
+
+
+async def asave_reencrypted(obj, columns: list[str], expected: dict, labels=()):
+    queryset, values = _conditional_update(obj, columns, expected)
+    updated = await queryset.aupdate(**values)
+    return _written(labels, updated)
+
+
+class PendingWrites:
+    """
+    Re-encryption writes collected per model instance, so that reading several
+    stale `EncryptedField`s of one row costs one UPDATE of all their columns
+    instead of one per field.
+    """
+
+    def __init__(self):
+        # id(instance) -> (instance, columns, expected, labels)
+        self._pending = {}
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def add(self, obj, columns: list[str], expected: dict, label: str):
+        entry = self._pending.get(id(obj))
+        if entry is None:
+            entry = self._pending[id(obj)] = (obj, set(), {}, [])
+        entry[1].update(columns)
+        # The values the row was read with, not ones set since
+        for column, value in expected.items():
+            entry[2].setdefault(column, value)
+        entry[3].append(label)
+
+    def _take(self):
+        pending = list(self._pending.values())
+        self._pending.clear()
+        return pending
+
+    def flush(self) -> int:
+        """
+        Saves every pending instance with one UPDATE of its dirty columns (see
+        `save_reencrypted`). Returns the number of instances written.
+        """
+        written = 0
+        for obj, columns, expected, labels in self._take():
+            written += save_reencrypted(obj, sorted(columns), expected, labels)
+        return written
+
+    async def aflush(self) -> int:
+        written = 0
+        for obj, columns, expected, labels in self._take():
+            written += await asave_reencrypted(obj, sorted(columns), expected, labels)
+        return written
+
+
+_pending: contextvars.ContextVar[PendingWrites | None] = contextvars.ContextVar(
+    "tink_field_pending_writes", default=None
+)
+
+
+def pending_writes() -> PendingWrites | None:
+    """
+    The `PendingWrites` of the enclosing `coalesce_reencryption()`, if any.
+    """
+    return _pending.get()
+
+
+def flush() -> int:
+    """
+    Writes the enclosing scope's pending re-encryptions now rather than when the
+    scope ends, e.g. before handing instances to code that saves them itself.
+    """
+    pending = _pending.get()
+    return 0 if pending is None else pending.flush()
+
+
+async def aflush() -> int:
+    pending = _pending.get()
+    return 0 if pending is None else await pending.aflush()
+
+
+class coalesce_reencryption:
+    """
+    Context manager (sync or async) that holds back the re-encryption writes
+    `EncryptedField` makes on reads until it exits, then writes each instance once.
+    Nested scopes join the outermost one. The writes are still made if the block
+    raises, since the re-encrypted values are valid either way.
+    """
+
+    def __init__(self):
+        self._token = None
+
+    def _enter(self):
+        if _pending.get() is None:
+            self._token = _pending.set(PendingWrites())
+
+    def _exit(self):
+        # Only the outermost scope owns the pending writes
+        if self._token is None:
+            return None
+        pending = _pending.get()
+        _pending.reset(self._token)
+        self._token = None
+        return pending
+
+    def __enter__(self):
+        self._enter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pending = self._exit()
+        if pending is None:
+            return
+        if exc_type is None:
+            pending.flush()
+            return
+        try:
+            pending.flush()
+        except Exception:
+            logger.exception("failed to write coalesced re-encryptions")
+
+    async def __aenter__(self):
+        self._enter()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pending = self._exit()
+        if pending is None:
+            return
+        if exc_type is None:
+            await pending.aflush()
+            return
+        try:
+            await pending.aflush()
+        except Exception:
+            logger.exception("failed to write coalesced re-encryptions")
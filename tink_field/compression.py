@@ -0,0 +1,117 @@
+import zlib
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+# Compressed plaintexts are framed as MAGIC + algorithm byte + compressed data,
+# and the frame is what gets encrypted, so it is covered by the AEAD tag.
+# Plaintexts without the frame (anything below the threshold, anything that didn't
+# shrink, and everything written before compression was enabled) are stored as-is,
+# except ones that happen to start with MAGIC themselves: those are framed as
+# STORED so they can't be mistaken for a frame. A STORED frame therefore always
+# holds a payload starting with MAGIC, and one that doesn't is an unframed value
+# from before STORED existed. An old unframed value that is itself byte-for-byte
+# a valid frame (MAGIC, an algorithm byte, then MAGIC again or a well-formed
+# compressed stream) can't be told apart and is read as one.
+MAGIC = b"\x00tfz"
+STORED = 0
+ZLIB = 1
+ZSTD = 2
+ALGORITHMS = {"zlib": ZLIB, "zstd": ZSTD}
+
+# Refuse to inflate a single value past this, so a crafted ciphertext can't be a
+# decompression bomb
+MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImproperlyConfigured("zstd compression requires the zstandard package")
+    return zstandard
+
+
+def algorithm() -> str | None:
+    name = getattr(settings, "TINK_FIELD_COMPRESSION", None)
+    if name is not None and name not in ALGORITHMS:
+        raise ImproperlyConfigured(f"Unknown TINK_FIELD_COMPRESSION {name}")
+    return name
+
+
+def threshold() -> int:
+    return getattr(settings, "TINK_FIELD_COMPRESSION_THRESHOLD", 1024)
+
+
+def level(name: str) -> int:
+    default = {"zlib": 6, "zstd": 3}[name]
+    return getattr(settings, "TINK_FIELD_COMPRESSION_LEVEL", None) or default
+
+
+def _stored(plaintext: bytes) -> bytes:
+    if plaintext.startswith(MAGIC):
+        return MAGIC + bytes([STORED]) + plaintext
+    return plaintext
+
+
+def compress(plaintext: bytes, name: str | None = None) -> bytes:
+    """
+    Frames and compresses `plaintext` with `name` (default: the
+    `TINK_FIELD_COMPRESSION` setting) if it is at least
+    `TINK_FIELD_COMPRESSION_THRESHOLD` bytes and compressing actually saves space.
+    Otherwise returns it unchanged, unless it starts with `MAGIC`.
+    """
+    if name is None:
+        name = algorithm()
+    if name is None or len(plaintext) < threshold():
+        return _stored(plaintext)
+
+    if name == "zlib":
+        compressed = zlib.compress(plaintext, level(name))
+    else:
+        compressed = _zstd().ZstdCompressor(level=level(name)).compress(plaintext)
+
+    framed = MAGIC + bytes([ALGORITHMS[name]]) + compressed
+    if len(framed) >= len(plaintext):
+        return _stored(plaintext)
+    return framed
+
+
+def decompress(data: bytes) -> bytes:
+    """
+    Inverse of `compress`. Anything without the compression frame is returned
+    unchanged, so this is safe to call on every decrypted value.
+    """
+    if not data.startswith(MAGIC) or len(data) <= len(MAGIC):
+        return data
+
+    kind = data[len(MAGIC)]
+    payload = data[len(MAGIC) + 1 :]
+    if kind == STORED:
+        if payload.startswith(MAGIC):
+            return payload
+        return data
+    elif kind == ZLIB:
+        decompressor = zlib.decompressobj()
+        try:
+            plaintext = decompressor.decompress(payload, MAX_DECOMPRESSED_SIZE)
+        except zlib.error:
+            # The value is authenticated, so this isn't a corrupted frame: it's a
+            # plaintext stored unframed before STORED existed
+            return data
+        if decompressor.unconsumed_tail:
+            raise ValueError("Decompressed value is too large")
+        return plaintext
+    elif kind == ZSTD:
+        zstandard = _zstd()
+        try:
+            size = zstandard.frame_content_size(payload)
+        except zstandard.ZstdError:
+            return data
+        if size > MAX_DECOMPRESSED_SIZE:
+            raise ValueError("Decompressed value is too large")
+        return zstandard.ZstdDecompressor().decompress(
+            payload, max_output_size=MAX_DECOMPRESSED_SIZE
+        )
+    # Likewise an old unframed plaintext
+    return data
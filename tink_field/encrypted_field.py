@@ -1,7 +1,81 @@
+import asyncio
 import builtins
 import base64
+import copy
+import functools
+import hashlib
+import logging
+import time
+import weakref
 from datetime import datetime, timedelta, timezone
 
+from asgiref.sync import sync_to_async
+from django.db.models import BooleanField, Case, Q, Value, When
+from django.utils import timezone as django_timezone
+
+from . import blind_index
+from .coalesce import (
+    asave_reencrypted,
+    get_recent_reencryptions,
+    pending_writes,
+    read_from_replica,
+    save_reencrypted,
+)
+from .instrumentation import get_instrumentation
+from .negative_cache import ciphertext_bytes, get_negative_cache, undecryptable
+from .rate_limit import get_reencryption_budget
+from .single_flight import get_flights
+from .write_behind import get_queue
+
+logger = logging.getLogger(__name__)
+
+
+def _now(other):
+    if other.tzinfo is not None and other.tzinfo.utcoffset(None) is not None:
+        return datetime.now(timezone.utc)
+    else:
+        return datetime.utcnow()
+
+
+def _snapshot(value):
+    # Ciphertexts and plaintexts may be mutable (JSON dicts, memoryviews from some
+    # database backends), so the plaintext cache holds copies of them.
+    match value:
+        case bytes() | str() | int() | None:
+            return value
+        case memoryview():
+            return bytes(value)
+        case _:
+            return copy.deepcopy(value)
+
+
+def _payload_size(value):
+    match value:
+        case bytes() | str() | memoryview():
+            return len(value)
+        case None:
+            return None
+        case _:
+            # JSON documents, as stored
+            return len(ciphertext_bytes(value))
+
+
+def _jitter(pk) -> float:
+    # Deterministic fraction in [0, 1) for a primary key
+    digest = hashlib.blake2b(str(pk).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") / 2**64
+
+
+class _PlaintextCache(dict):
+    # Lives in the instance `__dict__`, but pickles (and deep-copies) as empty, so
+    # plaintexts never reach cache backends or sessions along with the instance
+    def __reduce__(self):
+        return (_PlaintextCache, ())
+
+
+class DecryptionError(Exception):
+    pass
+
 
 class EncryptorInterface:
     def encrypt(self, plaintext, associated_data=b""):
@@ -10,6 +84,36 @@ class EncryptorInterface:
     def decrypt(self, ciphertext, associated_data=b""):
         raise NotImplementedError()
 
+    def may_decrypt(self, ciphertext) -> bool:
+        """
+        Cheap check, without decrypting, for whether `ciphertext` could be this
+        encryptor's output. `EncryptedField` only tries encryptors that return
+        `True`, so this must never reject a ciphertext `decrypt` would accept.
+        """
+        return True
+
+    async def amay_decrypt(self, ciphertext) -> bool:
+        """
+        Async equivalent of `may_decrypt`, for encryptors that have to load keys
+        before they can tell.
+        """
+        return self.may_decrypt(ciphertext)
+
+    def key_id(self, ciphertext) -> str | None:
+        """
+        Identifies the key `ciphertext`, which this encryptor just produced, was
+        encrypted under, for `EncryptedField.key_id_attr`. None if it can't tell.
+        """
+        return None
+
+    # Async variants run the blocking implementations on a thread by default.
+    # Encryptors that can do their I/O natively should override these.
+    async def aencrypt(self, plaintext, associated_data=b""):
+        return await asyncio.to_thread(self.encrypt, plaintext, associated_data)
+
+    async def adecrypt(self, ciphertext, associated_data=b""):
+        return await asyncio.to_thread(self.decrypt, ciphertext, associated_data)
+
 
 class DecryptedValueWrapper:
     def __init__(self, value):
@@ -35,13 +139,37 @@ class EncryptedField:
         associated_data_attr: str | None = None,
         fallback_encryptor: EncryptorInterface | None = None,
         reencryption_window: timedelta = timedelta(days=30),
+        reencryption_jitter: float = 0.0,
+        cache_plaintext: bool = True,
+        write_behind: bool = False,
+        blind_index_attr: str | None = None,
+        key_id_attr: str | None = None,
+        deferred: bool = True,
     ):
         self.encryptor = encryptor
         self.ciphertext_attr = ciphertext_attr
         self.last_reencryption_time_attr = last_reencryption_time_attr
         self.associated_data_attr = associated_data_attr
         self.fallback_encryptor = fallback_encryptor
+        if not 0 <= reencryption_jitter < 1:
+            raise Exception(
+                f"reencryption_jitter must be in [0, 1), not {reencryption_jitter}"
+            )
         self.reencryption_window = reencryption_window
+        self.reencryption_jitter = reencryption_jitter
+        # No row's window is shorter than this
+        self._shortest_window = reencryption_window * (1 - reencryption_jitter)
+        self.cache_plaintext = cache_plaintext
+        self.write_behind = write_behind
+        self.blind_index_attr = blind_index_attr
+        self.key_id_attr = key_id_attr
+        self.deferred = deferred
+        self.name = None
+        self.label = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.label = f"{owner.__name__}.{name}"
 
     def _get_associated_data(self, obj):
         associated_data = b""
@@ -60,67 +188,679 @@ class EncryptedField:
 
         return associated_data
 
+    def _observe(self, instrumentation, operation, encryptor, start, ciphertext):
+        instrumentation.observe(
+            operation,
+            self.label,
+            type(encryptor).__name__,
+            time.perf_counter() - start,
+            _payload_size(ciphertext),
+        )
+
+    def _timed_encrypt(self, encryptor, plaintext, associated_data):
+        instrumentation = get_instrumentation()
+        if not instrumentation.enabled:
+            return encryptor.encrypt(plaintext, associated_data)
+        start = time.perf_counter()
+        ciphertext = encryptor.encrypt(plaintext, associated_data)
+        self._observe(instrumentation, "encrypt", encryptor, start, ciphertext)
+        return ciphertext
+
+    def _timed_decrypt(self, encryptor, ciphertext, *associated_data):
+        instrumentation = get_instrumentation()
+        if not instrumentation.enabled:
+            return encryptor.decrypt(ciphertext, *associated_data)
+        start = time.perf_counter()
+        plaintext = encryptor.decrypt(ciphertext, *associated_data)
+        self._observe(instrumentation, "decrypt", encryptor, start, ciphertext)
+        return plaintext
+
+    async def _atimed_encrypt(self, encryptor, plaintext, associated_data):
+        instrumentation = get_instrumentation()
+        if not instrumentation.enabled:
+            return await encryptor.aencrypt(plaintext, associated_data)
+        start = time.perf_counter()
+        ciphertext = await encryptor.aencrypt(plaintext, associated_data)
+        self._observe(instrumentation, "encrypt", encryptor, start, ciphertext)
+        return ciphertext
+
+    async def _atimed_decrypt(self, encryptor, ciphertext, *associated_data):
+        instrumentation = get_instrumentation()
+        if not instrumentation.enabled:
+            return await encryptor.adecrypt(ciphertext, *associated_data)
+        start = time.perf_counter()
+        plaintext = await encryptor.adecrypt(ciphertext, *associated_data)
+        self._observe(instrumentation, "decrypt", encryptor, start, ciphertext)
+        return plaintext
+
     def _encrypt(self, obj, plaintext):
         associated_data = self._get_associated_data(obj)
-        print(f"encrypting {plaintext} with associated {associated_data}")
-        ciphertext = self.encryptor.encrypt(plaintext, associated_data)
-        return ciphertext
+        return self._timed_encrypt(self.encryptor, plaintext, associated_data)
 
     def _decrypt(self, obj, encoded_ciphertext):
         associated_data = self._get_associated_data(obj)
-        print(type(encoded_ciphertext))
+        return self.decrypt_value(encoded_ciphertext, associated_data)
+
+    def _decryptors(self, encoded_ciphertext):
+        """
+        Returns the encryptors that claim `encoded_ciphertext`, primary first. Legacy
+        rows go straight to the fallback instead of failing the primary first.
+        """
+        decryptors = []
+        if self.encryptor.may_decrypt(encoded_ciphertext):
+            decryptors.append(self.encryptor)
+        if self.fallback_encryptor is not None and self.fallback_encryptor.may_decrypt(
+            encoded_ciphertext
+        ):
+            decryptors.append(self.fallback_encryptor)
+        return decryptors
+
+    async def _adecryptors(self, encoded_ciphertext):
+        decryptors = []
+        if await self.encryptor.amay_decrypt(encoded_ciphertext):
+            decryptors.append(self.encryptor)
+        if self.fallback_encryptor is not None and (
+            await self.fallback_encryptor.amay_decrypt(encoded_ciphertext)
+        ):
+            decryptors.append(self.fallback_encryptor)
+        return decryptors
+
+    def _check_negative_cache(self, instrumentation, encoded_ciphertext, ad):
+        negative_cache = get_negative_cache()
+        # Skip hashing in the common case where nothing has ever failed
+        if len(negative_cache) and (
+            negative_cache.key(self.label, encoded_ciphertext, ad) in negative_cache
+        ):
+            instrumentation.increment("decrypt_failure_cached", self.label)
+            raise DecryptionError(f"{self.label}: ciphertext previously failed")
+
+    def _decrypted(self, instrumentation, encryptor):
+        primary = encryptor is self.encryptor
+        event = "decrypt_primary" if primary else "decrypt_fallback"
+        instrumentation.increment(event, self.label, type(encryptor).__name__)
+
+    def _failed(self, instrumentation, encoded_ciphertext, ad, error):
+        instrumentation.increment("decrypt_failure", self.label)
+        if error is None or undecryptable(error):
+            negative_cache = get_negative_cache()
+            negative_cache.add(negative_cache.key(self.label, encoded_ciphertext, ad))
+        if error is None:
+            raise DecryptionError(f"{self.label}: no encryptor claims the ciphertext")
+        raise error
+
+    def decrypt_value(self, encoded_ciphertext, associated_data: bytes):
+        """
+        Decrypts a raw column value without touching a model instance. Only the
+        encryptors whose `may_decrypt` accepts the ciphertext are tried, primary
+        first; values nothing could decrypt are remembered in the negative cache.
+        Failures that don't implicate the ciphertext, like a KMS outage, aren't.
+        """
+        instrumentation = get_instrumentation()
+        self._check_negative_cache(instrumentation, encoded_ciphertext, associated_data)
+
+        error = None
+        for encryptor in self._decryptors(encoded_ciphertext):
+            # The fallback encryptor doesn't get associated data
+            args = (associated_data,) if encryptor is self.encryptor else ()
+            try:
+                plaintext = self._timed_decrypt(encryptor, encoded_ciphertext, *args)
+            except Exception as e:
+                logger.debug(
+                    "%s: %s failed to decrypt: %s",
+                    self.label,
+                    type(encryptor).__name__,
+                    e,
+                )
+                # A remote error is the one to report, whatever else failed
+                if error is None or undecryptable(error):
+                    error = e
+                continue
+            self._decrypted(instrumentation, encryptor)
+            return plaintext
+
+        self._failed(instrumentation, encoded_ciphertext, associated_data, error)
+
+    async def adecrypt_value(self, encoded_ciphertext, associated_data: bytes):
+        """
+        Async equivalent of `decrypt_value`.
+        """
+        instrumentation = get_instrumentation()
+        self._check_negative_cache(instrumentation, encoded_ciphertext, associated_data)
+
+        error = None
+        for encryptor in await self._adecryptors(encoded_ciphertext):
+            args = (associated_data,) if encryptor is self.encryptor else ()
+            try:
+                plaintext = await self._atimed_decrypt(
+                    encryptor, encoded_ciphertext, *args
+                )
+            except Exception as e:
+                logger.debug(
+                    "%s: %s failed to decrypt: %s",
+                    self.label,
+                    type(encryptor).__name__,
+                    e,
+                )
+                # A remote error is the one to report, whatever else failed
+                if error is None or undecryptable(error):
+                    error = e
+                continue
+            self._decrypted(instrumentation, encryptor)
+            return plaintext
+
+        self._failed(instrumentation, encoded_ciphertext, associated_data, error)
+
+    def _cache(self, obj):
+        cache = obj.__dict__.get("_encrypted_field_cache")
+        if cache is None:
+            cache = obj.__dict__["_encrypted_field_cache"] = _PlaintextCache()
+        return cache
+
+    async def _adecrypt(self, obj, encoded_ciphertext):
+        associated_data = self._get_associated_data(obj)
+        return await self.adecrypt_value(encoded_ciphertext, associated_data)
+
+    async def _acached_decrypt(self, obj, encoded_ciphertext):
+        if not self.cache_plaintext:
+            return await self._adecrypt(obj, encoded_ciphertext)
+
+        associated_data = self._get_associated_data(obj)
+        cached = self._cache(obj).get(self.name)
+        if (
+            cached is not None
+            and cached[0] == encoded_ciphertext
+            and cached[1] == associated_data
+        ):
+            return _snapshot(cached[2])
+
+        plaintext = await self._adecrypt(obj, encoded_ciphertext)
+        self._remember(obj, encoded_ciphertext, associated_data, plaintext)
+        return plaintext
+
+    def prime_cache(self, obj, encoded_ciphertext, associated_data, plaintext):
+        """
+        Records an externally decrypted plaintext so that the next read of this field
+        on `obj` is served from the cache. Does nothing if caching is disabled.
+        """
+        if self.cache_plaintext:
+            self._remember(obj, encoded_ciphertext, associated_data, plaintext)
+
+    def _remember(self, obj, encoded_ciphertext, associated_data, plaintext):
+        self._cache(obj)[self.name] = (
+            _snapshot(encoded_ciphertext),
+            associated_data,
+            _snapshot(plaintext),
+        )
+
+    def _cached_decrypt(self, obj, encoded_ciphertext):
+        """
+        Like `_decrypt`, but memoizes the plaintext on `obj`. The cache entry is only
+        used while the ciphertext and associated data are unchanged, so assigning to
+        the ciphertext column (or to this field) invalidates it.
+        """
+        if not self.cache_plaintext:
+            return self._decrypt(obj, encoded_ciphertext)
+
+        associated_data = self._get_associated_data(obj)
+        cached = self._cache(obj).get(self.name)
+        if (
+            cached is not None
+            and cached[0] == encoded_ciphertext
+            and cached[1] == associated_data
+        ):
+            return _snapshot(cached[2])
+
+        plaintext = self._decrypt(obj, encoded_ciphertext)
+        self._remember(obj, encoded_ciphertext, associated_data, plaintext)
+        return plaintext
+
+    def reencryption_window_for(self, obj) -> timedelta:
+        """
+        `reencryption_window` shortened by up to `reencryption_jitter` of itself, by
+        an amount that depends only on `obj`'s primary key. Rows written together
+        then come due over a spread of times instead of all at once, while every
+        encrypted field of one row still comes due together.
+        """
+        if not self.reencryption_jitter or obj.pk is None:
+            return self.reencryption_window
+        return self.reencryption_window * (
+            1 - self.reencryption_jitter * _jitter(obj.pk)
+        )
+
+    def needs_reencryption(self, obj) -> bool:
+        last_reencryption_time = getattr(obj, self.last_reencryption_time_attr, None)
+        if last_reencryption_time is None:
+            return True
+        age = _now(last_reencryption_time) - last_reencryption_time
+        # Skip hashing the primary key for values that are fresh under any jitter
+        if age <= self._shortest_window:
+            return False
+        return age > self.reencryption_window_for(obj)
+
+    def stale_q(self, now: datetime | None = None) -> Q:
+        """
+        SQL equivalent of `needs_reencryption`: matches rows whose last re-encryption
+        time is unset or older than `reencryption_window`. With
+        `reencryption_jitter`, rows older than the shortest jittered window match,
+        which may include some that `needs_reencryption` still considers fresh.
+        """
+        if now is None:
+            now = django_timezone.now()
+        time_attr = self.last_reencryption_time_attr
+        return Q(**{f"{time_attr}__isnull": True}) | Q(
+            **{f"{time_attr}__lt": now - self._shortest_window}
+        )
+
+    def needs_reencryption_expression(self, now: datetime | None = None) -> Case:
+        """
+        Boolean expression for annotating querysets with `stale_q`.
+        """
+        return Case(
+            When(self.stale_q(now), then=Value(True)),
+            default=Value(False),
+            output_field=BooleanField(),
+        )
+
+    def reencrypt(self, obj) -> bool:
+        """
+        Decrypts and re-encrypts `obj`'s value in memory without saving it. Returns
+        `False` if there was nothing to re-encrypt. Decryption errors are raised.
+        """
+        encoded_ciphertext = getattr(obj, self.ciphertext_attr, None)
+        if encoded_ciphertext is None:
+            return False
+
+        plaintext = self._cached_decrypt(obj, encoded_ciphertext)
+        self.__set__(obj, plaintext)
+        get_instrumentation().increment("reencryption", self.label)
+        return True
+
+    @property
+    def reencryption_columns(self) -> list[str]:
+        """
+        Columns written by `__set__`, and so by re-encryption.
+        """
+        columns = [self.ciphertext_attr, self.last_reencryption_time_attr]
+        if self.blind_index_attr is not None:
+            columns.append(self.blind_index_attr)
+        if self.key_id_attr is not None:
+            columns.append(self.key_id_attr)
+        return columns
+
+    @property
+    def deferred_columns(self) -> list[str]:
+        """
+        Columns `EncryptedManager` leaves out of queries until this field is read,
+        if `deferred` is set.
+        """
+        if not self.deferred:
+            return []
+        return self.reencryption_columns
+
+    def blind_index(self, value) -> str:
+        """
+        The value `blind_index_attr` holds for plaintext `value`; see `blind_index`.
+        """
+        return blind_index.compute(self.label, value)
+
+    def _set_blind_index(self, obj, value):
+        if self.blind_index_attr is None:
+            return
+        # Without a key the index is left empty; `rebuild_blind_index` can fill it
+        # in once one is configured
+        index = self.blind_index(value) if blind_index.has_key() else None
+        setattr(obj, self.blind_index_attr, index)
+
+    def _set_key_id(self, obj, ciphertext):
+        if self.key_id_attr is not None:
+            setattr(obj, self.key_id_attr, self.encryptor.key_id(ciphertext))
+
+    def _clear(self, obj, error) -> bool:
+        # After a decryption failure. Returns whether the columns were nulled out
+        # and need writing back; a column that can't be NULL leaves them all as
+        # they are
+        if not all(obj._meta.get_field(c).null for c in self.reencryption_columns):
+            logger.warning(
+                "%s: failed to decrypt; leaving value in place: %s", self.label, error
+            )
+            return False
+        logger.warning(
+            "%s: failed to decrypt; nulling out value: %s", self.label, error
+        )
+        for column in self.reencryption_columns:
+            setattr(obj, column, None)
+        return True
+
+    def _expected(self, obj) -> dict:
+        # What the re-encryption write checks the row still holds: the last
+        # re-encryption time, plus the ciphertext itself where it can be compared
+        # in SQL, since rows rewritten by legacy code keep a NULL time
+        time_attr = self.last_reencryption_time_attr
+        expected = {time_attr: getattr(obj, time_attr, None)}
+        ciphertext = getattr(obj, self.ciphertext_attr, None)
+        match ciphertext:
+            case str() | bytes():
+                expected[self.ciphertext_attr] = ciphertext
+            case bytearray() | memoryview():
+                expected[self.ciphertext_attr] = bytes(ciphertext)
+        return expected
+
+    def _should_reencrypt(self, obj) -> bool:
+        if not self.needs_reencryption(obj):
+            return False
+        recent = get_recent_reencryptions()
+        # Skip the lookup in the common case of no replica reads
+        if len(recent) and recent.seen(
+            obj,
+            self.last_reencryption_time_attr,
+            getattr(obj, self.last_reencryption_time_attr, None),
+            getattr(obj, self.ciphertext_attr, None),
+        ):
+            get_instrumentation().increment("reencryption_replica_lag", self.label)
+            return False
+        return True
+
+    def _remember_replica_read(self, obj, expected, ciphertext):
+        # A replica that hasn't caught up keeps returning the row as it was read,
+        # and `_should_reencrypt` leaves it alone until then
+        if read_from_replica(obj):
+            time_attr = self.last_reencryption_time_attr
+            get_recent_reencryptions().add(
+                obj, {time_attr: expected[time_attr]}, ciphertext
+            )
+
+    def _save_reencrypted(self, obj, expected):
+        update_fields = self.reencryption_columns
+        pending = pending_writes()
+        if obj.pk is None:
+            # Not in the database yet; the caller's save writes the new values
+            return
+        elif self.write_behind:
+            get_queue().enqueue(obj, update_fields, expected)
+        elif pending is not None:
+            pending.add(obj, update_fields, expected, self.label)
+        else:
+            save_reencrypted(obj, update_fields, expected, [self.label])
+
+    def _adopt(self, obj, plaintext, values):
+        # Another reader of the same row re-encrypted it; take its result rather
+        # than encrypting and writing again
+        if values is None:
+            # It failed, deferred or is taking too long; a later read retries
+            return
+        get_instrumentation().increment("reencryption_skipped", self.label)
+        for column, value in values.items():
+            setattr(obj, column, value)
+        if self.cache_plaintext:
+            self._remember(
+                obj,
+                values[self.ciphertext_attr],
+                self._get_associated_data(obj),
+                plaintext,
+            )
+
+    def _within_budget(self) -> bool:
+        if get_reencryption_budget().acquire():
+            return True
+        # The row stays stale and is re-encrypted by a later read, once there's
+        # budget again
+        get_instrumentation().increment("reencryption_deferred", self.label)
+        return False
+
+    def _rotate(self, obj, plaintext):
+        """
+        Re-encrypts a stale value that was just read and writes it back. Readers of
+        the same row in this process share one re-encryption (see
+        `single_flight.Flights`), and each re-encryption takes a token from
+        `rate_limit.get_reencryption_budget()`; without one, the plaintext is
+        returned and the row is left for a later read.
+        """
+        if obj.pk is None:
+            # Not in the database yet, so nothing to share or write
+            self.__set__(obj, plaintext)
+            get_instrumentation().increment("reencryption", self.label)
+            return
+
+        expected = self._expected(obj)
+        flights = get_flights()
+        key = (obj._meta.label, obj.pk, self.name, *expected.values())
+        flight, leader = flights.join(key)
+        if not leader:
+            self._adopt(obj, plaintext, flight.wait(flights.timeout))
+            return
+        if not self._within_budget():
+            flights.land(key, flight, None)
+            return
+
+        values = None
+        ciphertext = getattr(obj, self.ciphertext_attr, None)
         try:
-            return self.encryptor.decrypt(encoded_ciphertext, associated_data)
-        except Exception as e:
-            print(f"failed to decrypt: {e}")
-            if self.fallback_encryptor is None:
-                raise
-            else:
-                return self.fallback_encryptor.decrypt(encoded_ciphertext)
+            self.__set__(obj, plaintext)
+            get_instrumentation().increment("reencryption", self.label)
+            values = {c: getattr(obj, c) for c in self.reencryption_columns}
+            self._save_reencrypted(obj, expected)
+            self._remember_replica_read(obj, expected, ciphertext)
+        finally:
+            flights.land(key, flight, values)
 
     def __get__(self, obj, objtype=None):
         encoded_ciphertext = getattr(obj, self.ciphertext_attr, None)
-        print(f"encoded ciphertext |||{encoded_ciphertext}|||")
-        last_reencryption_time = getattr(obj, self.last_reencryption_time_attr, None)
-
         if encoded_ciphertext is None:
             return None
 
         try:
-            plaintext = self._decrypt(obj, encoded_ciphertext)
+            plaintext = self._cached_decrypt(obj, encoded_ciphertext)
         except Exception as e:
-            print("failed to decrypt; nulling out value", e)
-            setattr(obj, self.ciphertext_attr, None)
-            setattr(obj, self.last_reencryption_time_attr, None)
-            obj.save()
+            if not undecryptable(e) and not isinstance(e, DecryptionError):
+                # The value may well be fine; don't throw it away
+                raise
+            expected = self._expected(obj)
+            if self._clear(obj, e):
+                self._save_reencrypted(obj, expected)
             return
 
-        print(f"got plaintext {plaintext}")
+        if self._should_reencrypt(obj):
+            self._rotate(obj, plaintext)
 
-        def now(other):
-            if other.tzinfo is not None and other.tzinfo.utcoffset(None) is not None:
-                return datetime.now(timezone.utc)
-            else:
-                return datetime.utcnow()
+        return DecryptedValueWrapper(plaintext)
 
-        if (
-            last_reencryption_time is None
-            or now(last_reencryption_time) - last_reencryption_time
-            > self.reencryption_window
-        ):
-            if last_reencryption_time is not None:
-                print(now(last_reencryption_time))
-            print("trying to reencrypt")
-            print(f"encoded {encoded_ciphertext} and plaintext {plaintext}")
-            self.__set__(obj, plaintext)
-            obj.save(
-                update_fields=[self.ciphertext_attr, self.last_reencryption_time_attr]
-            )
+    async def _asave_reencrypted(self, obj, expected):
+        update_fields = self.reencryption_columns
+        pending = pending_writes()
+        if obj.pk is None:
+            return
+        elif self.write_behind:
+            get_queue().enqueue(obj, update_fields, expected)
+        elif pending is not None:
+            pending.add(obj, update_fields, expected, self.label)
+        else:
+            await asave_reencrypted(obj, update_fields, expected, [self.label])
+
+    async def _arotate(self, obj, plaintext):
+        if obj.pk is None:
+            await self.aset(obj, plaintext)
+            get_instrumentation().increment("reencryption", self.label)
+            return
+
+        expected = self._expected(obj)
+        flights = get_flights()
+        key = (obj._meta.label, obj.pk, self.name, *expected.values())
+        flight, leader = flights.join(key)
+        if not leader:
+            self._adopt(obj, plaintext, await flight.await_(flights.timeout))
+            return
+        if not self._within_budget():
+            flights.land(key, flight, None)
+            return
+
+        values = None
+        ciphertext = getattr(obj, self.ciphertext_attr, None)
+        try:
+            await self.aset(obj, plaintext)
+            get_instrumentation().increment("reencryption", self.label)
+            values = {c: getattr(obj, c) for c in self.reencryption_columns}
+            await self._asave_reencrypted(obj, expected)
+            self._remember_replica_read(obj, expected, ciphertext)
+        finally:
+            flights.land(key, flight, values)
+
+    async def aget(self, obj):
+        """
+        Async equivalent of reading the field: encryptor work runs off the event
+        loop and any re-encryption is saved with the async ORM.
+        """
+        if self.ciphertext_attr not in obj.__dict__ and obj.pk is not None:
+            # Deferred; loading it would be a blocking query
+            await sync_to_async(load_deferred_columns)(obj)
+        encoded_ciphertext = getattr(obj, self.ciphertext_attr, None)
+        if encoded_ciphertext is None:
+            return None
+
+        try:
+            plaintext = await self._acached_decrypt(obj, encoded_ciphertext)
+        except Exception as e:
+            if not undecryptable(e) and not isinstance(e, DecryptionError):
+                # The value may well be fine; don't throw it away
+                raise
+            expected = self._expected(obj)
+            if self._clear(obj, e):
+                await self._asave_reencrypted(obj, expected)
+            return
+
+        if self._should_reencrypt(obj):
+            await self._arotate(obj, plaintext)
 
         return DecryptedValueWrapper(plaintext)
 
+    async def aset(self, obj, value):
+        """
+        Async equivalent of assigning to the field.
+        """
+        associated_data = self._get_associated_data(obj)
+        new_ciphertext = await self._atimed_encrypt(
+            self.encryptor, value, associated_data
+        )
+        setattr(obj, self.ciphertext_attr, new_ciphertext)
+        setattr(obj, self.last_reencryption_time_attr, django_timezone.now())
+        self._set_blind_index(obj, value)
+        self._set_key_id(obj, new_ciphertext)
+        if self.cache_plaintext:
+            self._remember(obj, new_ciphertext, associated_data, value)
+
     def __set__(self, obj, value):
         new_ciphertext = self._encrypt(obj, value)
-        print(f"encryption produced {new_ciphertext}")
         setattr(obj, self.ciphertext_attr, new_ciphertext)
-        setattr(obj, self.last_reencryption_time_attr, datetime.now())
+        setattr(obj, self.last_reencryption_time_attr, django_timezone.now())
+        self._set_blind_index(obj, value)
+        self._set_key_id(obj, new_ciphertext)
+        if self.cache_plaintext:
+            self._remember(obj, new_ciphertext, self._get_associated_data(obj), value)
+
+
+class EncryptedFieldsMixin:
+    """
+    Model mixin with awaitable accessors for `EncryptedField`s, for async views:
+    `await secret.aget("plaintext_from_b64")`.
+    """
+
+    async def aget(self, name: str):
+        return await encrypted_fields(type(self))[name].aget(self)
+
+    async def aset(self, name: str, value):
+        await encrypted_fields(type(self))[name].aset(self, value)
+
+    def refresh_from_db(self, using=None, fields=None, from_queryset=None):
+        # Django loads a deferred column by calling this with just that column.
+        # For encrypted columns, load every deferred encrypted column of every row
+        # fetched alongside this one instead, in one query.
+        if (
+            fields is not None
+            and from_queryset is None
+            and set(fields) <= set(deferred_columns(type(self)))
+        ):
+            load_deferred_columns(self, using)
+            if all(name in self.__dict__ for name in fields):
+                return
+        super().refresh_from_db(using, fields, from_queryset)
+
+
+def encrypted_fields(model) -> dict[str, EncryptedField]:
+    """
+    Returns every `EncryptedField` declared on `model` (or its parents) by name.
+    """
+    fields = {}
+    for klass in reversed(model.__mro__):
+        for name, value in vars(klass).items():
+            if isinstance(value, EncryptedField):
+                fields[name] = value
+    return fields
+
+
+@functools.cache
+def deferred_columns(model) -> tuple[str, ...]:
+    """
+    Every column `EncryptedManager` defers for `model`'s `EncryptedField`s.
+    """
+    columns = []
+    for f in encrypted_fields(model).values():
+        columns.extend(c for c in f.deferred_columns if c not in columns)
+    return tuple(columns)
+
+
+# Upper bound on primary keys in one `pk__in` query
+_LOAD_BATCH_SIZE = 1000
+
+
+class _Peers(list):
+    # Weak references to the rows fetched together, kept in each instance's
+    # `__dict__`. Weak references can't be pickled, and the peers wouldn't survive
+    # the round trip anyway, so they pickle (and deep-copy) as empty
+    def __reduce__(self):
+        return (_Peers, ())
+
+
+def attach_peers(instances):
+    """
+    Records that `instances` were fetched together, so that the first deferred
+    encrypted column read on any of them loads the columns for all of them.
+    """
+    if len(instances) < 2:
+        return
+    peers = _Peers(weakref.ref(obj) for obj in instances)
+    for obj in instances:
+        obj.__dict__["_encrypted_peers"] = peers
+
+
+def load_deferred_columns(obj, using=None):
+    """
+    Loads every deferred encrypted column of `obj` and of the rows fetched with it
+    (see `attach_peers`) with one query per `_LOAD_BATCH_SIZE` rows.
+    """
+    model = type(obj)
+    columns = deferred_columns(model)
+    peers = [ref() for ref in obj.__dict__.get("_encrypted_peers", ())]
+    peers = [peer for peer in peers if peer is not None] or [obj]
+    if not any(peer is obj for peer in peers):
+        peers.append(obj)
+
+    db = using or obj._state.db
+    pending = {}
+    for peer in peers:
+        if peer.pk is None or peer._state.db != db:
+            continue
+        missing = [c for c in columns if c not in peer.__dict__]
+        if missing:
+            pending.setdefault(peer.pk, []).append((peer, missing))
+    if not pending:
+        return
+
+    load = sorted({c for entries in pending.values() for _, m in entries for c in m})
+    manager = model._base_manager.db_manager(db)
+    pks = list(pending)
+    for start in range(0, len(pks), _LOAD_BATCH_SIZE):
+        batch = pks[start : start + _LOAD_BATCH_SIZE]
+        for pk, *values in manager.filter(pk__in=batch).values_list("pk", *load):
+            row = dict(zip(load, values))
+            for peer, missing in pending[pk]:
+                for column in missing:
+                    peer.__dict__[column] = row[column]
@@ -0,0 +1,420 @@
+import asyncio
+import struct
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+import tink
+from tink import aead
+from tink import core
+from tink.proto import tink_pb2
+
+# Same limit tink's `KmsEnvelopeAead` enforces
+_MAX_ENCRYPTED_DEK_LEN = 4096
+_DEK_LEN_BYTES = 4
+
+
+async def _remote_call(remote, method, *args):
+    # Remote AEADs that know how to do async I/O (`GcpKmsAead`, `LocalKmsAead`)
+    # expose `aencrypt`/`adecrypt`; anything else runs on a thread.
+    async_method = getattr(remote, f"a{method}", None)
+    if async_method is not None:
+        return await async_method(*args)
+    return await asyncio.to_thread(getattr(remote, method), *args)
+
+
+def plausible_envelope(header: bytes, length: int) -> bool:
+    """
+    Cheap check for whether a ciphertext of `length` bytes starting with `header`
+    is shaped like envelope output: a sane wrapped DEK length followed by at least
+    that many bytes plus a payload.
+    """
+    if length <= _DEK_LEN_BYTES:
+        return False
+    dek_len = struct.unpack(">I", header[:_DEK_LEN_BYTES])[0]
+    return 0 < dek_len <= _MAX_ENCRYPTED_DEK_LEN and (dek_len < length - _DEK_LEN_BYTES)
+
+
+class CachingKmsEnvelopeAead(aead.Aead):
+    """
+    Envelope encryption compatible with tink's `KmsEnvelopeAead` that caches data
+    encryption keys (DEKs) to avoid a remote KMS call on every operation.
+
+    The ciphertext format is identical to `KmsEnvelopeAead` (4-byte big endian
+    length of the wrapped DEK, the wrapped DEK, then the AEAD payload), so either
+    implementation can decrypt the other's output.
+
+    - encryption reuses one DEK, and so one wrapped DEK, for up to `max_uses`
+      encryptions or `ttl` seconds, whichever comes first
+    - decryption keeps up to `cache_size` unwrapped DEKs in an LRU keyed by the
+      wrapped DEK, each valid for `ttl` seconds, so repeated decrypts of ciphertexts
+      sharing a wrapped DEK only unwrap it once
+    """
+
+    def __init__(
+        self,
+        key_template: tink_pb2.KeyTemplate,
+        remote: aead.Aead,
+        *,
+        max_uses: int = 1000,
+        ttl: float = 300.0,
+        cache_size: int = 1000,
+    ):
+        # Fails early for unsupported templates, like `KmsEnvelopeAead` does
+        aead.KmsEnvelopeAead(key_template, remote)
+
+        self.key_template = key_template
+        self.remote_aead = remote
+        self.max_uses = max_uses
+        self.ttl = ttl
+        self.cache_size = cache_size
+
+        self.hits = 0
+        self.misses = 0
+        self.remote_calls = 0
+
+        self._lock = threading.Lock()
+        # Held across the KMS call that wraps a new encryption DEK, so concurrent
+        # misses share one call without blocking decryption cache hits on `_lock`
+        self._wrap_lock = threading.Lock()
+        # (encrypted DEK, DEK primitive, expiry, uses, KMS key version)
+        self._current = None
+        # encrypted DEK -> (DEK primitive, expiry, KMS key version that wrapped it)
+        self._deks = OrderedDict()
+
+    def cache_info(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "remote_calls": self.remote_calls,
+                "cached_deks": len(self._deks),
+            }
+
+    def _remember(self, encrypted_dek, dek_aead, expiry, version=None):
+        self._deks[encrypted_dek] = (dek_aead, expiry, version)
+        self._deks.move_to_end(encrypted_dek)
+        while len(self._deks) > self.cache_size:
+            self._deks.popitem(last=False)
+
+    def _dek_primitive(self, dek_bytes):
+        dek = tink_pb2.KeyData(
+            type_url=self.key_template.type_url,
+            value=dek_bytes,
+            key_material_type=tink_pb2.KeyData.SYMMETRIC,
+        )
+        return core.Registry.primitive(dek, aead.Aead)
+
+    def _wrap_new_dek(self):
+        # Returns (DEK, encrypted DEK, KMS key version or None)
+        dek = core.Registry.new_key_data(self.key_template)
+        encrypt_versioned = getattr(self.remote_aead, "encrypt_versioned", None)
+        if encrypt_versioned is not None:
+            return dek, *encrypt_versioned(dek.value, b"")
+        return dek, self.remote_aead.encrypt(dek.value, b""), None
+
+    async def _awrap_new_dek(self):
+        dek = core.Registry.new_key_data(self.key_template)
+        if hasattr(self.remote_aead, "encrypt_versioned"):
+            return dek, *await _remote_call(
+                self.remote_aead, "encrypt_versioned", dek.value, b""
+            )
+        encrypted_dek = await _remote_call(self.remote_aead, "encrypt", dek.value, b"")
+        return dek, encrypted_dek, None
+
+    def _take_current(self, now):
+        # Must hold `_lock`. Returns the cached encryption DEK, if still usable.
+        current = self._current
+        if current is None or current[2] <= now or current[3] >= self.max_uses:
+            return None
+        self.hits += 1
+        current[3] += 1
+        return current[0], current[1]
+
+    def _install_current(self, now, dek, encrypted_dek, version):
+        # Must hold `_lock`
+        if len(encrypted_dek) > _MAX_ENCRYPTED_DEK_LEN:
+            raise tink.TinkError("length of encrypted DEK too large")
+        dek_aead = core.Registry.primitive(dek, aead.Aead)
+        self.misses += 1
+        self.remote_calls += 1
+        self._current = [encrypted_dek, dek_aead, now + self.ttl, 1, version]
+        self._remember(encrypted_dek, dek_aead, now + self.ttl, version)
+        return encrypted_dek, dek_aead
+
+    def _encryption_dek(self):
+        now = time.monotonic()
+        with self._lock:
+            current = self._take_current(now)
+        if current is not None:
+            return current
+        with self._wrap_lock:
+            # Another thread may have wrapped one while this one waited
+            with self._lock:
+                current = self._take_current(now)
+            if current is None:
+                wrapped = self._wrap_new_dek()
+                with self._lock:
+                    current = self._install_current(now, *wrapped)
+        return current
+
+    async def _aencryption_dek(self):
+        now = time.monotonic()
+        with self._lock:
+            current = self._take_current(now)
+        if current is None:
+            # Can't hold a thread lock across the KMS call here; concurrent misses
+            # may each wrap a DEK, and the last one becomes current.
+            wrapped = await self._awrap_new_dek()
+            with self._lock:
+                current = self._install_current(now, *wrapped)
+        return current
+
+    def _cached_decryption_dek(self, encrypted_dek, now):
+        with self._lock:
+            cached = self._deks.get(encrypted_dek)
+            if cached is not None and cached[1] > now:
+                self.hits += 1
+                self._deks.move_to_end(encrypted_dek)
+                return cached[0]
+            self.misses += 1
+
+    def _install_decryption_dek(self, encrypted_dek, dek_bytes, now):
+        dek_aead = self._dek_primitive(dek_bytes)
+        with self._lock:
+            self.remote_calls += 1
+            self._remember(encrypted_dek, dek_aead, now + self.ttl)
+        return dek_aead
+
+    def _decryption_dek(self, encrypted_dek):
+        now = time.monotonic()
+        dek_aead = self._cached_decryption_dek(encrypted_dek, now)
+        if dek_aead is None:
+            # Unwrap outside the lock so a slow KMS call doesn't block cache hits
+            dek_bytes = self.remote_aead.decrypt(encrypted_dek, b"")
+            dek_aead = self._install_decryption_dek(encrypted_dek, dek_bytes, now)
+        return dek_aead
+
+    async def _adecryption_dek(self, encrypted_dek):
+        now = time.monotonic()
+        dek_aead = self._cached_decryption_dek(encrypted_dek, now)
+        if dek_aead is None:
+            dek_bytes = await _remote_call(
+                self.remote_aead, "decrypt", encrypted_dek, b""
+            )
+            dek_aead = self._install_decryption_dek(encrypted_dek, dek_bytes, now)
+        return dek_aead
+
+    def key_version(self, ciphertext: bytes) -> str | None:
+        """
+        Name of the KMS key version that wrapped `ciphertext`'s DEK. Only known for
+        DEKs this instance wrapped: the current encryption DEK, e.g. right after
+        `encrypt`, or an earlier one still in the decryption cache. KMS doesn't say
+        which version it used to unwrap one.
+        """
+        try:
+            encrypted_dek, _ = self.split(ciphertext)
+        except tink.TinkError:
+            return None
+        with self._lock:
+            # The current DEK's version is kept with it, since other DEKs
+            # unwrapped meanwhile can push it out of the decryption cache
+            current = self._current
+            if current is not None and current[0] == encrypted_dek:
+                return current[4]
+            cached = self._deks.get(encrypted_dek)
+        return None if cached is None else cached[2]
+
+    @staticmethod
+    def split(ciphertext: bytes) -> tuple[bytes, bytes]:
+        """
+        Splits an envelope ciphertext into (wrapped DEK, AEAD payload).
+        """
+        if len(ciphertext) < _DEK_LEN_BYTES:
+            raise tink.TinkError("ciphertext too short")
+        dek_len = struct.unpack(">I", ciphertext[:_DEK_LEN_BYTES])[0]
+        if dek_len > _MAX_ENCRYPTED_DEK_LEN or dek_len > (
+            len(ciphertext) - _DEK_LEN_BYTES
+        ):
+            raise tink.TinkError("length of encrypted DEK too large")
+        end = _DEK_LEN_BYTES + dek_len
+        return ciphertext[_DEK_LEN_BYTES:end], ciphertext[end:]
+
+    def encrypt(self, plaintext: bytes, associated_data: bytes) -> bytes:
+        encrypted_dek, dek_aead = self._encryption_dek()
+        ciphertext = dek_aead.encrypt(plaintext, associated_data)
+        return struct.pack(">I", len(encrypted_dek)) + encrypted_dek + ciphertext
+
+    def decrypt(self, ciphertext: bytes, associated_data: bytes) -> bytes:
+        encrypted_dek, payload = self.split(ciphertext)
+        return self._decryption_dek(encrypted_dek).decrypt(payload, associated_data)
+
+    async def aencrypt(self, plaintext: bytes, associated_data: bytes) -> bytes:
+        encrypted_dek, dek_aead = await self._aencryption_dek()
+        ciphertext = await asyncio.to_thread(
+            dek_aead.encrypt, plaintext, associated_data
+        )
+        return struct.pack(">I", len(encrypted_dek)) + encrypted_dek + ciphertext
+
+    async def adecrypt(self, ciphertext: bytes, associated_data: bytes) -> bytes:
+        encrypted_dek, payload = self.split(ciphertext)
+        dek_aead = await self._adecryption_dek(encrypted_dek)
+        return await asyncio.to_thread(dek_aead.decrypt, payload, associated_data)
+
+
+def _kms():
+    # The GCP client libraries are slow to import, so only load them when used
+    from google.cloud import kms
+
+    return kms
+
+
+def _google_api_error():
+    from google.api_core import exceptions
+
+    return exceptions.GoogleAPIError
+
+
+class GcpKmsAead(aead.Aead):
+    """
+    AEAD backed by a Google Cloud KMS key, with both blocking and asyncio methods.
+    Produces the same ciphertexts as tink's `gcpkms` integration, but `aencrypt`
+    and `adecrypt` use the async KMS client instead of blocking a thread.
+    """
+
+    def __init__(self, key_name: str, credential_file: str | None = None):
+        self.key_name = key_name
+        self.credential_file = credential_file
+        self._client = None
+        # grpc.aio channels are bound to an event loop, so keep one client per loop
+        self._async_clients = weakref.WeakKeyDictionary()
+
+    def _new_client(self, client_class):
+        if self.credential_file is not None:
+            return client_class.from_service_account_file(self.credential_file)
+        return client_class()
+
+    def _sync_client(self):
+        if self._client is None:
+            self._client = self._new_client(_kms().KeyManagementServiceClient)
+        return self._client
+
+    def _async_client(self):
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = self._new_client(_kms().KeyManagementServiceAsyncClient)
+            self._async_clients[loop] = client
+        return client
+
+    def _encrypt_request(self, plaintext, associated_data):
+        return {
+            "name": self.key_name,
+            "plaintext": plaintext,
+            "additional_authenticated_data": associated_data,
+        }
+
+    def _decrypt_request(self, ciphertext, associated_data):
+        return {
+            "name": self.key_name,
+            "ciphertext": ciphertext,
+            "additional_authenticated_data": associated_data,
+        }
+
+    def encrypt(self, plaintext: bytes, associated_data: bytes) -> bytes:
+        return self.encrypt_versioned(plaintext, associated_data)[0]
+
+    def encrypt_versioned(
+        self, plaintext: bytes, associated_data: bytes
+    ) -> tuple[bytes, str]:
+        """
+        Like `encrypt`, but also returns the name of the key version KMS used.
+        """
+        try:
+            request = self._encrypt_request(plaintext, associated_data)
+            response = self._sync_client().encrypt(request=request)
+            return response.ciphertext, response.name
+        except _google_api_error() as e:
+            raise tink.TinkError(e)
+
+    def decrypt(self, ciphertext: bytes, associated_data: bytes) -> bytes:
+        try:
+            request = self._decrypt_request(ciphertext, associated_data)
+            return self._sync_client().decrypt(request=request).plaintext
+        except _google_api_error() as e:
+            raise tink.TinkError(e)
+
+    async def aencrypt(self, plaintext: bytes, associated_data: bytes) -> bytes:
+        return (await self.aencrypt_versioned(plaintext, associated_data))[0]
+
+    async def aencrypt_versioned(
+        self, plaintext: bytes, associated_data: bytes
+    ) -> tuple[bytes, str]:
+        try:
+            request = self._encrypt_request(plaintext, associated_data)
+            response = await self._async_client().encrypt(request=request)
+            return response.ciphertext, response.name
+        except _google_api_error() as e:
+            raise tink.TinkError(e)
+
+    async def adecrypt(self, ciphertext: bytes, associated_data: bytes) -> bytes:
+        try:
+            request = self._decrypt_request(ciphertext, associated_data)
+            response = await self._async_client().decrypt(request=request)
+            return response.plaintext
+        except _google_api_error() as e:
+            raise tink.TinkError(e)
+
+
+class LocalKmsAead(aead.Aead):
+    """
+    In-process stand-in for a remote KMS key, for offline testing and benchmarks.
+    Wraps a freshly generated AES256-GCM key and sleeps `latency` seconds on every
+    call to simulate the round trip. The key only lives as long as the process, so
+    anything it encrypts is unreadable after a restart.
+    """
+
+    # Stands in for a KMS key version name
+    version = "local-kms"
+
+    def __init__(self, latency: float = 0.0):
+        aead.register()
+        self.latency = latency
+        self.calls = 0
+        keyset_handle = tink.new_keyset_handle(aead.aead_key_templates.AES256_GCM)
+        self._aead = keyset_handle.primitive(aead.Aead)
+
+    def encrypt(self, plaintext: bytes, associated_data: bytes) -> bytes:
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return self._aead.encrypt(plaintext, associated_data)
+
+    def decrypt(self, ciphertext: bytes, associated_data: bytes) -> bytes:
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return self._aead.decrypt(ciphertext, associated_data)
+
+    async def aencrypt(self, plaintext: bytes, associated_data: bytes) -> bytes:
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._aead.encrypt(plaintext, associated_data)
+
+    def encrypt_versioned(
+        self, plaintext: bytes, associated_data: bytes
+    ) -> tuple[bytes, str]:
+        return self.encrypt(plaintext, associated_data), self.version
+
+    async def aencrypt_versioned(
+        self, plaintext: bytes, associated_data: bytes
+    ) -> tuple[bytes, str]:
+        return await self.aencrypt(plaintext, associated_data), self.version
+
+    async def adecrypt(self, ciphertext: bytes, associated_data: bytes) -> bytes:
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._aead.decrypt(ciphertext, associated_data)
@@ -0,0 +1,144 @@
+import itertools
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Iterable, TextIO
+
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, transaction
+
+from .models import Secret
+
+
+@dataclass
+class ImportStats:
+    read: int = 0
+    imported: int = 0
+    rejected: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def rows_per_second(self) -> float:
+        if self.elapsed == 0:
+            return 0.0
+        return self.imported / self.elapsed
+
+
+def build_secret(name: str, plaintext: str) -> Secret:
+    """
+    An unsaved `Secret` with every encrypted field set, like the `create` view
+    makes.
+    """
+    plaintext_json = {"name": name, "secret": plaintext}
+    secret = Secret(
+        name=name, _plaintext_secret=plaintext, _plaintext_json=plaintext_json
+    )
+    secret.plaintext_from_binary = plaintext
+    secret.plaintext_from_b64 = plaintext
+    secret.plaintext_from_json = plaintext_json
+    return secret
+
+
+def _parse(line: str) -> tuple[str, str]:
+    record = json.loads(line)
+    if not isinstance(record, dict):
+        raise ValueError("expected a JSON object")
+    name, plaintext = record.get("name"), record.get("secret")
+    if not isinstance(name, str) or not isinstance(plaintext, str):
+        raise ValueError('expected string "name" and "secret" keys')
+    return name, plaintext
+
+
+def _build(line: str) -> Secret:
+    # Runs on a pool worker
+    secret = build_secret(*_parse(line))
+    # Length limits and the like, so one bad line can't fail a whole `bulk_create`
+    secret.clean_fields()
+    return secret
+
+
+def _error_message(error: Exception) -> str:
+    if isinstance(error, ValidationError):
+        return "; ".join(
+            f"{field}: {' '.join(messages)}"
+            for field, messages in error.message_dict.items()
+        )
+    return str(error) or type(error).__name__
+
+
+def import_secrets(
+    lines: Iterable[str],
+    *,
+    chunk_size: int = 500,
+    workers: int = 4,
+    rejects: TextIO | None = None,
+    progress=None,
+) -> ImportStats:
+    """
+    Creates a `Secret` for every line of `lines`, a JSONL stream of
+    `{"name": ..., "secret": ...}` objects.
+
+    Lines are read `chunk_size` at a time, so memory use doesn't depend on the size
+    of the input. Each chunk is parsed and encrypted on a pool of `workers` threads
+    and inserted with one `bulk_create`. Lines that don't parse, don't validate or
+    can't be inserted are skipped and written to `rejects`, if given, as JSONL
+    `{"line": <line number>, "error": ..., "input": <the line>}`. `progress`, if
+    given, is called with the running `ImportStats` after every chunk.
+    """
+    stats = ImportStats()
+    start = time.monotonic()
+
+    def reject(number, line, error):
+        stats.rejected += 1
+        if rejects is not None:
+            rejects.write(
+                json.dumps(
+                    {"line": number, "error": _error_message(error), "input": line}
+                )
+                + "\n"
+            )
+
+    numbered = (
+        (number, line.rstrip("\r\n"))
+        for number, line in enumerate(lines, start=1)
+        if line.strip()
+    )
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            chunk = list(itertools.islice(numbered, chunk_size))
+            if not chunk:
+                break
+            stats.read += len(chunk)
+
+            futures = [
+                (number, line, executor.submit(_build, line)) for number, line in chunk
+            ]
+            built = []
+            for number, line, future in futures:
+                try:
+                    built.append((number, line, future.result()))
+                except Exception as e:
+                    reject(number, line, e)
+
+            try:
+                with transaction.atomic():
+                    Secret.objects.bulk_create([secret for _, _, secret in built])
+                stats.imported += len(built)
+            except DatabaseError:
+                # Find the offending rows one at a time
+                for number, line, secret in built:
+                    secret.pk = None
+                    try:
+                        with transaction.atomic():
+                            secret.save(force_insert=True)
+                        stats.imported += 1
+                    except DatabaseError as e:
+                        reject(number, line, e)
+
+            stats.elapsed = time.monotonic() - start
+            if progress is not None:
+                progress(stats)
+
+    stats.elapsed = time.monotonic() - start
+    return stats
@@ -0,0 +1,198 @@
+import bisect
+import threading
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.utils.module_loading import import_string
+
+from . import keysets
+
+# Upper bounds, in seconds and bytes
+LATENCY_BUCKETS = (
+    0.00001,
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+)
+SIZE_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+class Instrumentation:
+    """
+    Receives events from `EncryptedField`. The default implementation does nothing;
+    subclass it and point `settings.TINK_FIELD_INSTRUMENTATION` at the subclass to
+    collect metrics.
+
+    - `operation` is "encrypt" or "decrypt"
+    - `field` is a label like "Secret.plaintext_from_b64"
+    - `encryptor` is the encryptor's class name
+    - `payload_size` is the ciphertext's length; JSON documents are measured
+      serialized
+    - `event` is one of:
+      - "decrypt_primary", "decrypt_fallback": which encryptor decrypted a value
+      - "decrypt_failure", "decrypt_failure_cached" (rejected by the negative cache)
+      - "reencryption"
+      - "reencryption_skipped": a duplicate re-encryption of a row that another
+        reader already rotated
+      - "reencryption_deferred": a re-encryption on read put off by the rate limit
+      - "reencryption_replica_lag": a stale replica read of a row that was just
+        re-encrypted
+    """
+
+    # `EncryptedField` skips timing entirely when this is False
+    enabled = False
+
+    def observe(self, operation, field, encryptor, seconds, payload_size=None):
+        pass
+
+    def increment(self, event, field, encryptor=None):
+        pass
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=""):
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}"
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, label_names, label_values):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            labels = _labels(label_names, label_values, f'le="{bound}"')
+            lines.append(f"{name}_bucket{labels} {cumulative}")
+        labels = _labels(label_names, label_values, 'le="+Inf"')
+        lines.append(f"{name}_bucket{labels} {self.count}")
+        labels = _labels(label_names, label_values)
+        lines.append(f"{name}_sum{labels} {self.sum}")
+        lines.append(f"{name}_count{labels} {self.count}")
+        return lines
+
+
+class PrometheusInstrumentation(Instrumentation):
+    """
+    Keeps latency and payload size histograms and event counters in memory and
+    renders them in the Prometheus text exposition format.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latency = {}
+        self._sizes = {}
+        self._events = {}
+
+    def observe(self, operation, field, encryptor, seconds, payload_size=None):
+        key = (operation, field, encryptor)
+        with self._lock:
+            histogram = self._latency.get(key)
+            if histogram is None:
+                histogram = self._latency[key] = _Histogram(LATENCY_BUCKETS)
+            histogram.observe(seconds)
+            if payload_size is not None:
+                histogram = self._sizes.get(key)
+                if histogram is None:
+                    histogram = self._sizes[key] = _Histogram(SIZE_BUCKETS)
+                histogram.observe(payload_size)
+
+    def increment(self, event, field, encryptor=None):
+        key = (event, field, encryptor or "")
+        with self._lock:
+            self._events[key] = self._events.get(key, 0) + 1
+
+    def render(self) -> str:
+        label_names = ("operation", "field", "encryptor")
+        lines = []
+        with self._lock:
+            lines.append(
+                "# HELP tink_field_operation_seconds Encrypt/decrypt latency by field and encryptor"
+            )
+            lines.append("# TYPE tink_field_operation_seconds histogram")
+            for key, histogram in sorted(self._latency.items()):
+                lines.extend(
+                    histogram.render("tink_field_operation_seconds", label_names, key)
+                )
+
+            lines.append(
+                "# HELP tink_field_payload_bytes Ciphertext size by field and encryptor"
+            )
+            lines.append("# TYPE tink_field_payload_bytes histogram")
+            for key, histogram in sorted(self._sizes.items()):
+                lines.extend(
+                    histogram.render("tink_field_payload_bytes", label_names, key)
+                )
+
+            lines.append(
+                "# HELP tink_field_events_total Decrypt sources, failures and re-encryptions"
+            )
+            lines.append("# TYPE tink_field_events_total counter")
+            for key, count in sorted(self._events.items()):
+                labels = _labels(("event", "field", "encryptor"), key)
+                lines.append(f"tink_field_events_total{labels} {count}")
+
+        lines.append(
+            "# HELP tink_field_keyset_reloads_total Times KEYSET_FILE was reloaded after changing"
+        )
+        lines.append("# TYPE tink_field_keyset_reloads_total counter")
+        lines.append(f"tink_field_keyset_reloads_total {keysets.reload_count()}")
+        key_id = keysets.active_key_id()
+        if key_id is not None:
+            lines.append(
+                "# HELP tink_field_keyset_primary_key_id Primary key ID of the loaded keyset"
+            )
+            lines.append("# TYPE tink_field_keyset_primary_key_id gauge")
+            lines.append(f"tink_field_keyset_primary_key_id {key_id}")
+        return "\n".join(lines) + "\n"
+
+
+_instrumentation: Instrumentation = None
+
+
+def get_instrumentation() -> Instrumentation:
+    global _instrumentation
+    if _instrumentation is None:
+        path = getattr(settings, "TINK_FIELD_INSTRUMENTATION", None)
+        if path is None:
+            _instrumentation = Instrumentation()
+        else:
+            _instrumentation = import_string(path)()
+
+    return _instrumentation
+
+
+def _reset(*, setting, **kwargs):
+    global _instrumentation
+    if setting == "TINK_FIELD_INSTRUMENTATION":
+        _instrumentation = None
+
+
+setting_changed.connect(_reset)
@@ -0,0 +1,269 @@
+import asyncio
+import json
+from typing import Any
+
+from .b64_encryptor import B64Encryptor
+from .encrypted_field import EncryptorInterface
+from .negative_cache import undecryptable
+
+
+def _parse_path(path: str) -> tuple[str, ...]:
+    segments = tuple(path.split("."))
+    if not path or any(segment == "" for segment in segments):
+        raise ValueError(f"Invalid JSON path {path!r}")
+    return segments
+
+
+def _leaves(document, pattern, prefix=()):
+    """
+    Yields (concrete path, value) for every value in `document` matching `pattern`.
+    Segments index dicts by key and lists by position; "*" matches every item.
+    Missing keys and out-of-range indexes match nothing.
+    """
+    if not pattern:
+        yield prefix, document
+        return
+
+    head, rest = pattern[0], pattern[1:]
+    match document:
+        case dict():
+            keys = list(document) if head == "*" else [head] if head in document else []
+        case list():
+            if head == "*":
+                keys = range(len(document))
+            elif head.isdigit() and int(head) < len(document):
+                keys = [int(head)]
+            else:
+                keys = []
+        case _:
+            keys = []
+    for key in keys:
+        yield from _leaves(document[key], rest, prefix + (key,))
+
+
+def _replaced(document, replacements):
+    """
+    Returns a copy of `document` with each (path, value) in `replacements` set.
+    Only the containers on those paths are copied (shallowly), once each; every
+    other subtree is shared with `document`.
+    """
+    copies = {(): document.copy()}
+    for path, value in replacements:
+        node = copies[()]
+        for depth in range(1, len(path)):
+            prefix = path[:depth]
+            child = copies.get(prefix)
+            if child is None:
+                child = copies[prefix] = node[path[depth - 1]].copy()
+                node[path[depth - 1]] = child
+            node = child
+        node[path[-1]] = value
+    return copies[()]
+
+
+class JsonEncryptor(B64Encryptor):
+    """
+    Encrypts the values at `paths` inside a JSON document and leaves the rest of it
+    readable. Paths are dot-separated keys or list indexes, and "*" matches every
+    item of a list or dict, e.g. `["password", "tokens.*.value"]`.
+
+    Each value is JSON-encoded and encrypted with the field's associated data plus
+    its concrete path, so an encrypted value can't be moved to another path. With
+    `legacy_associated_data`, values that don't decrypt that way are retried with
+    the plain associated data; that's how the original single-key
+    `JsonEncryptor` wrote its `"secret"` string.
+    """
+
+    def __init__(
+        self,
+        paths: list[str] | tuple[str, ...] = ("secret",),
+        *,
+        legacy_associated_data: bool = True,
+    ):
+        super().__init__()
+        self.paths = [_parse_path(path) for path in paths]
+        for path in self.paths:
+            for other in self.paths:
+                if path != other and other[: len(path)] == path:
+                    raise ValueError(
+                        f"JSON path {'.'.join(other)} is inside {'.'.join(path)}"
+                    )
+        self.legacy_associated_data = legacy_associated_data
+
+    def _selected(self, document):
+        return [leaf for pattern in self.paths for leaf in _leaves(document, pattern)]
+
+    @staticmethod
+    def _path_associated_data(associated_data: bytes, path) -> bytes:
+        return associated_data + b"\x00" + ".".join(map(str, path)).encode("utf-8")
+
+    @staticmethod
+    def _bytes(associated_data: str | bytes) -> bytes:
+        if type(associated_data) == str:
+            return associated_data.encode("utf-8")
+        return associated_data
+
+    def encrypt(
+        self, plaintext_dict: dict[Any, Any], associated_data: str | bytes = b""
+    ) -> dict[Any, Any]:
+        associated_data = self._bytes(associated_data)
+        return _replaced(
+            plaintext_dict,
+            [
+                (
+                    path,
+                    super(JsonEncryptor, self).encrypt(
+                        json.dumps(value),
+                        self._path_associated_data(associated_data, path),
+                    ),
+                )
+                for path, value in self._selected(plaintext_dict)
+            ],
+        )
+
+    def _decrypt_leaf(self, path, ciphertext, associated_data):
+        try:
+            plaintext = super().decrypt(
+                ciphertext, self._path_associated_data(associated_data, path)
+            )
+        except Exception as e:
+            if not self.legacy_associated_data or not undecryptable(e):
+                raise
+            return super().decrypt(ciphertext, associated_data)
+        return json.loads(plaintext)
+
+    def decrypt(
+        self, ciphertext_dict: dict[Any, Any], associated_data: str | bytes = b""
+    ) -> dict[Any, Any]:
+        associated_data = self._bytes(associated_data)
+        return _replaced(
+            ciphertext_dict,
+            [
+                (path, self._decrypt_leaf(path, ciphertext, associated_data))
+                for path, ciphertext in self._selected(ciphertext_dict)
+            ],
+        )
+
+    async def aencrypt(
+        self, plaintext_dict: dict[Any, Any], associated_data: str | bytes = b""
+    ) -> dict[Any, Any]:
+        associated_data = self._bytes(associated_data)
+        selected = self._selected(plaintext_dict)
+        ciphertexts = await asyncio.gather(
+            *(
+                super(JsonEncryptor, self).aencrypt(
+                    json.dumps(value),
+                    self._path_associated_data(associated_data, path),
+                )
+                for path, value in selected
+            )
+        )
+        return _replaced(
+            plaintext_dict,
+            [
+                (path, ciphertext)
+                for (path, _), ciphertext in zip(selected, ciphertexts)
+            ],
+        )
+
+    async def _adecrypt_leaf(self, path, ciphertext, associated_data):
+        try:
+            plaintext = await super().adecrypt(
+                ciphertext, self._path_associated_data(associated_data, path)
+            )
+        except Exception as e:
+            if not self.legacy_associated_data or not undecryptable(e):
+                raise
+            return await super().adecrypt(ciphertext, associated_data)
+        return json.loads(plaintext)
+
+    async def adecrypt(
+        self, ciphertext_dict: dict[Any, Any], associated_data: str | bytes = b""
+    ) -> dict[Any, Any]:
+        associated_data = self._bytes(associated_data)
+        selected = self._selected(ciphertext_dict)
+        plaintexts = await asyncio.gather(
+            *(
+                self._adecrypt_leaf(path, ciphertext, associated_data)
+                for path, ciphertext in selected
+            )
+        )
+        return _replaced(
+            ciphertext_dict,
+            [(path, plaintext) for (path, _), plaintext in zip(selected, plaintexts)],
+        )
+
+    def may_decrypt(self, ciphertext_dict) -> bool:
+        if not isinstance(ciphertext_dict, dict):
+            return False
+        return all(
+            super(JsonEncryptor, self).may_decrypt(ciphertext)
+            for _, ciphertext in self._selected(ciphertext_dict)
+        )
+
+    def key_id(self, ciphertext_dict: dict[Any, Any]) -> str | None:
+        # Every value is normally encrypted under the same key, but a data key
+        # rotation can land in the middle of a document
+        key_ids = {
+            super(JsonEncryptor, self).key_id(ciphertext)
+            for _, ciphertext in self._selected(ciphertext_dict)
+        }
+        return key_ids.pop() if len(key_ids) == 1 else None
+
+
+class JsonValuesEncryptor(EncryptorInterface):
+    """
+    Applies `encryptor` to the string values at `paths` inside a JSON document,
+    as-is: no JSON-encoding and no associated data. Used as the fallback for
+    documents whose `"secret"` was encrypted directly with `LegacyEncryptor`.
+    """
+
+    def __init__(
+        self,
+        encryptor: EncryptorInterface,
+        paths: list[str] | tuple[str, ...] = ("secret",),
+    ):
+        self.encryptor = encryptor
+        self.paths = [_parse_path(path) for path in paths]
+
+    def _selected(self, document):
+        return [leaf for pattern in self.paths for leaf in _leaves(document, pattern)]
+
+    def encrypt(
+        self, plaintext_dict: dict[Any, Any], _associated_data: str | bytes = b""
+    ) -> dict[Any, Any]:
+        return _replaced(
+            plaintext_dict,
+            [
+                (path, self.encryptor.encrypt(value))
+                for path, value in self._selected(plaintext_dict)
+            ],
+        )
+
+    def decrypt(
+        self, ciphertext_dict: dict[Any, Any], _associated_data: str | bytes = b""
+    ) -> dict[Any, Any]:
+        replacements = []
+        for path, ciphertext in self._selected(ciphertext_dict):
+            plaintext = self.encryptor.decrypt(ciphertext)
+            if type(plaintext) == bytes:
+                # JSON has no bytes
+                plaintext = plaintext.decode("utf-8")
+            replacements.append((path, plaintext))
+        return _replaced(ciphertext_dict, replacements)
+
+    def may_decrypt(self, ciphertext_dict) -> bool:
+        if not isinstance(ciphertext_dict, dict):
+            return False
+        return all(
+            self.encryptor.may_decrypt(ciphertext)
+            for _, ciphertext in self._selected(ciphertext_dict)
+        )
+
+    async def amay_decrypt(self, ciphertext_dict) -> bool:
+        if not isinstance(ciphertext_dict, dict):
+            return False
+        for _, ciphertext in self._selected(ciphertext_dict):
+            if not await self.encryptor.amay_decrypt(ciphertext):
+                return False
+        return True
@@ -0,0 +1,443 @@
+import asyncio
+import logging
+import math
+import os
+import threading
+import time
+from typing import Any, Callable, NamedTuple
+
+from django.conf import settings
+from django.core.signals import setting_changed
+
+from .negative_cache import get_negative_cache
+
+logger = logging.getLogger(__name__)
+
+# Settings that change which AEAD primitive `TinkEncryptor` uses
+PRIMITIVE_SETTINGS = (
+    "GCP_CREDENTIAL_FILE",
+    "GCP_PROJECT_ID",
+    "KMS_LOCATION_ID",
+    "KMS_KEY_RING_ID",
+    "KMS_KEY_ID",
+    "KEYSET_FILE",
+    "LOCAL_KMS_LATENCY",
+    "KMS_DEK_CACHE",
+    "KMS_DEK_CACHE_SIZE",
+    "KMS_DEK_CACHE_TTL",
+    "KMS_DEK_MAX_USES",
+    "STREAMING_KEYSET_FILE",
+    "KEYSET_RELOAD_INTERVAL",
+)
+
+
+def can_use_kms():
+    return all(
+        map(
+            lambda x: x is not None,
+            [
+                settings.GCP_PROJECT_ID,
+                settings.KMS_LOCATION_ID,
+                settings.KMS_KEY_RING_ID,
+                settings.KMS_KEY_ID,
+            ],
+        ),
+    )
+
+
+def kms_path():
+    if can_use_kms():
+        return f"projects/{settings.GCP_PROJECT_ID}/locations/{settings.KMS_LOCATION_ID}/keyRings/{settings.KMS_KEY_RING_ID}/cryptoKeys/{settings.KMS_KEY_ID}"
+
+
+def remote_aead():
+    """
+    Returns the key-encryption AEAD from settings: GCP KMS, the in-process
+    `LocalKmsAead` stand-in, or `None`.
+    """
+    if can_use_kms():
+        # Importing the GCP client libraries is slow, so only do it when needed
+        from tink.integration import gcpkms
+
+        kms_uri = f"gcp-kms://{kms_path()}"
+        client = gcpkms.GcpKmsClient(kms_uri, settings.GCP_CREDENTIAL_FILE)
+        return client.get_aead(kms_uri)
+    elif getattr(settings, "LOCAL_KMS_LATENCY", None) is not None:
+        from .envelope import LocalKmsAead
+
+        # Offline stand-in for KMS; only useful for testing envelope mode
+        return LocalKmsAead(settings.LOCAL_KMS_LATENCY)
+    return None
+
+
+# Matchers only look at this many leading bytes of a ciphertext
+HEADER_LEN = 8
+
+
+def _any_ciphertext(header: bytes, length: int) -> bool:
+    return True
+
+
+def _prefix_matcher(keyset_handle):
+    """
+    Returns a function that checks whether a ciphertext starts with the output
+    prefix of one of the keyset's enabled keys. Keys with RAW output have no
+    prefix, so a keyset containing one matches any ciphertext.
+    """
+    from tink.proto import tink_pb2
+
+    prefixes = set()
+    for key_info in keyset_handle.keyset_info().key_info:
+        if key_info.status != tink_pb2.ENABLED:
+            continue
+        key_id = key_info.key_id.to_bytes(4, "big")
+        match key_info.output_prefix_type:
+            case tink_pb2.TINK:
+                prefixes.add(b"\x01" + key_id)
+            case tink_pb2.LEGACY | tink_pb2.CRUNCHY:
+                prefixes.add(b"\x00" + key_id)
+            case _:
+                return _any_ciphertext
+
+    def matches(header: bytes, length: int) -> bool:
+        return header[:5] in prefixes
+
+    return matches
+
+
+class Keyset(NamedTuple):
+    primitive: Any
+    # Cheaply checks whether a ciphertext could have come from `primitive`
+    matcher: Callable[[bytes, int], bool]
+    # Identifies the key a ciphertext from `primitive` was encrypted under
+    key_id: Callable[[bytes], str | None]
+    # None with envelope encryption, which has no keyset
+    primary_key_id: int | None
+    # `_stamp()` of KEYSET_FILE when it was read, or None if there is no file
+    source: tuple | None
+
+
+def _stamp(path) -> tuple:
+    # Changes when the file is rewritten in place or replaced by a rename
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+def _unknown_key(ciphertext: bytes) -> None:
+    return None
+
+
+def _key_id_reader(keyset_handle):
+    """
+    Returns a function that reads the ID of the key a ciphertext was encrypted
+    under from its output prefix. A RAW primary key writes no prefix, so then every
+    ciphertext is attributed to the primary key; that's only right for ciphertexts
+    that were just encrypted.
+    """
+    from tink.proto import tink_pb2
+
+    keyset_info = keyset_handle.keyset_info()
+    primary_key_id = keyset_info.primary_key_id
+    for key_info in keyset_info.key_info:
+        if (
+            key_info.key_id == primary_key_id
+            and key_info.output_prefix_type == tink_pb2.RAW
+        ):
+            return lambda ciphertext: str(primary_key_id)
+
+    def key_id(ciphertext: bytes) -> str | None:
+        if len(ciphertext) < 5:
+            return None
+        return str(int.from_bytes(ciphertext[1:5], "big"))
+
+    return key_id
+
+
+def _build_aead() -> Keyset:
+    import tink
+    from tink import aead
+    from tink import secret_key_access
+
+    from .envelope import CachingKmsEnvelopeAead, GcpKmsAead, plausible_envelope
+
+    aead.register()
+
+    remote = remote_aead()
+
+    keyset_contents = None
+    source = None
+    if settings.KEYSET_FILE is not None:
+        # Stat before reading, so a write that lands in between is picked up by the
+        # next reload check rather than missed
+        source = _stamp(settings.KEYSET_FILE)
+        with open(settings.KEYSET_FILE, "rt") as f:
+            keyset_contents = f.read()
+
+    if keyset_contents is not None:
+        if remote is not None:
+            # Encrypted keyset
+            keyset_handle = tink.json_proto_keyset_format.parse_encrypted(
+                keyset_contents,
+                remote,
+                None,  # associated data
+            )
+        else:
+            # Plaintext keyset
+            keyset_handle = tink.json_proto_keyset_format.parse(
+                keyset_contents, secret_key_access.TOKEN
+            )
+        return Keyset(
+            keyset_handle.primitive(aead.Aead),
+            _prefix_matcher(keyset_handle),
+            _key_id_reader(keyset_handle),
+            keyset_handle.keyset_info().primary_key_id,
+            source,
+        )
+    elif remote is not None and getattr(settings, "KMS_DEK_CACHE", False):
+        # KmsEnvelopeAead-compatible, with data keys cached. `GcpKmsAead` makes
+        # the same KMS calls as tink's client but can also make them async.
+        if can_use_kms():
+            remote = GcpKmsAead(kms_path(), settings.GCP_CREDENTIAL_FILE)
+        primitive = CachingKmsEnvelopeAead(
+            aead.aead_key_templates.AES256_GCM,
+            remote,
+            max_uses=getattr(settings, "KMS_DEK_MAX_USES", 1000),
+            ttl=getattr(settings, "KMS_DEK_CACHE_TTL", 300.0),
+            cache_size=getattr(settings, "KMS_DEK_CACHE_SIZE", 1000),
+        )
+        return Keyset(primitive, plausible_envelope, primitive.key_version, None, None)
+    elif remote is not None:
+        # KmsEnvelopeAead. It doesn't report which KMS key version wrapped a DEK.
+        primitive = aead.KmsEnvelopeAead(aead.aead_key_templates.AES256_GCM, remote)
+        return Keyset(primitive, plausible_envelope, _unknown_key, None, None)
+    else:
+        raise Exception("No encryptor settings provided")
+
+
+# One `Keyset` per configuration, shared by every `TinkEncryptor`
+_primitives = {}
+_active: Keyset = None
+_lock = threading.Lock()
+
+# Hot reload of KEYSET_FILE: when to next stat it, how many times it has been
+# reloaded, and the stamp of the last version that failed to load
+_next_check = math.inf
+_reloads = 0
+_failed_source = None
+_reload_lock = threading.Lock()
+
+
+def _config():
+    return tuple(getattr(settings, name, None) for name in PRIMITIVE_SETTINGS)
+
+
+def _schedule_check():
+    global _next_check
+    interval = getattr(settings, "KEYSET_RELOAD_INTERVAL", 5.0)
+    _next_check = math.inf if interval is None else time.monotonic() + interval
+
+
+def _entry() -> Keyset:
+    global _active
+    entry = _active
+    if entry is None:
+        with _lock:
+            config = _config()
+            entry = _primitives.get(config)
+            if entry is None:
+                entry = _build_aead()
+                _primitives[config] = entry
+            _active = entry
+            _schedule_check()
+    elif entry.source is not None and time.monotonic() >= _next_check:
+        entry = _reload(entry)
+    return entry
+
+
+def _reload(entry: Keyset) -> Keyset:
+    """
+    Re-reads KEYSET_FILE if it changed since `entry` was built, and swaps the new
+    keyset in. Only one thread checks at a time; the others, and any encrypt or
+    decrypt already holding the old primitive, carry on with it meanwhile. If the
+    new file doesn't load (e.g. it's half-written), the old keyset stays active.
+    """
+    global _active, _reloads, _failed_source
+    if not _reload_lock.acquire(blocking=False):
+        return entry
+    try:
+        _schedule_check()
+        try:
+            source = _stamp(settings.KEYSET_FILE)
+        except OSError:
+            logger.warning("Can't stat KEYSET_FILE, keeping the loaded keyset")
+            return entry
+        if source == entry.source or source == _failed_source:
+            return entry
+
+        try:
+            new_entry = _build_aead()
+        except Exception:
+            _failed_source = source
+            logger.exception("Failed to reload KEYSET_FILE, keeping the loaded keyset")
+            return entry
+
+        with _lock:
+            # Settings changed while we were building; the next call starts over
+            if _active is not entry:
+                return entry
+            _primitives[_config()] = new_entry
+            _active = new_entry
+            _reloads += 1
+        # Ciphertexts under keys that have just been added may decrypt now
+        get_negative_cache().clear()
+        logger.info("Reloaded KEYSET_FILE, primary key ID %s", new_entry.primary_key_id)
+        return new_entry
+    finally:
+        _reload_lock.release()
+
+
+async def _aentry() -> Keyset:
+    # Building or reloading a keyset reads a file and may call KMS, so async
+    # callers do that on a thread instead of blocking the event loop
+    entry = _active
+    if entry is None or (entry.source is not None and time.monotonic() >= _next_check):
+        entry = await asyncio.to_thread(_entry)
+    return entry
+
+
+def get_aead():
+    """
+    Returns the shared AEAD primitive for the current settings, building it on
+    first use. The keyset file is read (and, with KMS, decrypted) once per process
+    rather than once per encryptor.
+    """
+    return _entry().primitive
+
+
+async def aget_aead():
+    """
+    Async equivalent of `get_aead`: the first build and any reload of the keyset
+    happen on a thread.
+    """
+    return (await _aentry()).primitive
+
+
+async def aload_keyset():
+    """
+    Builds or reloads the keyset for the current settings on a thread if it's due,
+    so that the synchronous helpers below return without blocking the event loop.
+    """
+    await _aentry()
+
+
+def get_ciphertext_matcher():
+    """
+    Returns a function that checks, without decrypting, whether a ciphertext
+    could have been produced by `get_aead()`: by output prefix (key ID) for
+    keysets, or by the wrapped key length for envelope encryption. It's called
+    with the first `HEADER_LEN` bytes of the ciphertext and its total length.
+    """
+    return _entry().matcher
+
+
+def ciphertext_key_id(ciphertext: bytes) -> str | None:
+    """
+    Identifies the key a ciphertext just produced by `get_aead()` was encrypted
+    under: the tink key ID for keysets, or the KMS key version that wrapped the data
+    key for cached envelope encryption (`KMS_DEK_CACHE`). None if it can't tell.
+    """
+    return _entry().key_id(ciphertext)
+
+
+def key_id_kind() -> str | None:
+    """
+    What `ciphertext_key_id` records for the current settings, without building
+    the primitive: "keyset" for tink key IDs, "kms" for the KMS key version names
+    of cached envelope encryption, or None for plain `KmsEnvelopeAead`, which
+    records nothing.
+    """
+    if settings.KEYSET_FILE is not None:
+        return "keyset"
+    if getattr(settings, "KMS_DEK_CACHE", False):
+        return "kms"
+    return None
+
+
+def active_key_id() -> int | None:
+    """
+    Primary key ID of the loaded keyset, i.e. the key new ciphertexts are written
+    under. None before anything has been encrypted or decrypted, and with envelope
+    encryption.
+    """
+    entry = _active
+    return None if entry is None else entry.primary_key_id
+
+
+def reload_count() -> int:
+    """
+    Number of times KEYSET_FILE has been reloaded after changing on disk.
+    """
+    return _reloads
+
+
+def _build_streaming_aead():
+    import tink
+    from tink import secret_key_access
+    from tink import streaming_aead
+
+    streaming_aead.register()
+
+    if getattr(settings, "STREAMING_KEYSET_FILE", None) is None:
+        raise Exception("STREAMING_KEYSET_FILE is not set")
+    with open(settings.STREAMING_KEYSET_FILE, "rt") as f:
+        keyset_contents = f.read()
+
+    remote = remote_aead()
+    if remote is not None:
+        keyset_handle = tink.json_proto_keyset_format.parse_encrypted(
+            keyset_contents, remote, None
+        )
+    else:
+        keyset_handle = tink.json_proto_keyset_format.parse(
+            keyset_contents, secret_key_access.TOKEN
+        )
+    return keyset_handle.primitive(streaming_aead.StreamingAead)
+
+
+_streaming_primitives = {}
+_streaming_active = None
+
+
+def get_streaming_aead():
+    """
+    Like `get_aead`, for the streaming AEAD keyset in `STREAMING_KEYSET_FILE`. It's
+    a separate keyset because streaming and regular AEAD keys aren't
+    interchangeable. It is encrypted with KMS when KMS is configured, like
+    `KEYSET_FILE`.
+    """
+    global _streaming_active
+    primitive = _streaming_active
+    if primitive is None:
+        with _lock:
+            config = _config()
+            primitive = _streaming_primitives.get(config)
+            if primitive is None:
+                primitive = _build_streaming_aead()
+                _streaming_primitives[config] = primitive
+            _streaming_active = primitive
+    return primitive
+
+
+def built_primitives() -> int:
+    return len(_primitives) + len(_streaming_primitives)
+
+
+def _reset(*, setting, **kwargs):
+    global _active, _streaming_active, _failed_source
+    if setting in PRIMITIVE_SETTINGS:
+        _active = None
+        _streaming_active = None
+        _failed_source = None
+
+
+setting_changed.connect(_reset)
@@ -1,6 +1,7 @@
 import base64
 from cryptography.fernet import Fernet
 from django.conf import settings
+from django.core.signals import setting_changed
 
 from .encrypted_field import EncryptorInterface
 
@@ -11,7 +12,15 @@ class LegacyEncryptor(EncryptorInterface):
     """
 
     def __init__(self):
-        self.fernet = Fernet(settings.LEGACY_KEY)
+        self._fernet = None
+
+    @property
+    def fernet(self) -> Fernet:
+        # Built on first use so that importing models doesn't require LEGACY_KEY,
+        # and rebuilt when it changes
+        if self._fernet is None:
+            self._fernet = Fernet(settings.LEGACY_KEY)
+        return self._fernet
 
     def encrypt(
         self, plaintext: str | bytes, _associated_data: str | bytes = b""
@@ -25,6 +34,17 @@ class LegacyEncryptor(EncryptorInterface):
     ) -> str:
         return self.fernet.decrypt(ciphertext)
 
+    def may_decrypt(self, ciphertext) -> bool:
+        # Fernet tokens are urlsafe base64 starting with the 0x80 version byte,
+        # which always encodes to "g"
+        match ciphertext:
+            case str():
+                return ciphertext.startswith("g")
+            case bytes():
+                return ciphertext.startswith(b"g")
+            case _:
+                return False
+
 
 _encryptor: LegacyEncryptor = None
 
@@ -35,3 +55,12 @@ def get_encryptor() -> LegacyEncryptor:
         _encryptor = LegacyEncryptor()
 
     return _encryptor
+
+
+def _reset(*, setting, **kwargs):
+    # Models hold on to the encryptor itself, so forget its key instead
+    if setting == "LEGACY_KEY" and _encryptor is not None:
+        _encryptor._fernet = None
+
+
+setting_changed.connect(_reset)
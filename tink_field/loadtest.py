@@ -0,0 +1,273 @@
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass, field
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.db import connections
+from django.test import Client
+from django.test.utils import (
+    CaptureQueriesContext,
+    setup_databases,
+    setup_test_environment,
+    teardown_databases,
+    teardown_test_environment,
+)
+from django.utils import timezone
+
+from .benchmarks import offline_settings
+from .ingest import build_secret
+from .instrumentation import Instrumentation, get_instrumentation
+from .legacy_encryptor import get_encryptor as legacy_encryptor
+from .models import Secret
+
+SCENARIOS = ("create", "changelist", "changelist_stale", "reencrypt_action")
+ADMIN_USERNAME = "loadtest"
+
+
+class CountingInstrumentation(Instrumentation):
+    """
+    Counts encrypt and decrypt calls made through `EncryptedField`, from any thread.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {"encrypt": 0, "decrypt": 0}
+
+    def observe(self, operation, field, encryptor, seconds, payload_size=None):
+        with self._lock:
+            self.counts[operation] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.counts)
+
+
+@dataclass
+class ScenarioResult:
+    scenario: str
+    requests: int = 0
+    errors: int = 0
+    elapsed: float = 0.0
+    latencies: list = field(default_factory=list, repr=False)
+    queries: int = 0
+    encrypts: int = 0
+    decrypts: int = 0
+
+    @property
+    def requests_per_second(self) -> float:
+        return self.requests / self.elapsed if self.elapsed else 0.0
+
+    def percentile(self, p: int) -> float:
+        """
+        Latency in milliseconds below which `p`% of requests completed.
+        """
+        if len(self.latencies) < 2:
+            return self.latencies[0] * 1000 if self.latencies else 0.0
+        # Inclusive, so the estimate never falls outside the observed latencies
+        quantiles = statistics.quantiles(self.latencies, n=100, method="inclusive")
+        return quantiles[p - 1] * 1000
+
+    def per_request(self, total: int) -> float:
+        return total / self.requests if self.requests else 0.0
+
+    def report(self) -> dict:
+        return {
+            "scenario": self.scenario,
+            "requests": self.requests,
+            "errors": self.errors,
+            "requests_per_second": self.requests_per_second,
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "p99_ms": self.percentile(99),
+            "queries_per_request": self.per_request(self.queries),
+            "encrypts_per_request": self.per_request(self.encrypts),
+            "decrypts_per_request": self.per_request(self.decrypts),
+        }
+
+
+def seed(rows: int, *, stale: float = 0.2, legacy: float = 0.1, chunk_size=1000):
+    """
+    Inserts `rows` secrets: a `stale` fraction whose re-encryption window has
+    passed, a `legacy` fraction encrypted only with the Fernet encryptor (as the
+    `create` view's "Legacy" option does), and fresh ones for the rest.
+    """
+    rng = random.Random(rows)
+    long_ago = timezone.now() - timedelta(days=365)
+    for start in range(0, rows, chunk_size):
+        secrets = []
+        for i in range(start, min(rows, start + chunk_size)):
+            name = f"load-{i}"
+            plaintext = f"{rng.getrandbits(64):016x}"
+            kind = rng.random()
+            if kind < legacy:
+                secrets.append(
+                    Secret(
+                        name=name,
+                        _plaintext_secret=plaintext,
+                        _plaintext_json={"name": name, "secret": plaintext},
+                        b64_encrypted_secret=legacy_encryptor().encrypt(plaintext),
+                        json_with_encrypted_secret={
+                            "name": name,
+                            "secret": legacy_encryptor().encrypt(plaintext),
+                        },
+                    )
+                )
+                continue
+            secret = build_secret(name, plaintext)
+            if kind < legacy + stale:
+                secret.binary_reencryption_time = long_ago
+                secret.b64_reencryption_time = long_ago
+                secret.json_reencryption_time = long_ago
+            secrets.append(secret)
+        Secret.objects.bulk_create(secrets)
+
+
+def _request(scenario, client, rng, pks, sequence):
+    if scenario == "create":
+        return client.post(
+            "/secrets/create",
+            {
+                "name": f"new-{sequence}",
+                "plaintext": f"{rng.getrandbits(64):016x}",
+                "encryptor": "default",
+            },
+        )
+    elif scenario == "changelist":
+        page = rng.randrange(max(1, len(pks) // 100))
+        return client.get(f"/admin/tink_field/secret/?p={page + 1}")
+    elif scenario == "changelist_stale":
+        return client.get("/admin/tink_field/secret/?stale=yes")
+    elif scenario == "reencrypt_action":
+        return client.post(
+            "/admin/tink_field/secret/",
+            {
+                "action": "maybe_trigger_reencryption",
+                "index": 0,
+                "_selected_action": rng.sample(pks, min(20, len(pks))),
+            },
+        )
+    raise ValueError(f"Unknown scenario {scenario}")
+
+
+def run_scenario(scenario, *, requests=200, concurrency=4, progress=None):
+    """
+    Sends `requests` requests for `scenario` through the Django test client from
+    `concurrency` threads, each logged in as the load test admin.
+    """
+    pks = list(Secret.objects.values_list("pk", flat=True))
+    admin = get_user_model().objects.get(username=ADMIN_USERNAME)
+    instrumentation = get_instrumentation()
+    result = ScenarioResult(scenario)
+    lock = threading.Lock()
+    sequence = iter(range(requests))
+
+    def worker():
+        # Server errors come back as 500s instead of being raised
+        client = Client(raise_request_exception=False)
+        client.force_login(admin)
+        rng = random.Random(threading.get_ident())
+        try:
+            while True:
+                with lock:
+                    n = next(sequence, None)
+                if n is None:
+                    return
+                with ExitStack() as stack:
+                    # Every alias, since secrets may be read from a replica
+                    captured = [
+                        stack.enter_context(CaptureQueriesContext(conn))
+                        for conn in connections.all()
+                    ]
+                    start = time.perf_counter()
+                    response = _request(scenario, client, rng, pks, n)
+                    latency = time.perf_counter() - start
+                with lock:
+                    result.requests += 1
+                    result.latencies.append(latency)
+                    result.queries += sum(len(c.captured_queries) for c in captured)
+                    if response.status_code >= 400:
+                        result.errors += 1
+        finally:
+            for conn in connections.all():
+                conn.close()
+
+    before = instrumentation.snapshot()
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result.elapsed = time.perf_counter() - start
+    after = instrumentation.snapshot()
+    result.encrypts = after["encrypt"] - before["encrypt"]
+    result.decrypts = after["decrypt"] - before["decrypt"]
+    if progress is not None:
+        progress(result)
+    return result
+
+
+@contextmanager
+def _file_backed_sqlite():
+    # SQLite's default in-memory test database fails concurrent writes with "table
+    # is locked" instead of waiting, so use a temporary file
+    with tempfile.TemporaryDirectory() as tmp:
+        changed = []
+        for conn in connections.all():
+            test_settings = conn.settings_dict.setdefault("TEST", {})
+            if conn.vendor == "sqlite" and not test_settings.get("NAME"):
+                test_settings["NAME"] = os.path.join(tmp, f"{conn.alias}.sqlite3")
+                changed.append(test_settings)
+        try:
+            yield
+        finally:
+            for test_settings in changed:
+                test_settings["NAME"] = None
+
+
+def run(
+    *,
+    rows: int = 10000,
+    stale: float = 0.2,
+    legacy: float = 0.1,
+    scenarios=SCENARIOS,
+    requests: int = 200,
+    concurrency: int = 4,
+    progress=None,
+) -> list[ScenarioResult]:
+    """
+    Seeds a throwaway test database and drives each of `scenarios` against it.
+    Everything is local: a generated keyset and Fernet key, no KMS, and requests go
+    through the test client rather than a socket.
+    """
+    setup_test_environment()
+    try:
+        with offline_settings(
+            TINK_FIELD_INSTRUMENTATION="tink_field.loadtest.CountingInstrumentation",
+            ALLOWED_HOSTS=["testserver"],
+        ), _file_backed_sqlite():
+            old_config = setup_databases(verbosity=0, interactive=False)
+            try:
+                seed(rows, stale=stale, legacy=legacy)
+                get_user_model().objects.create_superuser(ADMIN_USERNAME, password=None)
+                return [
+                    run_scenario(
+                        scenario,
+                        requests=requests,
+                        concurrency=concurrency,
+                        progress=progress,
+                    )
+                    for scenario in scenarios
+                ]
+            finally:
+                teardown_databases(old_config, verbosity=0)
+    finally:
+        teardown_test_environment()
@@ -0,0 +1,66 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tink_field import benchmarks
+
+
+class Command(BaseCommand):
+    help = "Benchmarks every encryptor and EncryptedField against a throwaway keyset"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            type=lambda v: [int(size) for size in v.split(",")],
+            default=list(benchmarks.SIZES),
+            help="comma separated payload sizes in bytes",
+        )
+        parser.add_argument(
+            "--only",
+            action="append",
+            help="only run cases with this name (e.g. TinkEncryptor); may be repeated",
+        )
+        parser.add_argument("--min-time", type=float, default=0.2)
+        parser.add_argument("--repeat", type=int, default=3)
+        parser.add_argument("--output", type=str, help="write JSON results here")
+        parser.add_argument("--compare", type=str, help="baseline JSON results")
+        parser.add_argument(
+            "--threshold",
+            type=float,
+            default=1.10,
+            help="slowdown ratio vs. --compare that counts as a regression",
+        )
+
+    def handle(self, *args, **options):
+        def progress(result):
+            line = (
+                f"{result.name:>20} {result.operation:>20} {result.size:>8} B "
+                f"{result.ns_per_op:>14.0f} ns/op {result.mb_per_second:>10.2f} MB/s"
+            )
+            if result.ratio is not None:
+                line += f" {result.ratio:>6.2f}x size"
+            self.stdout.write(line)
+
+        results = benchmarks.run(
+            sizes=options["sizes"],
+            min_time=options["min_time"],
+            repeat=options["repeat"],
+            only=options["only"],
+            progress=progress,
+        )
+
+        report = benchmarks.report(results)
+        if options["output"]:
+            with open(options["output"], "wt") as f:
+                json.dump(report, f, indent=2)
+
+        if options["compare"]:
+            with open(options["compare"], "rt") as f:
+                baseline = json.load(f)
+            regressions = benchmarks.compare(baseline, results, options["threshold"])
+            for key, before, after, ratio in regressions:
+                self.stdout.write(
+                    f"REGRESSION {key}: {before:.0f} -> {after:.0f} ns/op ({ratio:.2f}x)"
+                )
+            if regressions:
+                raise CommandError(f"{len(regressions)} benchmark regressions")
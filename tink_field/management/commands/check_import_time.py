@@ -0,0 +1,75 @@
+import json
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Runs in a fresh interpreter so that nothing is already imported
+_PROBE = """
+import json
+import time
+
+start = time.perf_counter()
+import django
+
+django.setup()
+setup = time.perf_counter()
+
+import tink_field.admin
+import tink_field.models
+import tink_field.views
+from tink_field import keysets
+
+done = time.perf_counter()
+print(
+    json.dumps(
+        {
+            "django_setup_ms": (setup - start) * 1000,
+            "tink_field_ms": (done - setup) * 1000,
+            "total_ms": (done - start) * 1000,
+            "primitives_built": keysets.built_primitives(),
+        }
+    )
+)
+"""
+
+
+class Command(BaseCommand):
+    help = "Checks how long importing tink_field takes against a budget"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--budget-ms",
+            type=float,
+            default=getattr(settings, "TINK_FIELD_IMPORT_BUDGET_MS", 1000),
+            help="maximum time for django.setup() plus importing tink_field",
+        )
+        parser.add_argument("--runs", type=int, default=3)
+
+    def handle(self, *args, **options):
+        results = []
+        for _ in range(options["runs"]):
+            output = subprocess.run(
+                [sys.executable, "-c", _PROBE],
+                capture_output=True,
+                text=True,
+                env=os.environ.copy(),
+            )
+            if output.returncode != 0:
+                raise CommandError(output.stderr)
+            results.append(json.loads(output.stdout.strip().splitlines()[-1]))
+
+        best = min(results, key=lambda r: r["total_ms"])
+        self.stdout.write(
+            f"django.setup(): {best['django_setup_ms']:.1f}ms, "
+            f"tink_field imports: {best['tink_field_ms']:.1f}ms, "
+            f"total: {best['total_ms']:.1f}ms (best of {len(results)}), "
+            f"budget: {options['budget_ms']:.0f}ms"
+        )
+
+        if best["primitives_built"]:
+            raise CommandError("Importing tink_field built an encryption primitive")
+        if best["total_ms"] > options["budget_ms"]:
+            raise CommandError("Import time budget exceeded")
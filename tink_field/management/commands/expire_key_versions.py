@@ -1,12 +1,17 @@
+import base64
+import json
 import re
 from datetime import timedelta, timezone, datetime
 
+from django.apps import apps
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+from django.db import router
 
 from google.cloud import kms
 
-from tink_field.encryptor import can_use_kms, kms_path
+from tink_field.keysets import can_use_kms, key_id_kind, kms_path
+from tink_field.reencryption import reencrypt_queryset
 
 # Example: 30d5h16m30s
 # Each component is optional but they must appear in that relative order
@@ -45,27 +50,133 @@ def destroy_key_version(version_name, client):
 
 
 class Command(BaseCommand):
-    help = "Expires key versions older than the cutoff"
+    help = (
+        "Expires key versions older than the cutoff, unless rows are still "
+        "encrypted under them"
+    )
 
     def add_arguments(self, parser):
         parser.add_argument("--destroy", action="store_true")
         parser.add_argument("--cutoff", type=str, default="30d")
+        parser.add_argument("--model", type=str, default="tink_field.Secret")
+        parser.add_argument(
+            "--reencrypt",
+            action="store_true",
+            help="re-encrypt rows still under the expiring versions (or under "
+            "unrecorded keys) first, instead of refusing",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="report the key census and what would be expired, then stop",
+        )
 
     def handle(self, *args, **options):
         cutoff = parse_cutoff(options["cutoff"])
         if not can_use_kms() or not cutoff:
             return
+        try:
+            model = apps.get_model(options["model"])
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+        kind = key_id_kind()
+        if kind is None:
+            raise CommandError(
+                "KmsEnvelopeAead doesn't record which KMS key version wrapped each "
+                "value, so there's no telling which rows depend on a version. Set "
+                "KMS_DEK_CACHE = True and run `reencrypt --force` to record them"
+            )
 
         client = kms.KeyManagementServiceClient()
+        primary = client.get_crypto_key(request={"name": kms_path()}).primary
         request = kms.ListCryptoKeyVersionsRequest(
             parent=kms_path(),
             filter="state=ENABLED",
         )
         key_version_iter = client.list_crypto_key_versions(request=request)
 
-        for version in key_version_iter:
-            if datetime.now(timezone.utc) - version.create_time > cutoff:
-                if options["destroy"]:
-                    destroy_key_version(version.name, client)
-                else:
-                    disable_key_version(version.name, client)
+        expiring = [
+            version.name
+            for version in key_version_iter
+            if datetime.now(timezone.utc) - version.create_time > cutoff
+            # New data keys are wrapped with the primary, so it can't go
+            and version.name != primary.name
+        ]
+        if not expiring:
+            return
+
+        if kind == "keyset":
+            self.check_keyset(client, expiring, options)
+        else:
+            self.check_rows(model, expiring, options)
+        if options["dry_run"]:
+            return
+
+        for version_name in expiring:
+            if options["destroy"]:
+                destroy_key_version(version_name, client)
+            else:
+                disable_key_version(version_name, client)
+
+    def check_keyset(self, client, expiring, options):
+        # Rows are encrypted under the keyset's tink keys, and only the keyset
+        # itself is encrypted under a KMS key version
+        with open(settings.KEYSET_FILE, "rt") as f:
+            encrypted_keyset = base64.b64decode(json.load(f)["encryptedKeyset"])
+        response = client.decrypt(
+            request={
+                "name": kms_path(),
+                "ciphertext": encrypted_keyset,
+                "additional_authenticated_data": b"",
+            }
+        )
+        if options["dry_run"]:
+            wrapped_by = "the primary" if response.used_primary else "an older"
+            self.stdout.write(
+                f"Would expire {len(expiring)} key versions; KEYSET_FILE is "
+                f"encrypted under {wrapped_by} key version"
+            )
+        elif not response.used_primary:
+            raise CommandError(
+                "KEYSET_FILE is encrypted under a key version other than the "
+                "primary, which may be expiring; encrypt it under the primary "
+                "version first"
+            )
+
+    def check_rows(self, model, expiring, options):
+        # Rows record the KMS key version that wrapped their data key. Count them
+        # where they're written, since a lagging replica can miss rows just
+        # written under a version that's about to go
+        queryset = model._default_manager.using(router.db_for_write(model))
+        for field_name, counts in queryset.key_census().items():
+            for key_id, count in sorted(counts.items(), key=lambda kv: str(kv[0])):
+                marker = " (expiring)" if key_id in expiring else ""
+                self.stdout.write(
+                    f"{field_name}: {key_id or 'unknown'}: {count} rows{marker}"
+                )
+
+        # Rows whose key wasn't recorded might be under an expiring version too
+        dependent = queryset.encrypted_under(expiring, unknown=True)
+        count = dependent.count()
+        if options["dry_run"]:
+            self.stdout.write(
+                f"Would expire {len(expiring)} key versions; {count} rows depend on "
+                "them or on unrecorded keys"
+            )
+            return
+        if count and not options["reencrypt"]:
+            raise CommandError(
+                f"{count} rows are still encrypted under expiring key versions or "
+                "under unrecorded keys; rerun with --reencrypt to move them first"
+            )
+        if count:
+            stats = reencrypt_queryset(dependent, force=True)
+            self.stdout.write(
+                f"Re-encrypted {stats.reencrypted} rows in {stats.elapsed:.2f}s"
+            )
+            remaining = queryset.encrypted_under(expiring, unknown=True).count()
+            if remaining:
+                raise CommandError(
+                    f"{remaining} rows still depend on expiring key versions "
+                    f"(failed to decrypt: {stats.failed_pks}); not expiring them"
+                )
@@ -0,0 +1,58 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tink_field.ingest import import_secrets
+
+
+class Command(BaseCommand):
+    help = 'Creates secrets from a JSONL file of {"name": ..., "secret": ...} lines'
+
+    def add_arguments(self, parser):
+        parser.add_argument("input_file", type=str, help='path, or "-" for stdin')
+        parser.add_argument("--chunk-size", type=int, default=500)
+        parser.add_argument("--workers", type=int, default=4)
+        parser.add_argument(
+            "--reject-file",
+            type=str,
+            default=None,
+            help="where to write lines that couldn't be imported, with the reason",
+        )
+
+    def handle(self, *args, **options):
+        def progress(stats):
+            self.stdout.write(
+                f"{stats.read} lines read, {stats.imported} imported, "
+                f"{stats.rejected} rejected ({stats.rows_per_second:.1f} rows/sec)"
+            )
+
+        try:
+            if options["input_file"] == "-":
+                input_file = sys.stdin
+            else:
+                input_file = open(options["input_file"], "rt", encoding="utf-8")
+            rejects = None
+            if options["reject_file"] is not None:
+                rejects = open(options["reject_file"], "wt", encoding="utf-8")
+        except OSError as e:
+            raise CommandError(str(e))
+
+        try:
+            stats = import_secrets(
+                input_file,
+                chunk_size=options["chunk_size"],
+                workers=options["workers"],
+                rejects=rejects,
+                progress=progress,
+            )
+        finally:
+            if input_file is not sys.stdin:
+                input_file.close()
+            if rejects is not None:
+                rejects.close()
+
+        self.stdout.write(
+            f"Done: {stats.imported} of {stats.read} lines imported, "
+            f"{stats.rejected} rejected in {stats.elapsed:.2f}s "
+            f"({stats.rows_per_second:.1f} rows/sec)"
+        )
@@ -0,0 +1,72 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tink_field import loadtest
+
+
+class Command(BaseCommand):
+    help = (
+        "Seeds a throwaway database and load tests the create view and admin "
+        "changelist, offline"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=10000)
+        parser.add_argument(
+            "--stale",
+            type=float,
+            default=0.2,
+            help="fraction of seeded rows past their re-encryption window",
+        )
+        parser.add_argument(
+            "--legacy",
+            type=float,
+            default=0.1,
+            help="fraction of seeded rows encrypted with the legacy Fernet key only",
+        )
+        parser.add_argument(
+            "--scenario",
+            dest="scenarios",
+            action="append",
+            choices=loadtest.SCENARIOS,
+            help="scenario to run; may be repeated (default: all)",
+        )
+        parser.add_argument("--requests", type=int, default=200)
+        parser.add_argument("--concurrency", type=int, default=4)
+        parser.add_argument("--output", type=str, help="write JSON results here")
+
+    def handle(self, *args, **options):
+        if options["stale"] + options["legacy"] > 1:
+            raise CommandError("--stale and --legacy add up to more than 1")
+
+        def progress(result):
+            report = result.report()
+            self.stdout.write(
+                f"{report['scenario']:>18}: {report['requests']} requests "
+                f"({report['errors']} errors), "
+                f"{report['requests_per_second']:.1f} req/s, "
+                f"p50 {report['p50_ms']:.1f} ms, p95 {report['p95_ms']:.1f} ms, "
+                f"p99 {report['p99_ms']:.1f} ms, "
+                f"{report['queries_per_request']:.1f} queries/req, "
+                f"{report['encrypts_per_request']:.1f} encrypts/req, "
+                f"{report['decrypts_per_request']:.1f} decrypts/req"
+            )
+
+        self.stdout.write(
+            f"Seeding {options['rows']} rows and running "
+            f"{options['requests']} requests per scenario at concurrency "
+            f"{options['concurrency']}"
+        )
+        results = loadtest.run(
+            rows=options["rows"],
+            stale=options["stale"],
+            legacy=options["legacy"],
+            scenarios=options["scenarios"] or loadtest.SCENARIOS,
+            requests=options["requests"],
+            concurrency=options["concurrency"],
+            progress=progress,
+        )
+        if options["output"]:
+            with open(options["output"], "wt") as f:
+                json.dump([result.report() for result in results], f, indent=2)
@@ -0,0 +1,66 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from tink_field.reencryption import rebuild_blind_indexes
+
+
+class Command(BaseCommand):
+    help = "Recomputes blind index columns for encrypted fields in chunks"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--model", type=str, default="tink_field.Secret")
+        parser.add_argument(
+            "--field",
+            dest="fields",
+            action="append",
+            help="blind-indexed field to rebuild; may be repeated (default: all)",
+        )
+        parser.add_argument("--chunk-size", type=int, default=500)
+        parser.add_argument(
+            "--missing-only",
+            action="store_true",
+            help="only fill in rows without an index (e.g. written before a key was set)",
+        )
+        parser.add_argument(
+            "--checkpoint-file",
+            type=str,
+            default=None,
+            help="records progress so an interrupted run can be resumed",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options["model"])
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+
+        def progress(stats):
+            self.stdout.write(
+                f"{stats.scanned} rows scanned, {stats.updated} updated, "
+                f"{stats.failed} failed ({stats.rows_per_second:.1f} rows/sec)"
+            )
+
+        try:
+            stats = rebuild_blind_indexes(
+                model._default_manager.all(),
+                options["fields"],
+                chunk_size=options["chunk_size"],
+                missing_only=options["missing_only"],
+                checkpoint=options["checkpoint_file"],
+                progress=progress,
+            )
+        except Exception as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(
+            f"Done: {stats.scanned} rows scanned, {stats.updated} updated, "
+            f"{stats.failed} failed in {stats.elapsed:.2f}s "
+            f"({stats.rows_per_second:.1f} rows/sec)"
+        )
+        if stats.skipped:
+            self.stdout.write(
+                f"{stats.skipped} rows changed while being indexed and were left as "
+                "they are"
+            )
+        if stats.failed_pks:
+            self.stdout.write(f"Failed to decrypt: {stats.failed_pks}")
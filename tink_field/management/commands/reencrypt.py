@@ -0,0 +1,68 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from tink_field.reencryption import reencrypt_queryset
+
+
+class Command(BaseCommand):
+    help = "Re-encrypts stale encrypted fields in bulk"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--model", type=str, default="tink_field.Secret")
+        parser.add_argument(
+            "--field",
+            dest="fields",
+            action="append",
+            help="encrypted field to re-encrypt; may be repeated (default: all)",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="re-encrypt every row, not just stale ones (e.g. to record key IDs)",
+        )
+        parser.add_argument("--chunk-size", type=int, default=500)
+        parser.add_argument("--workers", type=int, default=4)
+        parser.add_argument(
+            "--checkpoint-file",
+            type=str,
+            default=None,
+            help="records progress so an interrupted run can be resumed",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options["model"])
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+
+        def progress(stats):
+            self.stdout.write(
+                f"{stats.scanned} rows scanned, {stats.reencrypted} re-encrypted, "
+                f"{stats.failed} failed ({stats.rows_per_second:.1f} rows/sec)"
+            )
+
+        try:
+            stats = reencrypt_queryset(
+                model._default_manager.all(),
+                options["fields"],
+                chunk_size=options["chunk_size"],
+                workers=options["workers"],
+                checkpoint=options["checkpoint_file"],
+                progress=progress,
+                force=options["force"],
+            )
+        except Exception as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(
+            f"Done: {stats.scanned} rows scanned, {stats.reencrypted} re-encrypted, "
+            f"{stats.failed} failed in {stats.elapsed:.2f}s "
+            f"({stats.rows_per_second:.1f} rows/sec)"
+        )
+        if stats.skipped:
+            self.stdout.write(
+                f"{stats.skipped} values changed while being re-encrypted and were "
+                "left as they are"
+            )
+        if stats.failed_pks:
+            self.stdout.write(f"Failed to decrypt: {stats.failed_pks}")
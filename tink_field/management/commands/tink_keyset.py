@@ -5,9 +5,10 @@ from django.conf import settings
 import tink
 from tink import aead
 from tink import secret_key_access
+from tink import streaming_aead
 from tink.integration import gcpkms
 
-from tink_field.encryptor import can_use_kms, kms_path
+from tink_field.keysets import can_use_kms, kms_path
 
 
 class Command(BaseCommand):
@@ -16,12 +17,23 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument("--force-plaintext", action="store_true")
         parser.add_argument("--output-file", type=str, required=True)
+        parser.add_argument(
+            "--streaming",
+            action="store_true",
+            help="Create a streaming AEAD keyset for STREAMING_KEYSET_FILE",
+        )
 
     def handle(self, *args, **options):
         use_plaintext = options["force_plaintext"] or not can_use_kms()
 
-        aead.register()
-        key_template = aead.aead_key_templates.AES128_GCM
+        if options["streaming"]:
+            streaming_aead.register()
+            key_template = (
+                streaming_aead.streaming_aead_key_templates.AES256_GCM_HKDF_1MB
+            )
+        else:
+            aead.register()
+            key_template = aead.aead_key_templates.AES128_GCM
         keyset_handle = tink.new_keyset_handle(key_template)
 
         if use_plaintext:
@@ -0,0 +1,206 @@
+from django.db import models
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from .batch import decrypt_instances
+from .encrypted_field import attach_peers, deferred_columns, encrypted_fields
+
+
+class EncryptedQuerySet(models.QuerySet):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._decrypted_fields = ()
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._decrypted_fields = self._decrypted_fields
+        return clone
+
+    def _encrypted_fields(self, field_names):
+        fields = encrypted_fields(self.model)
+        for name in field_names:
+            if name not in fields:
+                raise Exception(
+                    f"{self.model._meta.label} has no encrypted field {name}"
+                )
+        if not field_names:
+            return fields
+        return {name: fields[name] for name in field_names}
+
+    def stale(self, *field_names):
+        """
+        Rows where any of `field_names` (default: every `EncryptedField`) needs
+        re-encryption, filtered in SQL without decrypting anything.
+        """
+        now = timezone.now()
+        stale = Q()
+        for field in self._encrypted_fields(field_names).values():
+            stale |= field.stale_q(now)
+        return self.filter(stale)
+
+    def annotate_needs_reencryption(self, *field_names):
+        """
+        Annotates each row with a `<field>_needs_reencryption` boolean per field in
+        `field_names` (default: every `EncryptedField`).
+        """
+        now = timezone.now()
+        return self.annotate(
+            **{
+                f"{name}_needs_reencryption": field.needs_reencryption_expression(now)
+                for name, field in self._encrypted_fields(field_names).items()
+            }
+        )
+
+    def filter_encrypted(self, **values):
+        """
+        Equality filter on decrypted values, e.g.
+        `filter_encrypted(plaintext_from_b64="hunter2")`, answered from each field's
+        blind index column without decrypting anything.
+        """
+        filters = {}
+        for name, field in self._encrypted_fields(list(values)).items():
+            if field.blind_index_attr is None:
+                raise Exception(
+                    f"{self.model._meta.label}.{name} has no blind index column"
+                )
+            filters[field.blind_index_attr] = field.blind_index(values[name])
+        return self.filter(**filters)
+
+    def _key_id_fields(self, field_names):
+        fields = {}
+        for name, field in self._encrypted_fields(field_names).items():
+            if field.key_id_attr is not None:
+                fields[name] = field
+            elif field_names:
+                raise Exception(f"{self.model._meta.label}.{name} has no key ID column")
+        return fields
+
+    def key_census(self, *field_names) -> dict[str, dict[str | None, int]]:
+        """
+        Counts rows per encryption key for each of `field_names` (default: every
+        `EncryptedField` with a `key_id_attr`), with one aggregate query per field
+        and no decryption: `{"plaintext_from_b64": {"<key ID>": 120, None: 3}}`.
+        `None` counts values whose key isn't known, e.g. ones written before the key
+        ID column existed.
+        """
+        census = {}
+        for name, field in self._key_id_fields(field_names).items():
+            rows = (
+                self.filter(**{f"{field.ciphertext_attr}__isnull": False})
+                .order_by()
+                .values_list(field.key_id_attr)
+                .annotate(count=Count("pk"))
+            )
+            census[name] = dict(rows)
+        return census
+
+    def encrypted_under(self, key_ids, *field_names, unknown: bool = False):
+        """
+        Rows where any of `field_names` (default: every `EncryptedField` with a
+        `key_id_attr`) is encrypted under one of `key_ids`, or, with `unknown`,
+        under a key that wasn't recorded.
+        """
+        under = Q()
+        for field in self._key_id_fields(field_names).values():
+            under |= Q(**{f"{field.key_id_attr}__in": list(key_ids)})
+            if unknown:
+                under |= Q(
+                    **{
+                        f"{field.key_id_attr}__isnull": True,
+                        f"{field.ciphertext_attr}__isnull": False,
+                    }
+                )
+        return self.filter(under)
+
+    def with_ciphertext(self, *field_names):
+        """
+        Loads the ciphertext columns of `field_names` (default: every
+        `EncryptedField`) with the rows instead of deferring them.
+        """
+        columns = set()
+        for field in self._encrypted_fields(field_names).values():
+            columns.update(field.deferred_columns)
+        clone = self._chain()
+        # There is no public way to undo part of a `.defer()`
+        existing, defer = clone.query.deferred_loading
+        if defer:
+            clone.query.deferred_loading = (frozenset(existing - columns), True)
+        else:
+            clone.query.deferred_loading = (frozenset(existing | columns), False)
+        return clone
+
+    def only(self, *fields):
+        # Django keeps fields from an earlier `.defer()` deferred even if they are
+        # passed to `.only()`; undo `EncryptedManager`'s default deferral for them
+        clone = self._chain()
+        existing, defer = clone.query.deferred_loading
+        if defer:
+            clone.query.deferred_loading = (
+                frozenset(existing.difference(fields)),
+                True,
+            )
+        return super(EncryptedQuerySet, clone).only(*fields)
+
+    def decrypted(self, *field_names):
+        """
+        Decrypts `field_names` (default: every `EncryptedField`) for every fetched
+        row in one batch on the shared decryption pool, so reading those
+        `EncryptedField`s afterwards is free. With `.iterator(chunk_size)`, each
+        chunk is decrypted as it is fetched.
+        """
+        field_names = tuple(self._encrypted_fields(field_names))
+        # Every row's ciphertext is about to be read, so fetch it up front
+        clone = self.with_ciphertext(*field_names)
+        clone._decrypted_fields = clone._decrypted_fields + tuple(
+            name for name in field_names if name not in clone._decrypted_fields
+        )
+        return clone
+
+    def _decrypt_batch(self, instances):
+        instances = [obj for obj in instances if isinstance(obj, self.model)]
+        decrypt_instances(instances, self._decrypted_fields)
+
+    def _fetch_all(self):
+        populate = self._result_cache is None
+        super()._fetch_all()
+        if populate:
+            attach_peers(
+                [obj for obj in self._result_cache if isinstance(obj, self.model)]
+            )
+        if populate and self._decrypted_fields:
+            self._decrypt_batch(self._result_cache)
+
+    def _process_chunk(self, chunk):
+        attach_peers([obj for obj in chunk if isinstance(obj, self.model)])
+        if self._decrypted_fields:
+            self._decrypt_batch(chunk)
+
+    def iterator(self, chunk_size=None):
+        if chunk_size is None:
+            chunk_size = 2000
+        chunk = []
+        for obj in super().iterator(chunk_size):
+            chunk.append(obj)
+            if len(chunk) >= chunk_size:
+                self._process_chunk(chunk)
+                yield from chunk
+                chunk = []
+        self._process_chunk(chunk)
+        yield from chunk
+
+
+class EncryptedManager(models.Manager.from_queryset(EncryptedQuerySet)):
+    """
+    Defers the ciphertext columns of `EncryptedField`s (unless they were declared
+    with `deferred=False`) so list queries don't fetch them. The first read of an
+    encrypted field loads the deferred columns for every row of that queryset in
+    one query. Use `.with_ciphertext()`, `.decrypted()` or `.only()` to load them
+    up front instead.
+    """
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        columns = deferred_columns(self.model)
+        if columns:
+            queryset = queryset.defer(*columns)
+        return queryset
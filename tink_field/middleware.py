@@ -0,0 +1,31 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from .coalesce import coalesce_reencryption
+
+
+class CoalesceReencryptionMiddleware:
+    """
+    Writes the re-encryptions triggered while handling a request once per instance,
+    after the view returns (see `coalesce.coalesce_reencryption`). Bodies of
+    streaming responses are produced after this runs, so reads there aren't
+    coalesced.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        with coalesce_reencryption():
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        async with coalesce_reencryption():
+            return await self.get_response(request)
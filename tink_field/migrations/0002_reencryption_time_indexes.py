@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tink_field", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="secret",
+            index=models.Index(
+                fields=["binary_reencryption_time"], name="secret_binary_reenc_time_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="secret",
+            index=models.Index(
+                fields=["b64_reencryption_time"], name="secret_b64_reenc_time_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="secret",
+            index=models.Index(
+                fields=["json_reencryption_time"], name="secret_json_reenc_time_idx"
+            ),
+        ),
+    ]
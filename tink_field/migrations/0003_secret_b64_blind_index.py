@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tink_field", "0002_reencryption_time_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="secret",
+            name="b64_blind_index",
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tink_field", "0003_secret_b64_blind_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="secret",
+            name="encrypted_file",
+            field=models.FileField(blank=True, null=True, upload_to="secrets"),
+        ),
+    ]
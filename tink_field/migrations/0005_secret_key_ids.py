@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tink_field", "0004_secret_encrypted_file"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="secret",
+            name="b64_key_id",
+            field=models.CharField(
+                blank=True, db_index=True, max_length=255, null=True
+            ),
+        ),
+        migrations.AddField(
+            model_name="secret",
+            name="binary_key_id",
+            field=models.CharField(
+                blank=True, db_index=True, max_length=255, null=True
+            ),
+        ),
+        migrations.AddField(
+            model_name="secret",
+            name="json_key_id",
+            field=models.CharField(
+                blank=True, db_index=True, max_length=255, null=True
+            ),
+        ),
+    ]
@@ -1,14 +1,15 @@
-import copy
 from datetime import timedelta
 from typing import Any
 
 from django.db import models
 
+from .blind_index import BLIND_INDEX_LENGTH
 from .tink_encryptor import get_encryptor as tink_encryptor
-from .b64_encryptor import B64Encryptor
 from .b64_encryptor import get_encryptor as b64_encryptor
+from .json_encryptor import JsonEncryptor, JsonValuesEncryptor
 from .legacy_encryptor import get_encryptor as legacy_encryptor
-from .encrypted_field import EncryptedField, EncryptorInterface
+from .encrypted_field import EncryptedField, EncryptedFieldsMixin, EncryptorInterface
+from .managers import EncryptedManager
 
 
 class PlaintextEncryptor(EncryptorInterface):
@@ -19,61 +20,76 @@ class PlaintextEncryptor(EncryptorInterface):
         return ciphertext
 
 
-class JsonEncryptor(B64Encryptor):
-    def __init__(self):
-        super().__init__()
-
-    def encrypt(
-        self, plaintext_dict: dict[Any, Any], associated_data: str | bytes = b""
-    ) -> dict[Any, Any]:
-        ciphertext = super().encrypt(plaintext_dict["secret"], associated_data)
-        ciphertext_dict = copy.deepcopy(plaintext_dict)
-        ciphertext_dict["secret"] = ciphertext
-        return ciphertext_dict
-
-    def decrypt(
-        self, ciphertext_dict: dict[Any, Any], associated_data: str | bytes = b""
-    ) -> dict[Any, Any]:
-        plaintext = super().encrypt(ciphertext_dict["secret"], associated_data)
-        plaintext_dict = copy.deepcopy(ciphertext_dict)
-        plaintext_dict["secret"] = plaintext
-        return plaintext_dict
-
-
-class Secret(models.Model):
+class Secret(EncryptedFieldsMixin, models.Model):
     name = models.CharField(max_length=50)
     _plaintext_secret = models.CharField(max_length=50, db_column="plaintext_secret")
     _plaintext_json = models.JSONField(db_column="plaintext_json")
 
     binary_encrypted_secret = models.BinaryField(blank=True, null=True)
     binary_reencryption_time = models.DateTimeField(blank=True, null=True)
+    binary_key_id = models.CharField(
+        max_length=255, blank=True, null=True, db_index=True
+    )
     plaintext_from_binary = EncryptedField(
         encryptor=tink_encryptor(),
         ciphertext_attr="binary_encrypted_secret",
         last_reencryption_time_attr="binary_reencryption_time",
+        key_id_attr="binary_key_id",
         fallback_encryptor=None,
         reencryption_window=timedelta(days=30),
+        reencryption_jitter=0.2,
         associated_data_attr="name",
     )
 
     b64_encrypted_secret = models.CharField(max_length=1000)
     b64_reencryption_time = models.DateTimeField(blank=True, null=True)
+    b64_key_id = models.CharField(max_length=255, blank=True, null=True, db_index=True)
+    b64_blind_index = models.CharField(
+        max_length=BLIND_INDEX_LENGTH, blank=True, null=True, db_index=True
+    )
     plaintext_from_b64 = EncryptedField(
         encryptor=b64_encryptor(),
         ciphertext_attr="b64_encrypted_secret",
         last_reencryption_time_attr="b64_reencryption_time",
+        blind_index_attr="b64_blind_index",
+        key_id_attr="b64_key_id",
         fallback_encryptor=legacy_encryptor(),
         reencryption_window=timedelta(days=30),
+        reencryption_jitter=0.2,
         associated_data_attr="name",
     )
 
     json_with_encrypted_secret = models.JSONField()
     json_reencryption_time = models.DateTimeField(blank=True, null=True)
+    json_key_id = models.CharField(max_length=255, blank=True, null=True, db_index=True)
     plaintext_from_json = EncryptedField(
-        encryptor=JsonEncryptor(),
+        encryptor=JsonEncryptor(paths=["secret"]),
         ciphertext_attr="json_with_encrypted_secret",
         last_reencryption_time_attr="json_reencryption_time",
-        fallback_encryptor=legacy_encryptor(),
+        key_id_attr="json_key_id",
+        fallback_encryptor=JsonValuesEncryptor(legacy_encryptor(), paths=["secret"]),
         reencryption_window=timedelta(days=30),
+        reencryption_jitter=0.2,
         associated_data_attr="name",
     )
+
+    # Large binary secrets, streamed through `streaming.StreamingEncryptor` with
+    # `name` as associated data. Holds the storage name of the ciphertext
+    encrypted_file = models.FileField(upload_to="secrets", blank=True, null=True)
+
+    objects = EncryptedManager()
+
+    class Meta:
+        # For `Secret.objects.stale()` and bulk re-encryption
+        indexes = [
+            models.Index(
+                fields=["binary_reencryption_time"],
+                name="secret_binary_reenc_time_idx",
+            ),
+            models.Index(
+                fields=["b64_reencryption_time"], name="secret_b64_reenc_time_idx"
+            ),
+            models.Index(
+                fields=["json_reencryption_time"], name="secret_json_reenc_time_idx"
+            ),
+        ]
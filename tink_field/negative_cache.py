@@ -0,0 +1,144 @@
+import hashlib
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import tink
+from cryptography.fernet import InvalidToken
+from django.conf import settings
+from django.core.signals import setting_changed
+
+# Settings that can make a previously undecryptable ciphertext decryptable
+KEY_SETTINGS = (
+    "GCP_CREDENTIAL_FILE",
+    "GCP_PROJECT_ID",
+    "KMS_LOCATION_ID",
+    "KMS_KEY_RING_ID",
+    "KMS_KEY_ID",
+    "KEYSET_FILE",
+    "LOCAL_KMS_LATENCY",
+    "LEGACY_KEY",
+    "DECRYPT_NEGATIVE_CACHE_SIZE",
+    "DECRYPT_NEGATIVE_CACHE_TTL",
+)
+
+
+def ciphertext_bytes(ciphertext) -> bytes:
+    # Any column value as bytes, for hashing
+    match ciphertext:
+        case bytes():
+            return ciphertext
+        case bytearray() | memoryview():
+            return bytes(ciphertext)
+        case str():
+            return ciphertext.encode("utf-8")
+        case _:
+            return json.dumps(ciphertext, sort_keys=True, default=str).encode("utf-8")
+
+
+# What encryptors raise for a ciphertext that is corrupt, tampered with or under a
+# key they don't have. Anything else says nothing about the ciphertext itself.
+_UNDECRYPTABLE = (tink.TinkError, InvalidToken, ValueError, TypeError, KeyError)
+
+
+def _remote(error) -> bool:
+    if isinstance(error, OSError):
+        # Includes timeouts and connection errors
+        return True
+    # Only loaded if a KMS client was, and then wrapped in a `tink.TinkError`
+    api_core = sys.modules.get("google.api_core.exceptions")
+    return api_core is not None and isinstance(error, api_core.GoogleAPIError)
+
+
+def undecryptable(error) -> bool:
+    """
+    Whether a decryption `error` means the ciphertext can't be decrypted with the
+    current keys, as opposed to the attempt failing, e.g. a KMS call timing out.
+    Only the former belong in the negative cache.
+    """
+    if not isinstance(error, _UNDECRYPTABLE):
+        return False
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if _remote(error) or any(_remote(arg) for arg in error.args):
+            return False
+        error = error.__cause__ or error.__context__
+    return True
+
+
+class NegativeCache:
+    """
+    Bounded LRU of ciphertexts that no encryptor could decrypt, so repeated reads
+    of a bad value fail immediately instead of trying every encryptor again.
+    Entries expire after `ttl` seconds in case a key is added in the meantime.
+
+    Only hashes are stored, never ciphertexts.
+    """
+
+    def __init__(self, size: int = 1000, ttl: float = 300.0):
+        self.size = size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> expiry
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def key(label: str, ciphertext, associated_data: bytes) -> bytes:
+        h = hashlib.blake2b(digest_size=16)
+        for part in (label.encode("utf-8"), ciphertext_bytes(ciphertext)):
+            h.update(len(part).to_bytes(8, "big"))
+            h.update(part)
+        h.update(associated_data)
+        return h.digest()
+
+    def __contains__(self, key: bytes) -> bool:
+        with self._lock:
+            expiry = self._entries.get(key)
+            if expiry is None:
+                return False
+            if expiry <= time.monotonic():
+                del self._entries[key]
+                return False
+            return True
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, key: bytes):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = time.monotonic() + self.ttl
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_negative_cache: NegativeCache = None
+
+
+def get_negative_cache() -> NegativeCache:
+    global _negative_cache
+    if _negative_cache is None:
+        _negative_cache = NegativeCache(
+            size=getattr(settings, "DECRYPT_NEGATIVE_CACHE_SIZE", 1000),
+            ttl=getattr(settings, "DECRYPT_NEGATIVE_CACHE_TTL", 300.0),
+        )
+
+    return _negative_cache
+
+
+def _reset(*, setting, **kwargs):
+    global _negative_cache
+    if setting in KEY_SETTINGS:
+        _negative_cache = None
+
+
+setting_changed.connect(_reset)
@@ -0,0 +1,64 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+
+
+class TokenBucket:
+    """
+    Allows `rate` operations per second on average, in bursts of up to `burst`.
+    With `rate=None` everything is allowed.
+    """
+
+    def __init__(self, rate: float | None, burst: float | None = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate or 0.0)
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+
+    def acquire(self) -> bool:
+        """
+        Takes a token if one is available. Never blocks.
+        """
+        if self.rate is None:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+_budget: TokenBucket = None
+
+
+def get_reencryption_budget() -> TokenBucket:
+    """
+    This process's budget for re-encryptions made by reads of stale
+    `EncryptedField`s (`REENCRYPTION_RATE_LIMIT` per second, bursts of
+    `REENCRYPTION_RATE_BURST`). Bulk re-encryption isn't limited by it.
+    """
+    global _budget
+    if _budget is None:
+        _budget = TokenBucket(
+            rate=getattr(settings, "REENCRYPTION_RATE_LIMIT", None),
+            burst=getattr(settings, "REENCRYPTION_RATE_BURST", None),
+        )
+
+    return _budget
+
+
+def _reset(*, setting, **kwargs):
+    global _budget
+    if setting in ("REENCRYPTION_RATE_LIMIT", "REENCRYPTION_RATE_BURST"):
+        _budget = None
+
+
+setting_changed.connect(_reset)
@@ -0,0 +1,305 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from django.db import router
+from django.db.models import Q
+from django.utils import timezone
+
+from . import blind_index
+from .batch import decrypt_instances
+from .coalesce import unchanged_q
+from .encrypted_field import encrypted_fields
+
+
+@dataclass
+class ReencryptionStats:
+    scanned: int = 0
+    reencrypted: int = 0
+    failed: int = 0
+    # Field values not written because the row changed while being re-encrypted
+    skipped: int = 0
+    last_pk: int | None = None
+    elapsed: float = 0.0
+    failed_pks: list = field(default_factory=list)
+
+    @property
+    def rows_per_second(self) -> float:
+        if self.elapsed == 0:
+            return 0.0
+        return self.scanned / self.elapsed
+
+
+def _load_checkpoint(path, model, field_names):
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path, "rt") as f:
+        checkpoint = json.load(f)
+    if (
+        checkpoint.get("model") != model._meta.label
+        or checkpoint.get("fields") != field_names
+    ):
+        raise Exception(f"Checkpoint {path} was written for a different run")
+    return checkpoint.get("last_pk")
+
+
+def _save_checkpoint(path, model, field_names, last_pk):
+    if path is None:
+        return
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wt") as f:
+        json.dump(
+            {"model": model._meta.label, "fields": field_names, "last_pk": last_pk}, f
+        )
+    os.replace(tmp_path, path)
+
+
+def _write_unchanged(model, f, changed_objs) -> int:
+    # One `bulk_update` of `f`'s columns, applied only to rows whose re-encryption
+    # time (and ciphertext) are still the ones they were read with, so a
+    # concurrent save isn't overwritten with the old value. Returns how many rows
+    # were left alone.
+    unchanged = Q()
+    for obj, expected in changed_objs:
+        unchanged |= unchanged_q(obj.pk, expected)
+    objs = [obj for obj, _ in changed_objs]
+    updated = model._base_manager.filter(unchanged).bulk_update(
+        objs, f.reencryption_columns
+    )
+    return len(objs) - updated
+
+
+def reencrypt_queryset(
+    queryset,
+    field_names: list[str] | None = None,
+    *,
+    chunk_size: int = 500,
+    workers: int = 4,
+    checkpoint: str | None = None,
+    progress=None,
+    force: bool = False,
+) -> ReencryptionStats:
+    """
+    Re-encrypts every row in `queryset` with at least one stale `EncryptedField`.
+
+    Rows are selected in primary key order, `chunk_size` at a time, using each
+    field's `last_reencryption_time_attr`. Decryption and re-encryption happen on a
+    pool of `workers` threads and results are written back with one `bulk_update`
+    per field per chunk. If `checkpoint` is a path, the last primary key written is
+    recorded there after every chunk so an interrupted run can resume; the file is
+    removed once the run completes. `progress`, if given, is called with the
+    running `ReencryptionStats` after every chunk.
+
+    With `force`, every row in `queryset` is re-encrypted whether it's stale or not,
+    e.g. to move rows off a key version (see `EncryptedQuerySet.encrypted_under`).
+
+    Rows that fail to decrypt are left untouched and reported in `failed_pks`. Rows
+    saved by someone else while their chunk was being re-encrypted keep the new
+    value; their fields are counted in `skipped`.
+    """
+    model = queryset.model
+    # Rows are read to be written back, so read them where the writes go rather
+    # than from a replica that may be behind
+    queryset = queryset.using(router.db_for_write(model))
+    all_fields = encrypted_fields(model)
+    if field_names is None:
+        field_names = list(all_fields)
+    for name in field_names:
+        if name not in all_fields:
+            raise Exception(f"{model._meta.label} has no encrypted field {name}")
+    fields = {name: all_fields[name] for name in field_names}
+
+    columns = {"pk"}
+    for f in fields.values():
+        columns.update([f.ciphertext_attr, f.last_reencryption_time_attr])
+        if f.associated_data_attr is not None:
+            columns.add(f.associated_data_attr)
+
+    if not force:
+        now = timezone.now()
+        stale = Q()
+        for f in fields.values():
+            stale |= f.stale_q(now)
+        queryset = queryset.filter(stale)
+    queryset = queryset.only(*columns).order_by("pk")
+
+    def reencrypt_row(obj):
+        # field name -> the columns it was read with, for the conditional write
+        changed = {}
+        failed = False
+        for name, f in fields.items():
+            if not force and not f.needs_reencryption(obj):
+                continue
+            expected = f._expected(obj)
+            try:
+                if f.reencrypt(obj):
+                    changed[name] = expected
+            except Exception:
+                failed = True
+        return changed, failed
+
+    stats = ReencryptionStats(last_pk=_load_checkpoint(checkpoint, model, field_names))
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            chunk_qs = queryset
+            if stats.last_pk is not None:
+                chunk_qs = chunk_qs.filter(pk__gt=stats.last_pk)
+            chunk = list(chunk_qs[:chunk_size])
+            if not chunk:
+                break
+
+            futures = [(obj, executor.submit(reencrypt_row, obj)) for obj in chunk]
+            changed_by_field = {name: [] for name in fields}
+            for obj, future in futures:
+                changed, failed = future.result()
+                if failed:
+                    stats.failed += 1
+                    stats.failed_pks.append(obj.pk)
+                for name, expected in changed.items():
+                    changed_by_field[name].append((obj, expected))
+                if changed:
+                    stats.reencrypted += 1
+
+            for name, changed_objs in changed_by_field.items():
+                if changed_objs:
+                    stats.skipped += _write_unchanged(model, fields[name], changed_objs)
+
+            stats.scanned += len(chunk)
+            stats.last_pk = chunk[-1].pk
+            stats.elapsed = time.monotonic() - start
+            _save_checkpoint(checkpoint, model, field_names, stats.last_pk)
+            if progress is not None:
+                progress(stats)
+
+    stats.elapsed = time.monotonic() - start
+    if checkpoint is not None and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return stats
+
+
+@dataclass
+class RebuildStats:
+    scanned: int = 0
+    updated: int = 0
+    failed: int = 0
+    skipped: int = 0
+    last_pk: int | None = None
+    elapsed: float = 0.0
+    failed_pks: list = field(default_factory=list)
+
+    @property
+    def rows_per_second(self) -> float:
+        if self.elapsed == 0:
+            return 0.0
+        return self.scanned / self.elapsed
+
+
+def rebuild_blind_indexes(
+    queryset,
+    field_names: list[str] | None = None,
+    *,
+    chunk_size: int = 500,
+    missing_only: bool = False,
+    checkpoint: str | None = None,
+    progress=None,
+) -> RebuildStats:
+    """
+    Recomputes the blind index of every row in `queryset` for `field_names`
+    (default: every `EncryptedField` with a `blind_index_attr`), e.g. after changing
+    `BLIND_INDEX_KEY` or adding a blind index to an existing field.
+
+    Rows are processed in primary key order, `chunk_size` at a time; each chunk is
+    decrypted on the shared decryption pool and written back with one `bulk_update`.
+    With `missing_only`, only rows whose index is null are visited. `checkpoint` and
+    `progress` work like they do for `reencrypt_queryset`. Rows that fail to decrypt
+    are left untouched and reported in `failed_pks`. Rows saved by someone else
+    while their chunk was being processed keep their new index and are counted in
+    `skipped`.
+    """
+    model = queryset.model
+    queryset = queryset.using(router.db_for_write(model))
+    all_fields = {
+        name: f for name, f in encrypted_fields(model).items() if f.blind_index_attr
+    }
+    if field_names is None:
+        field_names = list(all_fields)
+    for name in field_names:
+        if name not in all_fields:
+            raise Exception(f"{model._meta.label} has no blind-indexed field {name}")
+    fields = {name: all_fields[name] for name in field_names}
+    blind_index.get_key()
+
+    columns = {"pk"}
+    for f in fields.values():
+        columns.update(
+            [f.ciphertext_attr, f.last_reencryption_time_attr, f.blind_index_attr]
+        )
+        if f.associated_data_attr is not None:
+            columns.add(f.associated_data_attr)
+    if missing_only:
+        missing = Q()
+        for f in fields.values():
+            missing |= Q(**{f"{f.blind_index_attr}__isnull": True})
+        queryset = queryset.filter(missing)
+    queryset = queryset.only(*columns).order_by("pk")
+
+    stats = RebuildStats(last_pk=_load_checkpoint(checkpoint, model, field_names))
+    start = time.monotonic()
+    while True:
+        chunk_qs = queryset
+        if stats.last_pk is not None:
+            chunk_qs = chunk_qs.filter(pk__gt=stats.last_pk)
+        chunk = list(chunk_qs[:chunk_size])
+        if not chunk:
+            break
+
+        decrypt_instances(chunk, list(fields))
+        changed = []
+        unchanged = Q()
+        for obj in chunk:
+            updated = failed = False
+            # The columns each index was computed from, for the conditional write
+            expected = {}
+            for f in fields.values():
+                ciphertext = getattr(obj, f.ciphertext_attr)
+                if ciphertext is None:
+                    index = None
+                else:
+                    try:
+                        index = f.blind_index(f._cached_decrypt(obj, ciphertext))
+                    except Exception:
+                        failed = True
+                        continue
+                expected.update(f._expected(obj))
+                if getattr(obj, f.blind_index_attr) != index:
+                    setattr(obj, f.blind_index_attr, index)
+                    updated = True
+            if failed:
+                stats.failed += 1
+                stats.failed_pks.append(obj.pk)
+            if updated:
+                changed.append(obj)
+                unchanged |= unchanged_q(obj.pk, expected)
+
+        if changed:
+            # Like `_write_unchanged`: a row saved meanwhile already has the index
+            # of its new value
+            written = model._base_manager.filter(unchanged).bulk_update(
+                changed, [f.blind_index_attr for f in fields.values()]
+            )
+            stats.updated += written
+            stats.skipped += len(changed) - written
+        stats.scanned += len(chunk)
+        stats.last_pk = chunk[-1].pk
+        stats.elapsed = time.monotonic() - start
+        _save_checkpoint(checkpoint, model, field_names, stats.last_pk)
+        if progress is not None:
+            progress(stats)
+
+    stats.elapsed = time.monotonic() - start
+    if checkpoint is not None and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return stats
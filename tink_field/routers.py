@@ -0,0 +1,60 @@
+import functools
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+from .encrypted_field import encrypted_fields
+
+
+@functools.cache
+def _has_encrypted_fields(model) -> bool:
+    return bool(encrypted_fields(model))
+
+
+class ReplicaRouter:
+    """
+    Database router that reads models with `EncryptedField`s from the
+    `READ_REPLICA_DATABASE` alias and writes them to the default one.
+
+    Reading a stale field still re-encrypts it, but instances read from the replica
+    are written back with a conditional UPDATE on the default database (see
+    `coalesce.save_reencrypted`), and rows this process just re-encrypted aren't
+    re-encrypted again while the replica lags behind. Bulk jobs like
+    `reencrypt_queryset` read from the default database instead.
+
+    Without `READ_REPLICA_DATABASE`, or if it isn't in `DATABASES`, the router has
+    no opinion and everything uses the default database.
+    """
+
+    def _replica(self) -> str | None:
+        alias = getattr(settings, "READ_REPLICA_DATABASE", None)
+        if alias in settings.DATABASES:
+            return alias
+        return None
+
+    def db_for_read(self, model, **hints):
+        replica = self._replica()
+        if replica is not None and _has_encrypted_fields(model):
+            return replica
+        return None
+
+    def db_for_write(self, model, **hints):
+        if self._replica() is not None and _has_encrypted_fields(model):
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        replica = self._replica()
+        if replica is None:
+            return None
+        # The replica holds the same rows as the default database
+        databases = {DEFAULT_DB_ALIAS, replica}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replica gets its schema from the default database
+        if db == self._replica():
+            return False
+        return None
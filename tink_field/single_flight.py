@@ -0,0 +1,83 @@
+import asyncio
+import threading
+
+from django.conf import settings
+from django.core.signals import setting_changed
+
+
+class Flight:
+    """
+    One in-progress re-encryption of a field of a row. `values` is set to the
+    re-encrypted columns when it lands, or left None if it failed.
+    """
+
+    def __init__(self):
+        self.values = None
+        self._done = threading.Event()
+
+    def wait(self, timeout: float) -> dict | None:
+        if not self._done.wait(timeout):
+            return None
+        return self.values
+
+    async def await_(self, timeout: float) -> dict | None:
+        # Threads in this process may be leading it, so wait off the event loop
+        return await asyncio.to_thread(self.wait, timeout)
+
+
+class Flights:
+    """
+    Re-encryptions in progress in this process, by row, field and the last
+    re-encryption time they started from. The first reader of a stale row leads
+    and re-encrypts it; readers of the same row that arrive meanwhile wait up to
+    `timeout` seconds and take its result instead of encrypting and writing again.
+    """
+
+    def __init__(self, timeout: float = 1.0):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def join(self, key) -> tuple[Flight, bool]:
+        """
+        Returns the flight for `key` and whether the caller leads it. The leader
+        must call `land` when it's done, whether or not it succeeded.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self._flights[key] = Flight()
+            return flight, True
+
+    def land(self, key, flight: Flight, values: dict | None):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.values = values
+        flight._done.set()
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+
+_flights: Flights = None
+
+
+def get_flights() -> Flights:
+    global _flights
+    if _flights is None:
+        _flights = Flights(
+            timeout=getattr(settings, "REENCRYPTION_SINGLE_FLIGHT_TIMEOUT", 1.0)
+        )
+
+    return _flights
+
+
+def _reset(*, setting, **kwargs):
+    global _flights
+    if setting == "REENCRYPTION_SINGLE_FLIGHT_TIMEOUT":
+        _flights = None
+
+
+setting_changed.connect(_reset)
@@ -0,0 +1,219 @@
+import io
+import tempfile
+from typing import BinaryIO, Callable, Iterable, Iterator
+
+from django.core.files import File
+from django.core.files.storage import Storage
+
+from .keysets import get_streaming_aead
+
+# Plaintext is read and written in pieces of this size, so memory use stays flat
+# however big the blob is
+CHUNK_SIZE = 64 * 1024
+
+# Ciphertexts bigger than this spill from memory to a temporary file before they
+# are handed to a storage backend
+SPOOL_SIZE = 1024 * 1024
+
+
+def _bytes(associated_data: str | bytes) -> bytes:
+    if type(associated_data) == str:
+        return associated_data.encode("utf-8")
+    return associated_data
+
+
+class _KeepOpen(io.RawIOBase):
+    # Tink's encrypting stream closes its destination when it's closed; this lets
+    # the caller keep using it afterwards
+    def __init__(self, destination: BinaryIO):
+        self.destination = destination
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        return self.destination.write(b)
+
+    def close(self):
+        if not self.closed:
+            self.destination.flush()
+        super().close()
+
+
+def copy_stream(source: BinaryIO, destination: BinaryIO, chunk_size=CHUNK_SIZE):
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        destination.write(chunk)
+
+
+class StreamingEncryptor:
+    """
+    Encrypts and decrypts file-like objects in chunks with tink's streaming AEAD
+    (see `keysets.get_streaming_aead`), for blobs too large to hold in memory as
+    `bytes`. Ciphertexts are tink's segmented format, so a truncated or reordered
+    ciphertext fails to decrypt.
+    """
+
+    @property
+    def primitive(self):
+        return get_streaming_aead()
+
+    def encrypt_stream(
+        self,
+        source: BinaryIO,
+        destination: BinaryIO,
+        associated_data: str | bytes = b"",
+    ):
+        """
+        Reads plaintext from `source` until EOF and writes ciphertext to
+        `destination`, which is left open.
+        """
+        with self.primitive.new_encrypting_stream(
+            _KeepOpen(destination), _bytes(associated_data)
+        ) as encrypting_stream:
+            copy_stream(source, encrypting_stream)
+
+    def open_decrypted(
+        self, source: BinaryIO, associated_data: str | bytes = b""
+    ) -> BinaryIO:
+        """
+        Returns a readable stream of the plaintext of the ciphertext in `source`.
+        Each segment is authenticated before any of it is returned.
+        """
+        return self.primitive.new_decrypting_stream(source, _bytes(associated_data))
+
+    def decrypt_stream(
+        self,
+        source: BinaryIO,
+        destination: BinaryIO,
+        associated_data: str | bytes = b"",
+    ):
+        with self.open_decrypted(source, associated_data) as decrypting_stream:
+            copy_stream(decrypting_stream, destination)
+
+    def iter_decrypted(
+        self,
+        source: BinaryIO,
+        associated_data: str | bytes = b"",
+        chunk_size: int = CHUNK_SIZE,
+    ) -> Iterator[bytes]:
+        """
+        Yields the plaintext of `source` in chunks, e.g. for a
+        `StreamingHttpResponse`. `source` is closed when the iterator finishes.
+        """
+        with self.open_decrypted(source, associated_data) as decrypting_stream:
+            while True:
+                chunk = decrypting_stream.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def save_to_storage(
+        self,
+        storage: Storage,
+        name: str,
+        source: BinaryIO,
+        associated_data: str | bytes = b"",
+    ) -> str:
+        """
+        Encrypts `source` into `storage` under `name` and returns the name the
+        storage actually used. Ciphertext is spooled to a temporary file rather than
+        held in memory if it's large.
+        """
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as spool:
+            self.encrypt_stream(source, spool, associated_data)
+            spool.seek(0)
+            return storage.save(name, File(spool, name=name))
+
+    def open_from_storage(
+        self, storage: Storage, name: str, associated_data: str | bytes = b""
+    ) -> BinaryIO:
+        return self.open_decrypted(storage.open(name, "rb"), associated_data)
+
+    def write_chunks(
+        self,
+        source: BinaryIO,
+        write_chunk: Callable[[int, bytes], None],
+        associated_data: str | bytes = b"",
+        chunk_size: int = CHUNK_SIZE,
+    ):
+        """
+        Encrypts `source` and passes the ciphertext to `write_chunk(index, data)` in
+        pieces of `chunk_size` bytes, e.g. to store it as numbered `BinaryField`
+        rows. Read it back with `ChunkReader`.
+        """
+        with self.primitive.new_encrypting_stream(
+            ChunkWriter(write_chunk, chunk_size), _bytes(associated_data)
+        ) as encrypting_stream:
+            copy_stream(source, encrypting_stream)
+
+
+class ChunkWriter(io.RawIOBase):
+    """
+    Writable stream that hands its contents to `write_chunk(index, data)` in pieces
+    of exactly `chunk_size` bytes (the last may be shorter).
+    """
+
+    def __init__(self, write_chunk: Callable[[int, bytes], None], chunk_size: int):
+        self.write_chunk = write_chunk
+        self.chunk_size = chunk_size
+        self.index = 0
+        self._buffer = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._buffer += b
+        while len(self._buffer) >= self.chunk_size:
+            self._emit(self.chunk_size)
+        return len(b)
+
+    def _emit(self, size):
+        self.write_chunk(self.index, bytes(self._buffer[:size]))
+        del self._buffer[:size]
+        self.index += 1
+
+    def close(self):
+        if not self.closed and self._buffer:
+            self._emit(len(self._buffer))
+        super().close()
+
+
+class ChunkReader(io.RawIOBase):
+    """
+    Readable stream over an iterable of `bytes` chunks, such as
+    `Chunk.objects.filter(blob=blob).order_by("index").values_list("data", flat=True)
+    .iterator()`. Only one chunk is held in memory at a time.
+    """
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._current = memoryview(b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self._current:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._current = memoryview(bytes(chunk))
+        size = min(len(b), len(self._current))
+        b[:size] = self._current[:size]
+        self._current = self._current[size:]
+        return size
+
+
+_encryptor: StreamingEncryptor = None
+
+
+def get_encryptor() -> StreamingEncryptor:
+    global _encryptor
+    if _encryptor is None:
+        _encryptor = StreamingEncryptor()
+
+    return _encryptor
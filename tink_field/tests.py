@@ -1,3 +1,1564 @@
-from django.test import TestCase
+import base64
+import io
+import json
+import os
+import pickle
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from cryptography.fernet import InvalidToken
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection
+from django.test import (
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from google.api_core.exceptions import DeadlineExceeded
+import tink
+from tink import aead, secret_key_access, streaming_aead
+
+from .admin import EstimatedCountPaginator, SecretAdmin
+from . import compression
+from .batch import decrypt_instances, get_executor
+from .benchmarks import field_cases, offline_settings
+from .blind_index import generate_key
+from .coalesce import coalesce_reencryption, get_recent_reencryptions
+from .encrypted_field import DecryptionError, EncryptedField, encrypted_fields
+from .envelope import CachingKmsEnvelopeAead, LocalKmsAead
+from .ingest import build_secret, import_secrets
+from .instrumentation import (
+    Instrumentation,
+    PrometheusInstrumentation,
+    get_instrumentation,
+)
+from .json_encryptor import JsonEncryptor
+from . import keysets, loadtest
+from .keysets import get_aead
+from .legacy_encryptor import get_encryptor as legacy_encryptor
+from .models import Secret
+from .negative_cache import get_negative_cache
+from .rate_limit import TokenBucket
+from .reencryption import rebuild_blind_indexes, reencrypt_queryset
+from .single_flight import Flight
+from .streaming import ChunkReader, StreamingEncryptor
+from .tink_encryptor import TinkEncryptor
+from .write_behind import WriteBehindQueue
+
+LONG_AGO = timedelta(days=365)
+
+
+class OfflineMixin:
+    """
+    Generated keys, no KMS, and every query on the default database.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.enterContext(offline_settings(READ_REPLICA_DATABASE=None))
+
+    def make_secret(self, name="secret", plaintext="hunter2", **columns) -> Secret:
+        secret = build_secret(name, plaintext)
+        for column, value in columns.items():
+            setattr(secret, column, value)
+        secret.save()
+        return secret
+
+    def make_stale(self, secret):
+        Secret.objects.filter(pk=secret.pk).update(
+            binary_reencryption_time=timezone.now() - LONG_AGO,
+            b64_reencryption_time=timezone.now() - LONG_AGO,
+            json_reencryption_time=timezone.now() - LONG_AGO,
+        )
+
+    def read_b64(self, pk) -> str:
+        return Secret.objects.get(pk=pk).plaintext_from_b64.decrypted_value()
+
+
+@contextmanager
+def streaming_settings():
+    """
+    A generated streaming keyset, and uploads stored in a temporary directory.
+    """
+    streaming_aead.register()
+    keyset_handle = tink.new_keyset_handle(
+        streaming_aead.streaming_aead_key_templates.AES128_GCM_HKDF_4KB
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        keyset_file = os.path.join(tmp, "streaming.json")
+        with open(keyset_file, "wt") as f:
+            f.write(
+                tink.json_proto_keyset_format.serialize(
+                    keyset_handle, secret_key_access.TOKEN
+                )
+            )
+        with override_settings(STREAMING_KEYSET_FILE=keyset_file, MEDIA_ROOT=tmp):
+            yield
+
+
+class BlockingKms(LocalKmsAead):
+    """
+    Local KMS whose wraps can be held until the test releases them.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.block = False
+        self.wrapping = threading.Event()
+        self.release = threading.Event()
+
+    def encrypt_versioned(self, plaintext, associated_data):
+        if self.block:
+            self.wrapping.set()
+            self.release.wait(5)
+        return super().encrypt_versioned(plaintext, associated_data)
+
+
+class EnvelopeCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.kms = BlockingKms()
+        self.envelope = CachingKmsEnvelopeAead(
+            aead.aead_key_templates.AES256_GCM, self.kms, max_uses=3
+        )
+        self.ciphertext = self.envelope.encrypt(b"payload", b"ad")
+        self.addCleanup(self.kms.release.set)
+
+    def start_wrap(self):
+        # The next encrypt needs a new DEK, and its KMS call hangs
+        self.envelope._current = None
+        self.kms.block = True
+        thread = threading.Thread(target=self.envelope.encrypt, args=(b"x", b""))
+        thread.start()
+        self.assertTrue(self.kms.wrapping.wait(5))
+        return thread
+
+    def test_decrypt_cache_hits_dont_wait_for_wrap(self):
+        wrapper = self.start_wrap()
+        result = []
+        reader = threading.Thread(
+            target=lambda: result.append(self.envelope.decrypt(self.ciphertext, b"ad"))
+        )
+        reader.start()
+        reader.join(2)
+
+        self.assertEqual(result, [b"payload"])
+        self.kms.release.set()
+        wrapper.join()
+
+    def test_concurrent_misses_share_one_wrap(self):
+        wrapper = self.start_wrap()
+        # The blocked wrap hasn't counted itself yet
+        calls = self.kms.calls + 1
+        other = threading.Thread(target=self.envelope.encrypt, args=(b"y", b""))
+        other.start()
+        self.kms.release.set()
+        wrapper.join()
+        other.join()
+
+        self.assertEqual(self.kms.calls, calls)
+
+
+class EnvelopeKeyVersionTests(SimpleTestCase):
+    def test_current_dek_version_survives_cache_eviction(self):
+        kms = LocalKmsAead()
+        envelope = CachingKmsEnvelopeAead(
+            aead.aead_key_templates.AES256_GCM, kms, cache_size=2
+        )
+        others = [
+            CachingKmsEnvelopeAead(aead.aead_key_templates.AES256_GCM, kms).encrypt(
+                b"other", b""
+            )
+            for _ in range(3)
+        ]
+        envelope.encrypt(b"first", b"")
+
+        # Unwrapping other DEKs evicts the current one from the decryption cache
+        for ciphertext in others:
+            envelope.decrypt(ciphertext, b"")
+
+        self.assertEqual(envelope.key_version(envelope.encrypt(b"x", b"")), "local-kms")
+        self.assertIsNone(envelope.key_version(others[0]))
+
+
+class ImportTimeTests(SimpleTestCase):
+    def probe(self, **result):
+        output = {
+            "django_setup_ms": 100.0,
+            "tink_field_ms": 50.0,
+            "total_ms": 150.0,
+            "primitives_built": 0,
+        }
+        output.update(result)
+        return mock.patch(
+            "tink_field.management.commands.check_import_time.subprocess.run",
+            return_value=SimpleNamespace(
+                returncode=0, stdout=json.dumps(output) + "\n", stderr=""
+            ),
+        )
+
+    def test_importing_builds_no_primitives(self):
+        out = io.StringIO()
+        # A fresh interpreter; the budget is generous since CI machines vary
+        call_command("check_import_time", runs=1, budget_ms=60000, stdout=out)
+        self.assertIn("budget: 60000ms", out.getvalue())
+
+    def test_fails_over_budget(self):
+        with self.probe(total_ms=1500.0):
+            with self.assertRaisesMessage(CommandError, "budget exceeded"):
+                call_command("check_import_time", budget_ms=1000, stdout=io.StringIO())
+
+    def test_fails_if_a_primitive_was_built(self):
+        with self.probe(primitives_built=1):
+            with self.assertRaisesMessage(
+                CommandError, "built an encryption primitive"
+            ):
+                call_command("check_import_time", stdout=io.StringIO())
+
+
+class CompressionTests(OfflineMixin, SimpleTestCase):
+    plaintexts = [
+        b"",
+        b"short",
+        compression.MAGIC,
+        compression.MAGIC + b"\x00",
+        compression.MAGIC + b"\x01arbitrary user bytes",
+        compression.MAGIC + b"\x02arbitrary user bytes",
+        compression.MAGIC + b"\x07arbitrary user bytes",
+        compression.MAGIC + b"\x01" + b"a" * 4096,
+        b"compressible " * 1000,
+    ]
+
+    def test_round_trip(self):
+        encryptor = TinkEncryptor()
+        for setting in (None, "zlib"):
+            for plaintext in self.plaintexts:
+                with self.subTest(compression=setting, plaintext=plaintext[:8]):
+                    with override_settings(
+                        TINK_FIELD_COMPRESSION=setting,
+                        TINK_FIELD_COMPRESSION_THRESHOLD=0,
+                    ):
+                        ciphertext = encryptor.encrypt(plaintext, b"ad")
+                    self.assertEqual(encryptor.decrypt(ciphertext, b"ad"), plaintext)
+
+    def test_compresses_when_it_helps(self):
+        plaintext = b"compressible " * 1000
+        with override_settings(TINK_FIELD_COMPRESSION="zlib"):
+            framed = compression.compress(plaintext)
+        self.assertLess(len(framed), len(plaintext))
+        self.assertEqual(compression.decompress(framed), plaintext)
+
+    def test_reads_unframed_values_written_before_stored_frames(self):
+        for kind in (b"\x00", b"\x01", b"\x07"):
+            plaintext = compression.MAGIC + kind + b"arbitrary user bytes"
+            with self.subTest(kind=kind):
+                self.assertEqual(compression.decompress(plaintext), plaintext)
+
+
+class BenchmarkTests(OfflineMixin, SimpleTestCase):
+    def test_fallback_case_never_tries_the_primary(self):
+        field = encrypted_fields(Secret)["plaintext_from_b64"]
+        cases = {
+            (name, operation): run for name, operation, size, run in field_cases([16])
+        }
+
+        with mock.patch.object(
+            field.encryptor, "decrypt", side_effect=AssertionError("primary tried")
+        ):
+            plaintext = cases["EncryptedField", "decrypt_via_fallback"]()
+
+        self.assertEqual(plaintext, b"x" * 16)
+
+
+def write_keyset(path, template=aead.aead_key_templates.AES128_GCM):
+    # Replaced by a rename, like a deploy would, so the reload check sees it
+    keyset_handle = tink.new_keyset_handle(template)
+    with open(path + ".tmp", "wt") as f:
+        f.write(
+            tink.json_proto_keyset_format.serialize(
+                keyset_handle, secret_key_access.TOKEN
+            )
+        )
+    os.replace(path + ".tmp", path)
+
+
+def remote_failure():
+    # What a KMS outage looks like through tink's `GcpKmsAead`
+    try:
+        raise DeadlineExceeded("KMS took too long")
+    except DeadlineExceeded as e:
+        return tink.TinkError(e)
+
+
+class DecryptRoutingTests(OfflineMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.binary = encrypted_fields(Secret)["plaintext_from_binary"]
+        self.b64 = encrypted_fields(Secret)["plaintext_from_b64"]
+
+    def test_tink_and_b64_ciphertexts_route_to_the_primary(self):
+        ciphertext = self.binary.encryptor.encrypt(b"hunter2", b"name")
+        self.assertEqual(self.binary._decryptors(ciphertext), [self.binary.encryptor])
+        ciphertext = self.b64.encryptor.encrypt("hunter2", b"name")
+        self.assertEqual(self.b64._decryptors(ciphertext), [self.b64.encryptor])
+
+    @override_settings(KEYSET_FILE=None, LOCAL_KMS_LATENCY=0.0, KMS_DEK_CACHE=True)
+    def test_envelope_ciphertexts_route_to_the_primary(self):
+        ciphertext = self.binary.encryptor.encrypt(b"hunter2", b"name")
+        self.assertEqual(self.binary._decryptors(ciphertext), [self.binary.encryptor])
+        ciphertext = self.b64.encryptor.encrypt("hunter2", b"name")
+        self.assertEqual(self.b64._decryptors(ciphertext), [self.b64.encryptor])
+
+    def test_fernet_tokens_route_to_the_fallback(self):
+        token = legacy_encryptor().encrypt("hunter2")
+        self.assertEqual(self.b64._decryptors(token), [self.b64.fallback_encryptor])
+        self.assertEqual(self.binary._decryptors(token.encode("utf-8")), [])
+
+    def test_raw_keyset_accepts_everything(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            keyset_file = os.path.join(tmp, "raw.json")
+            write_keyset(keyset_file, aead.aead_key_templates.AES128_GCM_RAW)
+            with override_settings(KEYSET_FILE=keyset_file):
+                token = legacy_encryptor().encrypt("hunter2")
+                self.assertEqual(
+                    self.b64._decryptors(token),
+                    [self.b64.encryptor, self.b64.fallback_encryptor],
+                )
+                self.assertTrue(self.binary.encryptor.may_decrypt(b"\x07" * 40))
+
+
+class NegativeCacheTests(OfflineMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.field = encrypted_fields(Secret)["plaintext_from_b64"]
+        self.ciphertext = self.field.encryptor.encrypt("hunter2", b"name")
+
+    def claimed_by_both(self, primary_error, fallback_error=InvalidToken()):
+        primary = self.field.encryptor
+        fallback = self.field.fallback_encryptor
+        patches = [
+            mock.patch.object(primary, "may_decrypt", return_value=True),
+            mock.patch.object(fallback, "may_decrypt", return_value=True),
+            mock.patch.object(primary, "decrypt", side_effect=primary_error),
+            mock.patch.object(fallback, "decrypt", side_effect=fallback_error),
+        ]
+        return [self.enterContext(patch) for patch in patches][2:]
+
+    def test_cached_failure_skips_both_encryptors(self):
+        primary, fallback = self.claimed_by_both(tink.TinkError("decryption failed"))
+
+        with self.assertRaises(InvalidToken):
+            self.field.decrypt_value(self.ciphertext, b"name")
+        with self.assertRaises(DecryptionError):
+            self.field.decrypt_value(self.ciphertext, b"name")
+
+        self.assertEqual(primary.call_count, 1)
+        self.assertEqual(fallback.call_count, 1)
+
+    def test_remote_errors_arent_cached(self):
+        primary, fallback = self.claimed_by_both(remote_failure())
+
+        for _ in range(2):
+            with self.assertRaises(tink.TinkError) as raised:
+                self.field.decrypt_value(self.ciphertext, b"name")
+            # Reported over the fallback's failure, which says nothing
+            self.assertIsInstance(raised.exception.args[0], DeadlineExceeded)
+
+        self.assertEqual(primary.call_count, 2)
+        self.assertEqual(len(get_negative_cache()), 0)
+
+
+class RemoteFailureTests(OfflineMixin, TestCase):
+    def test_read_during_kms_outage_keeps_the_value(self):
+        secret = self.make_secret()
+        field = encrypted_fields(Secret)["plaintext_from_b64"]
+        secret = Secret.objects.get(pk=secret.pk)
+
+        with mock.patch.object(
+            field.encryptor, "decrypt", side_effect=remote_failure()
+        ):
+            with self.assertRaises(tink.TinkError):
+                secret.plaintext_from_b64
+
+        self.assertIsNotNone(secret.b64_encrypted_secret)
+        self.assertEqual(self.read_b64(secret.pk), "hunter2")
+
+
+class HotReloadTests(OfflineMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        tmp = self.enterContext(tempfile.TemporaryDirectory())
+        self.keyset_file = os.path.join(tmp, "keyset.json")
+        write_keyset(self.keyset_file)
+        self.enterContext(
+            override_settings(KEYSET_FILE=self.keyset_file, KEYSET_RELOAD_INTERVAL=0)
+        )
+
+    def test_swaps_in_the_new_keyset(self):
+        old = get_aead()
+        old_key_id = keysets.active_key_id()
+        ciphertext = old.encrypt(b"hunter2", b"")
+        reloads = keysets.reload_count()
+
+        write_keyset(self.keyset_file)
+        new = get_aead()
+
+        self.assertIsNot(new, old)
+        self.assertNotEqual(keysets.active_key_id(), old_key_id)
+        self.assertEqual(keysets.reload_count(), reloads + 1)
+        # Anything still holding the old primitive carries on with it
+        self.assertEqual(old.decrypt(ciphertext, b""), b"hunter2")
+
+    def test_keeps_the_old_keyset_when_the_new_one_doesnt_parse(self):
+        old = get_aead()
+        reloads = keysets.reload_count()
+        with open(self.keyset_file + ".tmp", "wt") as f:
+            f.write('{"primaryKeyId": ')
+        os.replace(self.keyset_file + ".tmp", self.keyset_file)
+
+        with mock.patch(
+            "tink_field.keysets._build_aead", wraps=keysets._build_aead
+        ) as build:
+            with self.assertLogs("tink_field.keysets", "ERROR"):
+                self.assertIs(get_aead(), old)
+            # The broken file is only tried once
+            self.assertIs(get_aead(), old)
+            self.assertEqual(build.call_count, 1)
+
+            write_keyset(self.keyset_file)
+            self.assertIsNot(get_aead(), old)
+
+        self.assertEqual(keysets.reload_count(), reloads + 1)
+
+    def test_reload_clears_negative_cache(self):
+        get_aead()
+        negative_cache = get_negative_cache()
+        negative_cache.add(negative_cache.key("label", b"ciphertext", b""))
+
+        write_keyset(self.keyset_file)
+        get_aead()
+
+        self.assertEqual(len(negative_cache), 0)
+
+
+class PlaintextCacheTests(OfflineMixin, TestCase):
+    def test_plaintexts_stay_out_of_pickles(self):
+        # The demo model keeps plaintext copies in its own columns; blank them so
+        # only the cache could leak the value
+        secret = self.make_secret(
+            plaintext="top-secret-value", _plaintext_secret="", _plaintext_json={}
+        )
+        secret = Secret.objects.decrypted(
+            "plaintext_from_binary", "plaintext_from_b64", "plaintext_from_json"
+        ).get(pk=secret.pk)
+        self.assertEqual(
+            secret.plaintext_from_b64.decrypted_value(), "top-secret-value"
+        )
+
+        pickled = pickle.dumps(secret)
+
+        self.assertNotIn(b"top-secret-value", pickled)
+        restored = pickle.loads(pickled)
+        self.assertEqual(
+            restored.plaintext_from_b64.decrypted_value(), "top-secret-value"
+        )
+        self.assertEqual(
+            restored.plaintext_from_json.decrypted_value()["secret"],
+            "top-secret-value",
+        )
+
+
+class BatchDecryptTests(OfflineMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        for i in range(3):
+            self.make_secret(name=f"secret-{i}", plaintext=f"hunter{i}")
+
+    def assert_cached(self, secrets):
+        # Reads come from the plaintext cache, without decrypting again
+        with mock.patch.object(
+            EncryptedField, "decrypt_value", side_effect=AssertionError("decrypted")
+        ):
+            for secret in secrets:
+                i = secret.name[-1]
+                self.assertEqual(
+                    secret.plaintext_from_b64.decrypted_value(), f"hunter{i}"
+                )
+                self.assertEqual(
+                    secret.plaintext_from_binary.decrypted_value(),
+                    f"hunter{i}".encode(),
+                )
+                self.assertEqual(
+                    secret.plaintext_from_json.decrypted_value()["secret"], f"hunter{i}"
+                )
+
+    def test_decrypts_every_field_by_default(self):
+        queryset = Secret.objects.decrypted()
+        self.assertEqual(set(queryset._decrypted_fields), set(encrypted_fields(Secret)))
+        self.assert_cached(list(queryset))
+
+    def test_decrypts_the_whole_result_in_one_batch(self):
+        with mock.patch(
+            "tink_field.managers.decrypt_instances", wraps=decrypt_instances
+        ) as batch:
+            list(Secret.objects.decrypted("plaintext_from_b64"))
+
+        batch.assert_called_once()
+        self.assertEqual(len(batch.call_args.args[0]), 3)
+        self.assertEqual(batch.call_args.args[1], ("plaintext_from_b64",))
+
+    def test_iterator_decrypts_each_chunk(self):
+        with mock.patch(
+            "tink_field.managers.decrypt_instances", wraps=decrypt_instances
+        ) as batch:
+            secrets = list(Secret.objects.decrypted().iterator(chunk_size=2))
+
+        self.assertEqual([len(call.args[0]) for call in batch.call_args_list], [2, 1])
+        self.assert_cached(secrets)
+
+    def test_process_pool(self):
+        with mock.patch("tink_field.batch._executor", None):
+            with override_settings(DECRYPT_EXECUTOR="process", DECRYPT_WORKERS=2):
+                executor = get_executor()
+                self.addCleanup(executor.shutdown)
+                self.assertIsInstance(executor, ProcessPoolExecutor)
+                secrets = list(Secret.objects.decrypted())
+
+        self.assert_cached(secrets)
+
+
+class WriteBehindTests(OfflineMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.field = encrypted_fields(Secret)["plaintext_from_b64"]
+        self.queue = WriteBehindQueue()
+        # Flushed by the test instead of a background thread
+        self.enterContext(mock.patch.object(self.queue, "_ensure_started"))
+        self.enterContext(
+            mock.patch("tink_field.encrypted_field.get_queue", return_value=self.queue)
+        )
+        self.enterContext(mock.patch.object(self.field, "write_behind", True))
+
+    def test_flush_writes_reencrypted_row(self):
+        secret = self.make_secret()
+        self.make_stale(secret)
+
+        Secret.objects.get(pk=secret.pk).plaintext_from_b64
+        self.assertTrue(self.field.needs_reencryption(Secret.objects.get(pk=secret.pk)))
+        self.queue.flush()
+
+        self.assertEqual((self.queue.written, self.queue.skipped), (1, 0))
+        self.assertFalse(
+            self.field.needs_reencryption(Secret.objects.get(pk=secret.pk))
+        )
+        self.assertEqual(self.read_b64(secret.pk), "hunter2")
+
+    def test_flush_keeps_concurrent_save(self):
+        secret = self.make_secret(plaintext="old")
+        self.make_stale(secret)
+
+        Secret.objects.get(pk=secret.pk).plaintext_from_b64
+        other = Secret.objects.get(pk=secret.pk)
+        other.plaintext_from_b64 = "NEW"
+        other.save()
+        self.queue.flush()
+
+        self.assertEqual((self.queue.written, self.queue.skipped), (0, 1))
+        self.assertEqual(self.read_b64(secret.pk), "NEW")
+
+    def test_flush_keeps_legacy_rewrite_with_the_same_null_time(self):
+        secret = self.make_secret(
+            b64_encrypted_secret=legacy_encryptor().encrypt("old"),
+            b64_reencryption_time=None,
+        )
+
+        Secret.objects.with_ciphertext().get(pk=secret.pk).plaintext_from_b64
+        Secret.objects.filter(pk=secret.pk).update(
+            b64_encrypted_secret=legacy_encryptor().encrypt("NEW")
+        )
+        self.queue.flush()
+
+        self.assertEqual((self.queue.written, self.queue.skipped), (0, 1))
+        self.assertEqual(self.read_b64(secret.pk), b"NEW")
+
+    def test_async_reads_enqueue_conditional_writes(self):
+        secret = self.make_secret(plaintext="old")
+        self.make_stale(secret)
+
+        stale = Secret.objects.with_ciphertext().get(pk=secret.pk)
+        async_to_sync(self.field.aget)(stale)
+        other = Secret.objects.get(pk=secret.pk)
+        other.plaintext_from_b64 = "NEW"
+        other.save()
+        self.queue.flush()
+
+        self.assertEqual((self.queue.written, self.queue.skipped), (0, 1))
+        self.assertEqual(self.read_b64(secret.pk), "NEW")
+
+
+class AsyncFieldTests(OfflineMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.builds = []
+        build = keysets._build_aead
+
+        def record_build():
+            self.builds.append(threading.current_thread())
+            return build()
+
+        self.enterContext(
+            mock.patch("tink_field.keysets._build_aead", side_effect=record_build)
+        )
+
+    def run_on_loop(self, coroutine_function, *args):
+        # Returns the result, and checks that any keyset was built off the loop
+        async def run():
+            return threading.current_thread(), await coroutine_function(*args)
+
+        self.builds.clear()
+        loop_thread, result = async_to_sync(run)()
+        self.assertNotIn(loop_thread, self.builds)
+        return result
+
+    def test_aget_loads_the_keyset_off_the_event_loop(self):
+        secret = self.make_secret()
+        secret = Secret.objects.with_ciphertext().get(pk=secret.pk)
+
+        with mock.patch("tink_field.keysets._active", None):
+            with mock.patch.dict(keysets._primitives, clear=True):
+                value = self.run_on_loop(secret.aget, "plaintext_from_b64")
+
+        self.assertEqual(len(self.builds), 1)
+        self.assertEqual(value.decrypted_value(), "hunter2")
+
+    def test_aset_loads_the_keyset_off_the_event_loop(self):
+        secret = Secret(name="secret")
+
+        with mock.patch("tink_field.keysets._active", None):
+            with mock.patch.dict(keysets._primitives, clear=True):
+                self.run_on_loop(secret.aset, "plaintext_from_b64", "hunter2")
+
+        self.assertEqual(len(self.builds), 1)
+        self.assertEqual(secret.plaintext_from_b64.decrypted_value(), "hunter2")
+
+    @override_settings(KEYSET_RELOAD_INTERVAL=0)
+    def test_keyset_reload_happens_off_the_event_loop(self):
+        secret = Secret(name="secret")
+        secret.plaintext_from_b64 = "old"
+        reloads = keysets.reload_count()
+
+        write_keyset(settings.KEYSET_FILE)
+        self.run_on_loop(secret.aset, "plaintext_from_b64", "new")
+
+        self.assertEqual(len(self.builds), 1)
+        self.assertEqual(keysets.reload_count(), reloads + 1)
+
+    def test_aget_saves_reencryption(self):
+        secret = self.make_secret()
+        self.make_stale(secret)
+        secret = Secret.objects.with_ciphertext().get(pk=secret.pk)
+
+        self.run_on_loop(secret.aget, "plaintext_from_b64")
+
+        secret.refresh_from_db()
+        self.assertGreater(
+            secret.b64_reencryption_time, timezone.now() - timedelta(minutes=1)
+        )
+
+    def test_aset_then_save(self):
+        secret = self.make_secret(plaintext="old")
+
+        self.run_on_loop(secret.aset, "plaintext_from_b64", "new")
+        secret.save()
+
+        self.assertEqual(self.read_b64(secret.pk), "new")
+
+
+class StaleQueryTests(OfflineMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.fresh = self.make_secret(name="fresh")
+        self.stale_b64 = self.make_secret(name="stale-b64")
+        self.legacy = self.make_secret(name="legacy")
+        self.almost = self.make_secret(name="almost")
+        Secret.objects.filter(pk=self.stale_b64.pk).update(
+            b64_reencryption_time=timezone.now() - LONG_AGO
+        )
+        Secret.objects.filter(pk=self.legacy.pk).update(
+            binary_reencryption_time=None,
+            b64_reencryption_time=None,
+            json_reencryption_time=None,
+        )
+        # Inside the 30 day window, but past the shortest jittered one (24 days)
+        Secret.objects.filter(pk=self.almost.pk).update(
+            json_reencryption_time=timezone.now() - timedelta(days=25)
+        )
+
+    def names(self, queryset):
+        return set(queryset.values_list("name", flat=True))
+
+    def test_stale_defaults_to_every_field(self):
+        self.assertEqual(
+            self.names(Secret.objects.stale()), {"stale-b64", "legacy", "almost"}
+        )
+
+    def test_stale_for_some_fields(self):
+        self.assertEqual(
+            self.names(Secret.objects.stale("plaintext_from_b64")),
+            {"stale-b64", "legacy"},
+        )
+        self.assertEqual(
+            self.names(Secret.objects.stale("plaintext_from_binary")), {"legacy"}
+        )
+
+    def test_annotate_needs_reencryption(self):
+        rows = {
+            row["name"]: row
+            for row in Secret.objects.annotate_needs_reencryption().values(
+                "name",
+                "plaintext_from_b64_needs_reencryption",
+                "plaintext_from_json_needs_reencryption",
+            )
+        }
+
+        self.assertEqual(
+            {
+                name: row["plaintext_from_b64_needs_reencryption"]
+                for name, row in rows.items()
+            },
+            {"fresh": False, "stale-b64": True, "legacy": True, "almost": False},
+        )
+        self.assertEqual(
+            {
+                name: row["plaintext_from_json_needs_reencryption"]
+                for name, row in rows.items()
+            },
+            {"fresh": False, "stale-b64": False, "legacy": True, "almost": True},
+        )
+
+    def test_unknown_field(self):
+        with self.assertRaisesMessage(Exception, "has no encrypted field"):
+            Secret.objects.stale("name")
+
+
+class ImportSecretsTests(OfflineMixin, TestCase):
+    LINES = [
+        '{"name": "first", "secret": "hunter2"}\n',
+        "not json\n",
+        "\n",
+        '["a list"]\n',
+        '{"name": "no secret"}\n',
+        json.dumps({"name": "x" * 51, "secret": "too long a name"}) + "\n",
+        '{"name": "second", "secret": "hunter3"}\n',
+    ]
+
+    def test_imports_valid_lines_and_rejects_the_rest(self):
+        rejects = io.StringIO()
+
+        stats = import_secrets(self.LINES, chunk_size=2, workers=2, rejects=rejects)
+
+        self.assertEqual((stats.read, stats.imported, stats.rejected), (6, 2, 4))
+        rejected = [json.loads(line) for line in rejects.getvalue().splitlines()]
+        self.assertEqual([r["line"] for r in rejected], [2, 4, 5, 6])
+        self.assertEqual(rejected[0]["input"], "not json")
+        self.assertIn("name:", rejected[3]["error"])
+        self.assertEqual(
+            {
+                s.name: s.plaintext_from_b64.decrypted_value()
+                for s in Secret.objects.all()
+            },
+            {"first": "hunter2", "second": "hunter3"},
+        )
+
+    def test_falls_back_to_row_inserts_when_a_chunk_fails(self):
+        save = Secret.save
+
+        def failing_save(secret, *args, **kwargs):
+            if secret.name == "bad":
+                raise DatabaseError("row rejected")
+            return save(secret, *args, **kwargs)
+
+        lines = [
+            json.dumps({"name": name, "secret": "hunter2"})
+            for name in ("good", "bad", "also good")
+        ]
+        rejects = io.StringIO()
+        with mock.patch.object(
+            Secret.objects, "bulk_create", side_effect=DatabaseError("chunk failed")
+        ):
+            with mock.patch.object(Secret, "save", failing_save):
+                stats = import_secrets(lines, rejects=rejects)
+
+        self.assertEqual((stats.imported, stats.rejected), (2, 1))
+        self.assertEqual(
+            set(Secret.objects.values_list("name", flat=True)), {"good", "also good"}
+        )
+        self.assertEqual(
+            json.loads(rejects.getvalue()),
+            {"line": 2, "error": "row rejected", "input": lines[1]},
+        )
+
+    def test_command_writes_reject_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            input_file = os.path.join(tmp, "secrets.jsonl")
+            reject_file = os.path.join(tmp, "rejects.jsonl")
+            with open(input_file, "wt") as f:
+                f.writelines(self.LINES)
+            out = io.StringIO()
+
+            call_command(
+                "import_secrets", input_file, reject_file=reject_file, stdout=out
+            )
+
+            with open(reject_file) as f:
+                self.assertEqual(len(f.readlines()), 4)
+        self.assertIn("Done: 2 of 6 lines imported, 4 rejected", out.getvalue())
+
+
+class LoadTestTests(OfflineMixin, TestCase):
+    def test_seed_mixes_fresh_stale_and_legacy_rows(self):
+        loadtest.seed(60, stale=0.3, legacy=0.3, chunk_size=25)
+
+        self.assertEqual(Secret.objects.count(), 60)
+        legacy = Secret.objects.filter(binary_encrypted_secret__isnull=True)
+        stale = Secret.objects.stale().exclude(pk__in=legacy)
+        fresh = Secret.objects.exclude(pk__in=legacy).exclude(pk__in=stale)
+        for rows in (legacy, stale, fresh):
+            self.assertTrue(rows.exists())
+        # Legacy rows only decrypt through the fallback encryptor, which returns
+        # Fernet's bytes
+        for secret in legacy.with_ciphertext():
+            self.assertEqual(
+                secret.plaintext_from_b64.decrypted_value(),
+                secret._plaintext_secret.encode("utf-8"),
+            )
+
+    def test_seed_is_deterministic(self):
+        loadtest.seed(10)
+        first = list(Secret.objects.order_by("name").values_list("_plaintext_secret"))
+        Secret.objects.all().delete()
+        loadtest.seed(10)
+        second = list(Secret.objects.order_by("name").values_list("_plaintext_secret"))
+        self.assertEqual(first, second)
+
+    def test_report(self):
+        result = loadtest.ScenarioResult(
+            "changelist",
+            requests=4,
+            errors=1,
+            elapsed=2.0,
+            latencies=[0.001, 0.002, 0.003, 0.004],
+            queries=12,
+            encrypts=0,
+            decrypts=400,
+        )
+
+        report = result.report()
+
+        self.assertEqual(report["requests_per_second"], 2.0)
+        self.assertEqual(report["queries_per_request"], 3.0)
+        self.assertEqual(report["decrypts_per_request"], 100.0)
+        self.assertAlmostEqual(report["p50_ms"], 2.5)
+        self.assertTrue(3.0 < report["p95_ms"] <= 4.0)
+        self.assertEqual(loadtest.ScenarioResult("empty").report()["p99_ms"], 0.0)
+
+    def test_command_rejects_impossible_fractions(self):
+        with self.assertRaisesMessage(CommandError, "more than 1"):
+            call_command("loadtest", stale=0.8, legacy=0.5, stdout=io.StringIO())
+
+
+class DeferredColumnTests(OfflineMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        for i in range(3):
+            self.make_secret(name=f"secret-{i}", plaintext=f"value-{i}")
+
+    def test_first_read_loads_every_row(self):
+        secrets = list(Secret.objects.order_by("pk"))
+
+        with self.assertNumQueries(1):
+            values = [s.plaintext_from_b64.decrypted_value() for s in secrets]
+
+        self.assertEqual(values, ["value-0", "value-1", "value-2"])
+
+    def test_instances_fetched_together_pickle(self):
+        secrets = list(Secret.objects.order_by("pk"))
+
+        restored = pickle.loads(pickle.dumps(secrets[1]))
+
+        self.assertEqual(restored.plaintext_from_b64.decrypted_value(), "value-1")
+        self.assertEqual(secrets[0].plaintext_from_b64.decrypted_value(), "value-0")
+
+
+class LegacyJsonTests(OfflineMixin, TestCase):
+    def test_legacy_rows_decrypt_through_the_fallback(self):
+        self.client.post(
+            reverse("create"),
+            {"name": "old", "plaintext": "hunter2", "encryptor": "legacy"},
+        )
+
+        secret = Secret.objects.get(name="old")
+        self.assertEqual(
+            secret.plaintext_from_json.decrypted_value(),
+            {"name": "old", "secret": "hunter2"},
+        )
+        # ...and is re-encrypted with the primary encryptor
+        fresh = Secret.objects.get(pk=secret.pk)
+        self.assertIsNotNone(fresh.json_reencryption_time)
+        self.assertEqual(
+            fresh.plaintext_from_json.decrypted_value()["secret"], "hunter2"
+        )
+
+    def test_failure_leaves_not_null_columns_in_place(self):
+        document = {"name": "broken", "secret": "not a ciphertext"}
+        secret = self.make_secret(name="broken", json_with_encrypted_secret=document)
+
+        with self.assertLogs("tink_field", "WARNING"):
+            self.assertIsNone(secret.plaintext_from_json)
+
+        self.assertEqual(secret.json_with_encrypted_secret, document)
+        fresh = Secret.objects.get(pk=secret.pk)
+        self.assertEqual(fresh.json_with_encrypted_secret, document)
+
+    def test_failure_nulls_out_nullable_columns(self):
+        secret = self.make_secret(binary_encrypted_secret=b"not a ciphertext")
+
+        with self.assertLogs("tink_field", "WARNING"):
+            self.assertIsNone(secret.plaintext_from_binary)
+
+        fresh = Secret.objects.get(pk=secret.pk)
+        self.assertIsNone(fresh.binary_encrypted_secret)
+        self.assertIsNone(fresh.binary_reencryption_time)
+
+
+class ViewAccessTests(OfflineMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.enterContext(streaming_settings())
+        self.admin = get_user_model().objects.create_superuser("admin", password=None)
+        self.client.force_login(self.admin)
+        self.client.post(
+            reverse("create"),
+            {
+                "name": 'report "q1".txt',
+                "plaintext": "hunter2",
+                "encryptor": "default",
+                "file": SimpleUploadedFile("upload.txt", b"file contents"),
+            },
+        )
+        self.secret = Secret.objects.get()
+        self.client.logout()
+
+    def test_download_needs_view_permission(self):
+        url = reverse("download", args=[self.secret.pk])
+        self.assertRedirects(
+            self.client.get(url), f"{reverse('admin:login')}?next={url}"
+        )
+
+        user = get_user_model().objects.create_user("nobody")
+        self.client.force_login(user)
+        self.assertEqual(self.client.get(url).status_code, 302)
+
+    def test_download_escapes_filename(self):
+        self.client.force_login(self.admin)
+
+        response = self.client.get(reverse("download", args=[self.secret.pk]))
+
+        self.assertEqual(b"".join(response.streaming_content), b"file contents")
+        self.assertEqual(
+            response["Content-Disposition"],
+            'attachment; filename="report \\"q1\\".txt"',
+        )
+
+    def test_metrics_need_staff(self):
+        self.enterContext(
+            override_settings(
+                TINK_FIELD_INSTRUMENTATION=(
+                    "tink_field.instrumentation.PrometheusInstrumentation"
+                )
+            )
+        )
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 302)
+
+        self.client.force_login(self.admin)
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 200)
+
+
+class PrometheusInstrumentationTests(OfflineMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.enterContext(
+            override_settings(
+                TINK_FIELD_INSTRUMENTATION=(
+                    "tink_field.instrumentation.PrometheusInstrumentation"
+                )
+            )
+        )
+
+    def test_renders_field_metrics(self):
+        secret = self.make_secret()
+        secret = Secret.objects.with_ciphertext().get(pk=secret.pk)
+        secret.plaintext_from_json
+
+        text = get_instrumentation().render()
+
+        json_labels = (
+            'operation="encrypt",field="Secret.plaintext_from_json",'
+            'encryptor="JsonEncryptor"'
+        )
+        self.assertIn(f"tink_field_operation_seconds_count{{{json_labels}}} 1", text)
+        self.assertIn(f"tink_field_payload_bytes_count{{{json_labels}}} 1", text)
+        self.assertIn(
+            'tink_field_events_total{event="decrypt_primary",'
+            'field="Secret.plaintext_from_json",encryptor="JsonEncryptor"} 1',
+            text,
+        )
+        self.assertIn("# TYPE tink_field_keyset_reloads_total counter", text)
+        self.assertIn(
+            f"tink_field_keyset_primary_key_id {keysets.active_key_id()}", text
+        )
+
+    def test_histogram_buckets_are_cumulative(self):
+        instrumentation = PrometheusInstrumentation()
+        instrumentation.observe("encrypt", 'a "quoted"\nlabel', "E", 0.001, 10)
+        instrumentation.observe("encrypt", 'a "quoted"\nlabel', "E", 0.001, 100)
+
+        text = instrumentation.render()
+
+        labels = 'operation="encrypt",field="a \\"quoted\\"\\nlabel",encryptor="E"'
+        self.assertIn(f'tink_field_payload_bytes_bucket{{{labels},le="16"}} 1', text)
+        self.assertIn(f'tink_field_payload_bytes_bucket{{{labels},le="256"}} 2', text)
+        self.assertIn(f'tink_field_payload_bytes_bucket{{{labels},le="+Inf"}} 2', text)
+        self.assertIn(f"tink_field_payload_bytes_sum{{{labels}}} 110.0", text)
+
+
+class ExpireKeyVersionsTests(OfflineMixin, TestCase):
+    KEY = "projects/p/locations/l/keyRings/r/cryptoKeys/k"
+    OLD = f"{KEY}/cryptoKeyVersions/1"
+    PRIMARY = f"{KEY}/cryptoKeyVersions/2"
+
+    def setUp(self):
+        super().setUp()
+        self.secret = self.make_secret()
+        self.enterContext(
+            override_settings(
+                GCP_PROJECT_ID="p",
+                KMS_LOCATION_ID="l",
+                KMS_KEY_RING_ID="r",
+                KMS_KEY_ID="k",
+            )
+        )
+        self.client = self.enterContext(
+            mock.patch(
+                "tink_field.management.commands.expire_key_versions.kms."
+                "KeyManagementServiceClient"
+            )
+        ).return_value
+        self.client.get_crypto_key.return_value.primary.name = self.PRIMARY
+        created = timezone.now() - LONG_AGO
+        self.client.list_crypto_key_versions.return_value = [
+            SimpleNamespace(name=name, create_time=created)
+            for name in (self.OLD, self.PRIMARY)
+        ]
+        # disable_key_version prints
+        self.enterContext(redirect_stdout(io.StringIO()))
+
+    def expire(self):
+        call_command("expire_key_versions", stdout=io.StringIO())
+
+    def disabled(self) -> list[str]:
+        return [
+            call.kwargs["request"]["crypto_key_version"]["name"]
+            for call in self.client.update_crypto_key_version.call_args_list
+        ]
+
+    def encrypted_keyset(self, used_primary: bool):
+        tmp = self.enterContext(tempfile.TemporaryDirectory())
+        keyset_file = os.path.join(tmp, "keyset.json")
+        with open(keyset_file, "wt") as f:
+            json.dump({"encryptedKeyset": base64.b64encode(b"wrapped").decode()}, f)
+        self.enterContext(override_settings(KEYSET_FILE=keyset_file))
+        self.client.decrypt.return_value.used_primary = used_primary
+
+    def test_keyset_mode_checks_the_keyset_not_tink_key_ids(self):
+        self.encrypted_keyset(used_primary=True)
+
+        self.expire()
+
+        self.assertEqual(
+            self.client.decrypt.call_args.kwargs["request"]["ciphertext"], b"wrapped"
+        )
+        self.assertEqual(self.disabled(), [self.OLD])
+
+    def test_keyset_mode_refuses_keyset_under_old_version(self):
+        self.encrypted_keyset(used_primary=False)
+
+        with self.assertRaisesMessage(CommandError, "KEYSET_FILE"):
+            self.expire()
+        self.assertEqual(self.disabled(), [])
+
+    @override_settings(KEYSET_FILE=None, KMS_DEK_CACHE=True)
+    def test_envelope_mode_compares_kms_versions(self):
+        Secret.objects.update(
+            binary_key_id=self.PRIMARY, b64_key_id=self.OLD, json_key_id=self.PRIMARY
+        )
+        with self.assertRaisesMessage(CommandError, "1 rows"):
+            self.expire()
+
+        Secret.objects.update(b64_key_id=self.PRIMARY)
+        self.expire()
+        self.assertEqual(self.disabled(), [self.OLD])
+
+    @override_settings(
+        KEYSET_FILE=None, KMS_DEK_CACHE=True, READ_REPLICA_DATABASE="replica"
+    )
+    def test_envelope_mode_counts_rows_on_the_primary(self):
+        # The test case isn't allowed to query the replica, so reading the census
+        # from it fails the test
+        Secret.objects.update(
+            binary_key_id=self.PRIMARY, b64_key_id=self.OLD, json_key_id=self.PRIMARY
+        )
+
+        with self.assertRaisesMessage(CommandError, "1 rows"):
+            self.expire()
+
+    @override_settings(KEYSET_FILE=None, KMS_DEK_CACHE=False)
+    def test_plain_envelope_mode_refuses(self):
+        with self.assertRaisesMessage(CommandError, "KMS_DEK_CACHE"):
+            self.expire()
+        self.client.list_crypto_key_versions.assert_not_called()
+
+
+class ReplicaMemoTests(OfflineMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.enterContext(
+            mock.patch(
+                "tink_field.encrypted_field.read_from_replica", return_value=True
+            )
+        )
+        self.addCleanup(get_recent_reencryptions().clear)
+        legacy = legacy_encryptor().encrypt("hunter2")
+        self.secret = self.make_secret(
+            b64_encrypted_secret=legacy, b64_reencryption_time=None
+        )
+
+    def test_lagging_replica_read_isnt_reencrypted_again(self):
+        # As the replica would return it, ciphertext included
+        first, lagging = (Secret.objects.with_ciphertext().get() for _ in range(2))
+
+        first.plaintext_from_b64
+        self.assertIsNotNone(first.b64_reencryption_time)
+        self.assertEqual(lagging.plaintext_from_b64.decrypted_value(), b"hunter2")
+
+        self.assertIsNone(lagging.b64_reencryption_time)
+
+    def test_row_rewritten_with_the_same_time_is_reencrypted(self):
+        Secret.objects.get().plaintext_from_b64
+        Secret.objects.update(
+            b64_encrypted_secret=legacy_encryptor().encrypt("correct horse"),
+            b64_reencryption_time=None,
+        )
+
+        rewritten = Secret.objects.get()
+        self.assertEqual(
+            rewritten.plaintext_from_b64.decrypted_value(), b"correct horse"
+        )
+
+        self.assertIsNotNone(rewritten.b64_reencryption_time)
+
+
+class ConditionalReencryptionTests(OfflineMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.secret = self.make_secret()
+        self.make_stale(self.secret)
+        self.increment = self.enterContext(
+            mock.patch.object(Instrumentation, "increment")
+        )
+
+    def skipped(self) -> list[str]:
+        return [
+            c.args[1]
+            for c in self.increment.call_args_list
+            if c.args[0] == "reencryption_skipped"
+        ]
+
+    def test_loser_of_a_race_skips_its_write(self):
+        first, second = (Secret.objects.with_ciphertext().get() for _ in range(2))
+
+        first.plaintext_from_b64
+        second.plaintext_from_b64
+
+        self.assertEqual(self.skipped(), ["Secret.plaintext_from_b64"])
+        fresh = Secret.objects.get()
+        self.assertEqual(fresh.b64_encrypted_secret, first.b64_encrypted_secret)
+        self.assertNotEqual(fresh.b64_encrypted_secret, second.b64_encrypted_secret)
+
+    def test_legacy_rewrite_with_the_same_null_time_is_kept(self):
+        legacy = self.make_secret(
+            name="legacy",
+            b64_encrypted_secret=legacy_encryptor().encrypt("old"),
+            b64_reencryption_time=None,
+        )
+        stale = Secret.objects.with_ciphertext().get(pk=legacy.pk)
+
+        with coalesce_reencryption():
+            self.assertEqual(stale.plaintext_from_b64.decrypted_value(), b"old")
+            # Legacy code rewrites the row without touching the time
+            Secret.objects.filter(pk=legacy.pk).update(
+                b64_encrypted_secret=legacy_encryptor().encrypt("NEW")
+            )
+
+        self.assertEqual(self.skipped(), ["Secret.plaintext_from_b64"])
+        self.assertEqual(self.read_b64(legacy.pk), b"NEW")
+
+    def test_concurrent_readers_share_one_reencryption(self):
+        field = encrypted_fields(Secret)["plaintext_from_b64"]
+        leader, follower = (Secret.objects.with_ciphertext().get() for _ in range(2))
+        encrypting, release, waiting = (threading.Event() for _ in range(3))
+        self.addCleanup(release.set)
+        encrypt, wait = field.encryptor.encrypt, Flight.wait
+
+        def slow_encrypt(*args):
+            encrypting.set()
+            release.wait(5)
+            return encrypt(*args)
+
+        def wait_and_signal(flight, timeout):
+            waiting.set()
+            return wait(flight, timeout)
+
+        self.enterContext(
+            mock.patch.object(field.encryptor, "encrypt", side_effect=slow_encrypt)
+        )
+        self.enterContext(mock.patch.object(Flight, "wait", wait_and_signal))
+        save = self.enterContext(
+            mock.patch("tink_field.encrypted_field.save_reencrypted")
+        )
+        leading = threading.Thread(target=lambda: leader.plaintext_from_b64)
+        leading.start()
+        self.assertTrue(encrypting.wait(5))
+        following = threading.Thread(target=lambda: follower.plaintext_from_b64)
+        following.start()
+        self.assertTrue(waiting.wait(5))
+        release.set()
+        leading.join()
+        following.join()
+
+        self.assertEqual(field.encryptor.encrypt.call_count, 1)
+        save.assert_called_once()
+        self.assertEqual(follower.b64_encrypted_secret, leader.b64_encrypted_secret)
+        self.assertEqual(follower.b64_reencryption_time, leader.b64_reencryption_time)
+        self.assertEqual(self.skipped(), ["Secret.plaintext_from_b64"])
+
+
+class CoalesceTests(OfflineMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.make_stale(self.make_secret())
+
+    def test_coalesced_reads_write_each_row_once(self):
+        secret = Secret.objects.with_ciphertext().get()
+
+        with CaptureQueriesContext(connection) as queries:
+            with coalesce_reencryption():
+                secret.plaintext_from_binary
+                secret.plaintext_from_b64
+                secret.plaintext_from_json
+
+        updates = [q["sql"] for q in queries if q["sql"].startswith("UPDATE")]
+        self.assertEqual(len(updates), 1)
+        fresh = Secret.objects.get()
+        for field in encrypted_fields(Secret).values():
+            self.assertFalse(field.needs_reencryption(fresh))
+
+
+class RateLimitTests(OfflineMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.secret = self.make_secret()
+        self.make_stale(self.secret)
+        self.increment = self.enterContext(
+            mock.patch.object(Instrumentation, "increment")
+        )
+
+    @override_settings(REENCRYPTION_RATE_LIMIT=0.001, REENCRYPTION_RATE_BURST=1)
+    def test_reencryptions_over_budget_are_deferred(self):
+        other = self.make_secret(name="other")
+        self.make_stale(other)
+
+        Secret.objects.get(pk=self.secret.pk).plaintext_from_b64
+        deferred = Secret.objects.get(pk=other.pk)
+        self.assertEqual(deferred.plaintext_from_b64.decrypted_value(), "hunter2")
+
+        field = encrypted_fields(Secret)["plaintext_from_b64"]
+        self.assertFalse(
+            field.needs_reencryption(Secret.objects.get(pk=self.secret.pk))
+        )
+        self.assertTrue(field.needs_reencryption(Secret.objects.get(pk=other.pk)))
+        self.increment.assert_any_call("reencryption_deferred", field.label)
+
+    def test_bucket_refills_over_time(self):
+        bucket = TokenBucket(rate=10.0, burst=2)
+        with mock.patch("tink_field.rate_limit.time.monotonic", return_value=100.0):
+            bucket._updated = 100.0
+            self.assertEqual([bucket.acquire() for _ in range(3)], [True, True, False])
+        with mock.patch("tink_field.rate_limit.time.monotonic", return_value=100.15):
+            self.assertTrue(bucket.acquire())
+            self.assertFalse(bucket.acquire())
+        self.assertTrue(TokenBucket(rate=None).acquire())
+
+
+class JitterTests(SimpleTestCase):
+    def test_window_depends_only_on_the_primary_key(self):
+        field = EncryptedField(
+            encryptor=TinkEncryptor(),
+            ciphertext_attr="ciphertext",
+            last_reencryption_time_attr="reencrypted",
+            reencryption_window=timedelta(days=30),
+            reencryption_jitter=0.2,
+        )
+        windows = {
+            pk: field.reencryption_window_for(Secret(pk=pk)) for pk in range(1, 201)
+        }
+
+        self.assertEqual(field.reencryption_window_for(Secret(pk=7)), windows[7])
+        self.assertTrue(
+            all(timedelta(days=24) < w <= timedelta(days=30) for w in windows.values())
+        )
+        self.assertGreater(len(set(windows.values())), 100)
+
+
+class JsonEncryptorTests(OfflineMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.encryptor = JsonEncryptor(paths=["password", "tokens.*.value"])
+        self.document = {
+            "user": {"name": "alice"},
+            "password": "hunter2",
+            "tokens": [{"value": "a", "scope": "read"}, {"value": ["b"]}],
+        }
+
+    def test_round_trip_encrypts_only_the_paths(self):
+        encrypted = self.encryptor.encrypt(self.document, "ad")
+
+        self.assertIs(encrypted["user"], self.document["user"])
+        self.assertEqual(encrypted["tokens"][0]["scope"], "read")
+        self.assertNotEqual(encrypted["password"], "hunter2")
+        self.assertEqual(self.document["password"], "hunter2")
+        self.assertEqual(self.encryptor.decrypt(encrypted, "ad"), self.document)
+        self.assertEqual(
+            async_to_sync(self.encryptor.adecrypt)(
+                async_to_sync(self.encryptor.aencrypt)(self.document, "ad"), "ad"
+            ),
+            self.document,
+        )
+
+    def test_values_cant_move_between_paths(self):
+        encrypted = self.encryptor.encrypt(self.document, "ad")
+        encrypted["password"] = encrypted["tokens"][0]["value"]
+
+        strict = JsonEncryptor(
+            paths=["password", "tokens.*.value"], legacy_associated_data=False
+        )
+        with self.assertRaises(Exception):
+            strict.decrypt(encrypted, "ad")
+
+    def test_nested_paths_are_rejected(self):
+        with self.assertRaises(ValueError):
+            JsonEncryptor(paths=["tokens", "tokens.0"])
+
+
+@override_settings(BLIND_INDEX_KEY=generate_key())
+class BlindIndexTests(OfflineMixin, TestCase):
+    def test_filter_encrypted_finds_equal_values(self):
+        secret = self.make_secret(plaintext="hunter2")
+        self.make_secret(name="other", plaintext="correct horse")
+
+        with self.assertNumQueries(1):
+            found = list(Secret.objects.filter_encrypted(plaintext_from_b64="hunter2"))
+
+        self.assertEqual([s.pk for s in found], [secret.pk])
+
+    def test_index_follows_assignment(self):
+        secret = self.make_secret(plaintext="hunter2")
+        secret.plaintext_from_b64 = "changed"
+        secret.save()
+
+        matches = Secret.objects.filter_encrypted
+        self.assertFalse(matches(plaintext_from_b64="hunter2").exists())
+        self.assertTrue(matches(plaintext_from_b64="changed").exists())
+
+
+class RebuildBlindIndexTests(OfflineMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.enterContext(override_settings(BLIND_INDEX_KEY=generate_key()))
+        self.secret = self.make_secret(plaintext="old")
+        # A new key, so every index needs rebuilding
+        self.enterContext(override_settings(BLIND_INDEX_KEY=generate_key()))
+
+    def test_rebuilds_indexes_under_the_new_key(self):
+        stats = rebuild_blind_indexes(Secret.objects.all())
+
+        self.assertEqual((stats.updated, stats.skipped), (1, 0))
+        found = Secret.objects.filter_encrypted(plaintext_from_b64="old")
+        self.assertEqual([s.pk for s in found], [self.secret.pk])
+
+    def test_keeps_index_of_concurrent_save(self):
+        def save_meanwhile(instances, field_names):
+            decrypt_instances(instances, field_names)
+            other = Secret.objects.get(pk=self.secret.pk)
+            other.plaintext_from_b64 = "NEW"
+            other.save()
+
+        with mock.patch(
+            "tink_field.reencryption.decrypt_instances", side_effect=save_meanwhile
+        ):
+            stats = rebuild_blind_indexes(Secret.objects.all())
+
+        self.assertEqual((stats.updated, stats.skipped), (0, 1))
+        matches = Secret.objects.filter_encrypted
+        self.assertFalse(matches(plaintext_from_b64="old").exists())
+        self.assertTrue(matches(plaintext_from_b64="NEW").exists())
+
+
+class StreamingTests(SimpleTestCase):
+    def setUp(self):
+        self.enterContext(streaming_settings())
+        self.encryptor = StreamingEncryptor()
+        # Several 4 KB segments
+        self.plaintext = os.urandom(20000)
+
+    def encrypt(self) -> bytes:
+        ciphertext = io.BytesIO()
+        self.encryptor.encrypt_stream(io.BytesIO(self.plaintext), ciphertext, "ad")
+        return ciphertext.getvalue()
+
+    def test_round_trip(self):
+        ciphertext = self.encrypt()
+
+        plaintext = io.BytesIO()
+        self.encryptor.decrypt_stream(io.BytesIO(ciphertext), plaintext, "ad")
+        self.assertEqual(plaintext.getvalue(), self.plaintext)
+        chunks = self.encryptor.iter_decrypted(
+            io.BytesIO(ciphertext), "ad", chunk_size=1000
+        )
+        self.assertEqual(b"".join(chunks), self.plaintext)
+
+    def test_chunked_rows_round_trip(self):
+        rows = {}
+        self.encryptor.write_chunks(
+            io.BytesIO(self.plaintext), rows.__setitem__, "ad", chunk_size=3000
+        )
+
+        self.assertTrue(all(len(rows[i]) == 3000 for i in range(len(rows) - 1)))
+        reader = ChunkReader(rows[i] for i in sorted(rows))
+        with self.encryptor.open_decrypted(reader, "ad") as decrypted:
+            self.assertEqual(decrypted.read(), self.plaintext)
+
+    def test_truncated_ciphertext_fails(self):
+        ciphertext = self.encrypt()[:-100]
+
+        with self.assertRaises(Exception):
+            self.encryptor.decrypt_stream(io.BytesIO(ciphertext), io.BytesIO(), "ad")
+
+
+class AdminTests(OfflineMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        admin = get_user_model().objects.create_superuser("admin", password=None)
+        self.client.force_login(admin)
+
+    def test_json_preview_keeps_other_keys(self):
+        secret = self.make_secret(name="visible-name")
+
+        response = self.client.get("/admin/tink_field/secret/")
+
+        [row] = response.context["cl"].result_list
+        preview = SecretAdmin(Secret, None).json_with_secret(row)
+        self.assertEqual(preview["name"], "visible-name")
+        ciphertext = secret.json_with_encrypted_secret["secret"]
+        self.assertEqual(preview["secret"], f"{ciphertext[:5]}...{ciphertext[-5:]}")
+
+    def test_pages_past_the_count_limit(self):
+        for i in range(12):
+            self.make_secret(name=f"secret-{i}")
+        queryset = Secret.objects.filter(name__startswith="secret-").order_by("pk")
+
+        with mock.patch.object(EstimatedCountPaginator, "exact_count_limit", 5):
+            paginator = EstimatedCountPaginator(queryset, 2)
+            self.assertEqual(paginator.count, 5)
+            page = paginator.page(6)
+
+        self.assertEqual([s.name for s in page], ["secret-10", "secret-11"])
+        self.assertEqual(paginator.count, 12)
+
+
+class ReencryptQuerysetTests(OfflineMixin, TransactionTestCase):
+    def test_reencrypts_stale_rows(self):
+        secret = self.make_secret()
+        self.make_stale(secret)
+
+        stats = reencrypt_queryset(Secret.objects.all(), workers=1)
+
+        self.assertEqual((stats.scanned, stats.reencrypted, stats.skipped), (1, 1, 0))
+        fresh = Secret.objects.get(pk=secret.pk)
+        for f in encrypted_fields(Secret).values():
+            self.assertFalse(f.needs_reencryption(fresh), f.label)
+        self.assertEqual(self.read_b64(secret.pk), "hunter2")
+
+    def test_keeps_concurrent_save(self):
+        secret = self.make_secret(plaintext="old")
+        self.make_stale(secret)
+        reencrypt = EncryptedField.reencrypt
+
+        def save_meanwhile(field, obj):
+            # Someone saves a new value after the chunk was read
+            if field.name == "plaintext_from_b64":
+                other = Secret.objects.get(pk=obj.pk)
+                other.plaintext_from_b64 = "NEW"
+                other.save()
+            return reencrypt(field, obj)
+
+        with mock.patch.object(EncryptedField, "reencrypt", save_meanwhile):
+            stats = reencrypt_queryset(
+                Secret.objects.all(), ["plaintext_from_b64"], workers=1
+            )
+
+        self.assertEqual(stats.skipped, 1)
+        self.assertEqual(self.read_b64(secret.pk), "NEW")
+
+    def test_keeps_legacy_rewrite_with_the_same_null_time(self):
+        secret = self.make_secret(
+            b64_encrypted_secret=legacy_encryptor().encrypt("old"),
+            b64_reencryption_time=None,
+        )
+        reencrypt = EncryptedField.reencrypt
+
+        def rewrite_meanwhile(field, obj):
+            Secret.objects.filter(pk=obj.pk).update(
+                b64_encrypted_secret=legacy_encryptor().encrypt("NEW")
+            )
+            return reencrypt(field, obj)
+
+        with mock.patch.object(EncryptedField, "reencrypt", rewrite_meanwhile):
+            stats = reencrypt_queryset(
+                Secret.objects.all(), ["plaintext_from_b64"], workers=1
+            )
+
+        self.assertEqual(stats.skipped, 1)
+        self.assertEqual(self.read_b64(secret.pk), b"NEW")
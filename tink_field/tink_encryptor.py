@@ -1,73 +1,32 @@
-import tink
-from tink import aead
-from tink.integration import gcpkms
-from tink import secret_key_access
+import asyncio
 
+from . import compression
 from .encrypted_field import EncryptorInterface
-
-from django.conf import settings
-
-
-def can_use_kms():
-    return all(
-        map(
-            lambda x: x is not None,
-            [
-                settings.GCP_PROJECT_ID,
-                settings.KMS_LOCATION_ID,
-                settings.KMS_KEY_RING_ID,
-                settings.KMS_KEY_ID,
-            ],
-        ),
-    )
-
-
-def kms_path():
-    if can_use_kms():
-        return f"projects/{settings.GCP_PROJECT_ID}/locations/{settings.KMS_LOCATION_ID}/keyRings/{settings.KMS_KEY_RING_ID}/cryptoKeys/{settings.KMS_KEY_ID}"
+from .keysets import (
+    HEADER_LEN,
+    aget_aead,
+    aload_keyset,
+    can_use_kms,
+    ciphertext_key_id,
+    get_aead,
+    get_ciphertext_matcher,
+    kms_path,
+)
 
 
 class TinkEncryptor(EncryptorInterface):
     """
-    Minimal encryptor. Deals in bytes.
+    Minimal encryptor. Deals in bytes. Large plaintexts are compressed before
+    encryption if `settings.TINK_FIELD_COMPRESSION` is set (see `compression`).
+
+    Construction is cheap: the AEAD primitive is resolved from the settings on first
+    use and shared with every other `TinkEncryptor` (see `keysets.get_aead`). It is
+    swapped out when `KEYSET_FILE` changes on disk, without a restart.
     """
 
-    def __init__(self):
-        aead.register()
-
-        remote_aead = None
-        if can_use_kms():
-            kms_uri = f"gcp-kms://{kms_path()}"
-            client = gcpkms.GcpKmsClient(kms_uri, settings.GCP_CREDENTIAL_FILE)
-            remote_aead = client.get_aead(kms_uri)
-
-        keyset_contents = None
-        if settings.KEYSET_FILE is not None:
-            with open(settings.KEYSET_FILE, "rt") as f:
-                keyset_contents = f.read()
-
-        if keyset_contents is not None and remote_aead is not None:
-            # Encrypted keyset
-            keyset_handle = tink.json_proto_keyset_format.parse_encrypted(
-                keyset_contents,
-                remote_aead,
-                None,  # associated data
-            )
-            self.encryptor = keyset_handle.primitive(aead.Aead)
-        elif keyset_contents is not None:
-            # Plaintext keyset
-            keyset_handle = tink.json_proto_keyset_format.parse(
-                keyset_contents, secret_key_access.TOKEN
-            )
-            self.encryptor = keyset_handle.primitive(aead.Aead)
-        elif remote_aead is not None:
-            # KmsEnvelopeAead
-            self.encryptor = aead.KmsEnvelopeAead(
-                aead.aead_key_templates.AES256_GCM, remote_aead
-            )
-        else:
-            raise Exception("No encryptor settings provided")
-        pass
+    @property
+    def encryptor(self):
+        return get_aead()
 
     def encrypt(
         self, plaintext: str | bytes, associated_data: str | bytes = b""
@@ -76,10 +35,48 @@ class TinkEncryptor(EncryptorInterface):
             plaintext = plaintext.encode("utf-8")
         if type(associated_data) == str:
             associated_data = associated_data.encode("utf-8")
+        plaintext = compression.compress(plaintext)
         return self.encryptor.encrypt(plaintext, associated_data)
 
     def decrypt(self, ciphertext: bytes, associated_data: bytes = b"") -> bytes:
-        return self.encryptor.decrypt(ciphertext, associated_data)
+        plaintext = self.encryptor.decrypt(ciphertext, associated_data)
+        return compression.decompress(plaintext)
+
+    def may_decrypt(self, ciphertext) -> bool:
+        if not isinstance(ciphertext, (bytes, bytearray, memoryview)):
+            return False
+        return get_ciphertext_matcher()(bytes(ciphertext[:HEADER_LEN]), len(ciphertext))
+
+    async def amay_decrypt(self, ciphertext) -> bool:
+        await aload_keyset()
+        return self.may_decrypt(ciphertext)
+
+    def key_id(self, ciphertext: bytes) -> str | None:
+        return ciphertext_key_id(bytes(ciphertext))
+
+    async def aencrypt(
+        self, plaintext: str | bytes, associated_data: str | bytes = b""
+    ) -> bytes:
+        if type(plaintext) == str:
+            plaintext = plaintext.encode("utf-8")
+        if type(associated_data) == str:
+            associated_data = associated_data.encode("utf-8")
+        plaintext = compression.compress(plaintext)
+        # One lookup, so a keyset reload can't swap the primitive mid-call
+        encryptor = await aget_aead()
+        if hasattr(encryptor, "aencrypt"):
+            return await encryptor.aencrypt(plaintext, associated_data)
+        return await asyncio.to_thread(encryptor.encrypt, plaintext, associated_data)
+
+    async def adecrypt(self, ciphertext: bytes, associated_data: bytes = b"") -> bytes:
+        encryptor = await aget_aead()
+        if hasattr(encryptor, "adecrypt"):
+            plaintext = await encryptor.adecrypt(ciphertext, associated_data)
+        else:
+            plaintext = await asyncio.to_thread(
+                encryptor.decrypt, ciphertext, associated_data
+            )
+        return compression.decompress(plaintext)
 
 
 _encryptor: TinkEncryptor = None
@@ -4,4 +4,6 @@ from . import views
 
 urlpatterns = [
     path("create", views.create, name="create"),
+    path("<int:pk>/file", views.download, name="download"),
+    path("metrics", views.metrics, name="metrics"),
 ]
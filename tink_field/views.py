@@ -1,8 +1,18 @@
-from django.shortcuts import render
-from django.http import HttpResponse, HttpResponseRedirect
+from django.contrib.admin.views.decorators import staff_member_required
+from django.contrib.auth.decorators import permission_required
+from django.shortcuts import get_object_or_404, render
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseRedirect,
+    StreamingHttpResponse,
+)
 from django.urls import reverse
+from django.utils.http import content_disposition_header
 
+from .instrumentation import get_instrumentation
 from .legacy_encryptor import get_encryptor as legacy_encryptor
+from .streaming import get_encryptor as streaming_encryptor
 
 from .models import Secret
 
@@ -29,7 +39,51 @@ def create(request):
         else:
             # Bypass `EncryptedField`. Not bothering with the binary one
             new_secret.b64_encrypted_secret = legacy_encryptor().encrypt(plaintext)
-            new_secret.json_with_encrypted_secret = plaintext_json
+            new_secret.json_with_encrypted_secret = {
+                "name": name,
+                "secret": legacy_encryptor().encrypt(plaintext),
+            }
+
+        upload = request.FILES.get("file")
+        if upload is not None:
+            # Uploads are read in chunks (and spooled to disk past
+            # FILE_UPLOAD_MAX_MEMORY_SIZE), so the plaintext is never all in memory
+            new_secret.encrypted_file.name = streaming_encryptor().save_to_storage(
+                new_secret.encrypted_file.storage,
+                new_secret.encrypted_file.field.generate_filename(
+                    new_secret, upload.name
+                ),
+                upload,
+                name,
+            )
 
         new_secret.save()
         return HttpResponseRedirect(reverse("create"))
+
+
+@permission_required("tink_field.view_secret", login_url="admin:login")
+def download(request, pk):
+    secret = get_object_or_404(
+        Secret.objects.only("name", "encrypted_file"), pk=pk, encrypted_file__gt=""
+    )
+    response = StreamingHttpResponse(
+        streaming_encryptor().iter_decrypted(
+            secret.encrypted_file.storage.open(secret.encrypted_file.name, "rb"),
+            secret.name,
+        ),
+        content_type="application/octet-stream",
+    )
+    response["Content-Disposition"] = content_disposition_header(
+        as_attachment=True, filename=secret.name
+    )
+    return response
+
+
+@staff_member_required
+def metrics(request):
+    instrumentation = get_instrumentation()
+    if not hasattr(instrumentation, "render"):
+        raise Http404("No exportable instrumentation configured")
+    return HttpResponse(
+        instrumentation.render(), content_type="text/plain; version=0.0.4"
+    )
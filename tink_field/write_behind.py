@@ -0,0 +1,157 @@
+import atexit
+import logging
+import queue
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, router
+from django.db.models import Q
+
+from .coalesce import unchanged_q
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindQueue:
+    """
+    Bounded in-process queue of re-encrypted rows waiting to be written back.
+
+    `EncryptedField` enqueues the new column values of a stale row instead of saving
+    it on the read path. A background thread drains the queue and writes the rows
+    back with one `bulk_update` per model and set of columns, which only touches
+    rows whose last re-encryption times (and ciphertexts) are still the ones they
+    were read with; a row saved in the meantime keeps its new value and counts as
+    `skipped`. If the queue is full the row is dropped; it is still stale in the database, so it will
+    be re-encrypted again on a later read. Whatever is still queued is flushed at
+    interpreter exit.
+    """
+
+    def __init__(self, maxsize=10000, batch_size=500, flush_interval=1.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enqueued = 0
+        self.written = 0
+        self.skipped = 0
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize)
+        self._write_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def enqueue(self, obj, update_fields: list[str], expected: dict) -> bool:
+        """
+        Snapshots `update_fields` of `obj` for a later write, conditional on the
+        `expected` columns still holding the values `obj` was read with. Returns
+        `False` if the queue was full and the write was dropped.
+        """
+        values = {name: getattr(obj, name) for name in update_fields}
+        # An instance read from a replica is still written to the primary
+        using = router.db_for_write(type(obj), instance=obj)
+        item = (type(obj), using, obj.pk, values, expected)
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.enqueued += 1
+        self._ensure_started()
+        return True
+
+    def flush(self):
+        """
+        Synchronously writes everything currently queued.
+        """
+        while True:
+            batch = self._drain(block=False)
+            if not batch:
+                return
+            self._write(batch)
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="tink-field-write-behind", daemon=True
+                )
+                self._thread.start()
+
+    def _drain(self, block: bool):
+        batch = []
+        try:
+            if block:
+                batch.append(self._queue.get(timeout=self.flush_interval))
+            while len(batch) < self.batch_size:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _run(self):
+        while not self._stopping.is_set():
+            batch = self._drain(block=True)
+            if batch:
+                try:
+                    self._write(batch)
+                except Exception:
+                    logger.exception("write-behind re-encryption flush failed")
+                finally:
+                    close_old_connections()
+
+    def _write(self, batch):
+        # Merge every entry for the same row; later values win, but the row must
+        # still hold what the earliest entry read
+        rows = {}
+        for model, using, pk, values, expected in batch:
+            row_values, row_expected = rows.setdefault((model, using, pk), ({}, {}))
+            row_values.update(values)
+            for column, value in expected.items():
+                row_expected.setdefault(column, value)
+
+        groups = {}
+        for (model, using, pk), (values, expected) in rows.items():
+            key = (model, using, tuple(values))
+            groups.setdefault(key, []).append((model(pk=pk, **values), expected))
+
+        with self._write_lock:
+            for (model, using, fields), entries in groups.items():
+                unchanged = Q()
+                for obj, expected in entries:
+                    unchanged |= unchanged_q(obj.pk, expected)
+                objs = [obj for obj, _ in entries]
+                updated = (
+                    model._base_manager.using(using)
+                    .filter(unchanged)
+                    .bulk_update(objs, list(fields))
+                )
+                self.written += updated
+                self.skipped += len(objs) - updated
+
+
+_queue: WriteBehindQueue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue() -> WriteBehindQueue:
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = WriteBehindQueue(
+                    maxsize=getattr(settings, "REENCRYPTION_QUEUE_SIZE", 10000),
+                    batch_size=getattr(settings, "REENCRYPTION_BATCH_SIZE", 500),
+                    flush_interval=getattr(
+                        settings, "REENCRYPTION_FLUSH_INTERVAL", 1.0
+                    ),
+                )
+                atexit.register(_queue.stop)
+
+    return _queue